@@ -8,7 +8,7 @@
 # ============================================================================================================================================
 # IMPORTS
 # ============================================================================================================================================
-import os
+import os, json, time, base64, asyncio
 from pathlib import Path
 from dotenv import load_dotenv
 from aiohttp import ClientResponseError, ClientError
@@ -25,6 +25,56 @@ USER_AI_SERVICE_LEAPER = os.environ.get("USER_AI_SERVICE_LEAPER")
 PASSWORD_AI_SERVICE_LEAPER = os.environ.get("PASSWORD_AI_SERVICE_LEAPER")
 LEAPER_API_URL_BASE = os.getenv("LEAPER_API_URL_BASE")
 
+# CACHE DE TOKENS: TTL usado quando o token não traz 'exp' e margem de segurança antes de expirar
+LEAPER_TOKEN_TTL_PADRAO = int(os.getenv("LEAPER_TOKEN_TTL_PADRAO", "1800"))
+LEAPER_TOKEN_MARGEM_EXPIRACAO = int(os.getenv("LEAPER_TOKEN_MARGEM_EXPIRACAO", "60"))
+
+
+# ========================================================================================================================================================================
+# CACHE DE TOKENS (service-user compartilhado + token por company)
+# ========================================================================================================================================================================
+_token_service_user = {"token": None, "expira_em": 0.0}
+_tokens_company = {}            # id_company -> {"token": str, "expira_em": float}
+_locks_login = {}               # chave -> asyncio.Lock (single-flight por company / service-user)
+
+
+def _lock_login(chave):
+    lock = _locks_login.get(chave)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks_login[chave] = lock
+    return lock
+
+
+def _calcula_expiracao_token(token):
+    """Lê o 'exp' do JWT (sem validar assinatura); sem 'exp' usa LEAPER_TOKEN_TTL_PADRAO."""
+    agora = time.time()
+    try:
+        payload_b64 = token.split(" ")[-1].split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload_b64)).get("exp")
+        if exp:
+            return float(exp) - LEAPER_TOKEN_MARGEM_EXPIRACAO
+    except Exception:
+        pass
+    return agora + LEAPER_TOKEN_TTL_PADRAO
+
+
+def _token_valido(entrada):
+    return bool(entrada and entrada.get("token") and entrada.get("expira_em", 0) > time.time())
+
+
+def invalida_token_leaper(token):
+    """Remove do cache o token recusado pela API (401) para que o próximo pedido faça novo login."""
+    if not token:
+        return
+    if _token_service_user.get("token") == token:
+        _token_service_user["token"] = None
+        _token_service_user["expira_em"] = 0.0
+    for id_company, entrada in list(_tokens_company.items()):
+        if entrada.get("token") == token:
+            _tokens_company.pop(id_company, None)
+
 
 # ================================================================================================================================================================================
 # AUTENTICA USUÁRIO DE SERVIÇO
@@ -93,28 +143,75 @@ async def auth_company_leaper(session, auth_token_user_leaper, id_company, max_r
 
 
 # ====================================================================================================
-# FUNÇÃO UTILITÁRIA PARA OBTER O TOKEN APP LEAPER (service-user + company)
+# OBTÉM TOKEN DO USUÁRIO DE SERVIÇO (CACHE COMPARTILHADO ENTRE COMPANIES)
 # ====================================================================================================
-async def get_auth_token_company_leaper(session, id_company):
+async def get_auth_token_service_user_leaper(session, force_refresh: bool = False):
+
+    if not force_refresh and _token_valido(_token_service_user):
+        return _token_service_user["token"]
+
+    async with _lock_login("__service_user__"):
+        # outro chamador pode ter renovado enquanto esperávamos o lock
+        if not force_refresh and _token_valido(_token_service_user):
+            return _token_service_user["token"]
 
-    try:
-        # AUTENTICA USUÁRIO
         auth_service_response = await auth_service_user_leaper(session, USER_AI_SERVICE_LEAPER, PASSWORD_AI_SERVICE_LEAPER)
         auth_token_user_leaper = auth_service_response.get("accessToken", "")
-
         if not auth_token_user_leaper:
-            logger.error("Falha na autenticação do usuário de serviço (Leaper)")
             return None
 
-        # AUTENTICA NA COMPANY
-        auth_company_response = await auth_company_leaper(session, auth_token_user_leaper, id_company)
-        auth_token_app_leaper = auth_company_response.get("accessToken", "")
+        _token_service_user["token"] = auth_token_user_leaper
+        _token_service_user["expira_em"] = _calcula_expiracao_token(auth_token_user_leaper)
+        return auth_token_user_leaper
 
-        if not auth_token_app_leaper:
-            logger.error("Falha na autenticação da company (Leaper)")
-            return None
 
-        return auth_token_app_leaper
+# ====================================================================================================
+# FUNÇÃO UTILITÁRIA PARA OBTER O TOKEN APP LEAPER (service-user + company)
+# ====================================================================================================
+async def get_auth_token_company_leaper(session, id_company, force_refresh: bool = False):
+    """
+    Retorna o token da company a partir do cache enquanto não expirar.
+    Chamadas concorrentes para a mesma company aguardam um único login em andamento.
+    """
+    id_company = str(id_company)
+
+    try:
+        entrada = _tokens_company.get(id_company)
+        if not force_refresh and _token_valido(entrada):
+            return entrada["token"]
+
+        async with _lock_login(id_company):
+            entrada = _tokens_company.get(id_company)
+            if not force_refresh and _token_valido(entrada):
+                return entrada["token"]
+
+            # AUTENTICA USUÁRIO
+            auth_token_user_leaper = await get_auth_token_service_user_leaper(session)
+
+            if not auth_token_user_leaper:
+                logger.error("Falha na autenticação do usuário de serviço (Leaper)")
+                return None
+
+            # AUTENTICA NA COMPANY
+            auth_company_response = await auth_company_leaper(session, auth_token_user_leaper, id_company)
+            auth_token_app_leaper = auth_company_response.get("accessToken", "")
+
+            # token do service-user pode ter sido revogado antes do 'exp': renova uma vez e tenta de novo
+            if not auth_token_app_leaper:
+                auth_token_user_leaper = await get_auth_token_service_user_leaper(session, force_refresh=True)
+                if auth_token_user_leaper:
+                    auth_company_response = await auth_company_leaper(session, auth_token_user_leaper, id_company)
+                    auth_token_app_leaper = auth_company_response.get("accessToken", "")
+
+            if not auth_token_app_leaper:
+                logger.error("Falha na autenticação da company (Leaper)")
+                return None
+
+            _tokens_company[id_company] = {
+                "token": auth_token_app_leaper,
+                "expira_em": _calcula_expiracao_token(auth_token_app_leaper),
+            }
+            return auth_token_app_leaper
 
     except Exception as e:
         logger.error(f"Erro em get_auth_token_company_leaper: {e}", exc_info=True)
@@ -136,6 +233,8 @@ async def change_lead_status(session, auth_token_app_leaper, id_lead, id_status,
                 texto = await resp.text()
                 if resp.status // 100 == 2:
                     return True
+                if resp.status == 401:
+                    invalida_token_leaper(auth_token_app_leaper)
 
                 error_msg = texto or f"HTTP {resp.status}"
                 logger.error(f"change_lead_status tentativa {attempt}/{max_retries} falhou: {error_msg}")
@@ -164,6 +263,8 @@ async def send_lead_conversion_value(session, auth_token_app_leaper, id_lead, co
                 texto = await resp.text()
                 if resp.status // 100 == 2:
                     return True
+                if resp.status == 401:
+                    invalida_token_leaper(auth_token_app_leaper)
 
                 error_msg = texto or f"HTTP {resp.status}"
                 logger.error(f"send_lead_conversion_value tentativa {attempt}/{max_retries} falhou: {error_msg}")
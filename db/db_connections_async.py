@@ -7,7 +7,7 @@
 # ========================================================================================================================================================================
 # IMPORTS
 # ========================================================================================================================================================================
-import os, logging, json
+import os, logging, json, time, asyncio
 from pathlib import Path 
 from dotenv import load_dotenv
 from databases import Database
@@ -24,6 +24,9 @@ LEAPER_DB_PASSWORD = os.getenv("LEAPER_DB_PASSWORD")
 LEAPER_DB_PORT = os.getenv("LEAPER_DB_PORT")
 LEAPER_DB_SSL_MODE = os.getenv("LEAPER_DB_SSL_MODE")
 
+# POOLS EVOLUTION PERSISTENTES: tempo sem uso até fechar o pool (segundos)
+EVO_POOL_IDLE_TIMEOUT = int(os.getenv("EVO_POOL_IDLE_TIMEOUT", "1800"))
+
 
 
 
@@ -92,6 +95,135 @@ async def conecta_leaper_db_evo(evo_db_host, db_name, min_size, max_size):
     conn = Database(leaper_evo_db_url, min_size=min_size, max_size=max_size, timeout=60, command_timeout=120)
     await conn.connect()
     return conn
-    
 
 
+
+# ========================================================================================================================================================================
+# REGISTRO DE POOLS EVOLUTION PERSISTENTES (CHAVE: evo_db_host + evo_db_name)
+# ========================================================================================================================================================================
+_pools_evo = {}            # (evo_db_host, evo_db_name) -> PoolEvoMonitorado
+_pools_evo_lock = None
+
+
+class _ConexaoMonitorada:
+    """Context manager que mede o tempo de espera para obter conexão do pool."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = pool.db.connection()
+
+    async def __aenter__(self):
+        pool = self._pool
+        pool.em_uso += 1
+        t0 = time.monotonic()
+        try:
+            conn = await self._conn.__aenter__()
+        except BaseException:
+            pool.em_uso -= 1
+            pool.ultimo_uso = time.monotonic()
+            raise
+        espera = time.monotonic() - t0
+        pool.qtd_aquisicoes += 1
+        pool.espera_total += espera
+        pool.espera_max = max(pool.espera_max, espera)
+        return conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self._conn.__aexit__(exc_type, exc, tb)
+        finally:
+            self._pool.em_uso -= 1
+            self._pool.ultimo_uso = time.monotonic()
+
+
+class PoolEvoMonitorado:
+    """Pool Evolution de longa duração; expõe connection() como o Database e acumula stats de espera."""
+
+    def __init__(self, db, evo_db_host, evo_db_name, max_size):
+        self.db = db
+        self.evo_db_host = evo_db_host
+        self.evo_db_name = evo_db_name
+        self.max_size = max_size
+        self.em_uso = 0
+        self.ultimo_uso = time.monotonic()
+        self.qtd_aquisicoes = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+
+    def connection(self):
+        return _ConexaoMonitorada(self)
+
+    async def disconnect(self):
+        await self.db.disconnect()
+
+
+async def obtem_pool_evo(evo_db_host, evo_db_name, min_size=1, max_size=16):
+    """Retorna o pool já aberto para (host, db) ou abre um novo sob demanda."""
+    global _pools_evo_lock
+    if _pools_evo_lock is None:
+        _pools_evo_lock = asyncio.Lock()
+
+    chave = (evo_db_host, evo_db_name)
+    pool = _pools_evo.get(chave)
+    if pool is not None:
+        pool.ultimo_uso = time.monotonic()
+        return pool
+
+    async with _pools_evo_lock:
+        pool = _pools_evo.get(chave)
+        if pool is None:
+            db = await conecta_leaper_db_evo(evo_db_host, evo_db_name, min_size=min_size, max_size=max_size)
+            pool = PoolEvoMonitorado(db, evo_db_host, evo_db_name, max_size)
+            _pools_evo[chave] = pool
+        pool.ultimo_uso = time.monotonic()
+        return pool
+
+
+async def fecha_pools_evo_ociosos(idle_timeout=None):
+    """Fecha pools sem conexões em uso há mais de idle_timeout segundos. Retorna as chaves fechadas."""
+    idle_timeout = EVO_POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+    agora = time.monotonic()
+    fechados = []
+    for chave, pool in list(_pools_evo.items()):
+        if pool.em_uso == 0 and agora - pool.ultimo_uso > idle_timeout:
+            _pools_evo.pop(chave, None)
+            try:
+                await pool.disconnect()
+            except Exception as e:
+                # segue fechando os demais; o pool já saiu do registro e não é reaproveitado
+                logging.getLogger(__name__).warning(f"Erro ao fechar pool Evolution ocioso {chave}: {e}")
+            fechados.append(chave)
+    return fechados
+
+
+async def fecha_pools_evo():
+    """Fecha todos os pools Evolution (encerramento do serviço)."""
+    erros = []
+    for chave, pool in list(_pools_evo.items()):
+        _pools_evo.pop(chave, None)
+        try:
+            await pool.disconnect()
+        except Exception as e:
+            erros.append((chave, e))
+    return erros
+
+
+def estatisticas_pools_evo(reset=True):
+    """Stats de espera por pool desde a última leitura: aquisições, espera média/máx (ms) e conexões em uso."""
+    stats = []
+    for (evo_db_host, evo_db_name), pool in _pools_evo.items():
+        media = (pool.espera_total / pool.qtd_aquisicoes) if pool.qtd_aquisicoes else 0.0
+        stats.append({
+            "evo_db_host": evo_db_host,
+            "evo_db_name": evo_db_name,
+            "max_size": pool.max_size,
+            "em_uso": pool.em_uso,
+            "aquisicoes": pool.qtd_aquisicoes,
+            "espera_media_ms": round(media * 1000, 2),
+            "espera_max_ms": round(pool.espera_max * 1000, 2),
+        })
+        if reset:
+            pool.qtd_aquisicoes = 0
+            pool.espera_total = 0.0
+            pool.espera_max = 0.0
+    return stats
@@ -0,0 +1,142 @@
+# ========================================================================================================================================================================
+# ========================================================================================================================================================================
+# ESTADO DE ANÁLISE POR LEAD (lead_analysis_state)
+# 1 linha por lead com o resumo da execução mais recente em lead_status_transition, mantida a cada escrita
+# (status_analyzer ao gravar execuções, send_messages ao enviar, webhook ao receber resposta).
+# Substitui o DISTINCT ON sobre todo o histórico na consulta de elegibilidade do status_analyzer.
+# ========================================================================================================================================================================
+# ========================================================================================================================================================================
+import asyncio
+
+
+# ========================================================================================================================================================================
+# INTERVALO MÍNIMO ATÉ REPROCESSAR (MESMA REGRA DA CONSULTA DE ELEGIBILIDADE)
+# ========================================================================================================================================================================
+EXPR_INTERVALO_REPROCESSO = """
+    CASE
+        WHEN message_sent_date IS NOT NULL AND response_date IS NULL THEN INTERVAL '24 hours'
+        ELSE INTERVAL '9 hours'
+    END
+"""
+
+COLUNAS_ESTADO_LEADS = (
+    "lead_id", "company_id", "last_transition_id", "last_execution_date", "last_kw_execution_date",
+    "last_ai_fingerprint", "last_message_status", "message_sent_date", "response_date",
+    "min_reprocess_interval", "updated_at",
+)
+
+# projeção de uma linha de lead_status_transition nas colunas do estado (mesma ordem de COLUNAS_ESTADO_LEADS)
+SELECT_ESTADO_DE_TRANSICAO = f"""
+    lead_id,
+    company_id,
+    id AS last_transition_id,
+    execution_date AS last_execution_date,
+    execution_date_kw AS last_kw_execution_date,
+    metadata->>'ai_fingerprint' AS last_ai_fingerprint,
+    message_status AS last_message_status,
+    message_sent_date,
+    response_date,
+    {EXPR_INTERVALO_REPROCESSO} AS min_reprocess_interval,
+    now() AS updated_at
+"""
+
+
+# ========================================================================================================================================================================
+# CRIA A TABELA (COM BACKFILL DO HISTÓRICO) SE NÃO EXISTIR
+# ========================================================================================================================================================================
+DDL_ESTADO_LEADS = [
+    # CREATE TABLE AS herda os tipos das colunas de lead_status_transition e já popula com a última execução de cada lead
+    f"""
+    CREATE TABLE IF NOT EXISTS lead_analysis_state AS
+    SELECT DISTINCT ON (lead_id)
+        {SELECT_ESTADO_DE_TRANSICAO}
+    FROM lead_status_transition
+    ORDER BY lead_id, execution_date DESC
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_lead_analysis_state_lead ON lead_analysis_state (lead_id)",
+    "CREATE INDEX IF NOT EXISTS idx_lead_analysis_state_company ON lead_analysis_state (company_id, last_execution_date)",
+    "CREATE INDEX IF NOT EXISTS idx_lead_analysis_state_transition ON lead_analysis_state (last_transition_id)",
+]
+
+
+async def estado_leads_existe(db_core):
+    """
+    Tabela pronta para o upsert (índice único do ON CONFLICT criado) no banco, por esta ou por outra réplica.
+    """
+    async with db_core.connection() as conn:
+        row = await asyncio.wait_for(
+            conn.fetch_one(query="SELECT to_regclass('ux_lead_analysis_state_lead') IS NOT NULL AS existe"),
+            timeout=30
+        )
+    return bool(row and row["existe"])
+
+
+async def cria_estado_leads(db_core):
+    """
+    Réplicas subindo juntas disputam o CREATE TABLE AS / CREATE INDEX (violação única em pg_type/pg_class mesmo
+    com IF NOT EXISTS): se o comando falhar mas a tabela já estiver pronta, vale a que a outra réplica criou.
+    """
+    try:
+        async with db_core.connection() as conn:
+            for ddl in DDL_ESTADO_LEADS:
+                await asyncio.wait_for(conn.execute(query=ddl), timeout=1800)
+    except Exception:
+        if not await estado_leads_existe(db_core):
+            raise
+
+
+# ========================================================================================================================================================================
+# UPSERT A PARTIR DE LINHAS RECÉM INSERIDAS (CTE DO INSERT ... RETURNING)
+# ========================================================================================================================================================================
+def monta_upsert_estado_leads(nome_cte):
+    """
+    INSERT ... ON CONFLICT no estado a partir de uma CTE com as colunas de lead_status_transition
+    (usado como CTE adicional no mesmo comando do INSERT em lote). Só avança o estado, nunca retrocede.
+    """
+    atualizacoes = ",\n            ".join(f"{c} = EXCLUDED.{c}" for c in COLUNAS_ESTADO_LEADS if c != "lead_id")
+    return f"""
+        INSERT INTO lead_analysis_state ({", ".join(COLUNAS_ESTADO_LEADS)})
+        SELECT DISTINCT ON (lead_id)
+            {SELECT_ESTADO_DE_TRANSICAO}
+        FROM {nome_cte}
+        ORDER BY lead_id, execution_date DESC
+        ON CONFLICT (lead_id) DO UPDATE SET
+            {atualizacoes}
+        WHERE lead_analysis_state.last_execution_date IS NULL
+           OR EXCLUDED.last_execution_date >= lead_analysis_state.last_execution_date
+    """
+
+
+# ========================================================================================================================================================================
+# MENSAGEM ENVIADA (send_messages / webhook open_24h_window)
+# ========================================================================================================================================================================
+async def atualiza_estado_mensagem_enviada(conn, transition_id):
+    """Só altera o estado se a linha enviada for a execução mais recente do lead."""
+    await conn.execute(
+        query="""
+            UPDATE lead_analysis_state
+            SET message_sent_date      = NOW(),
+                last_message_status    = 'sent',
+                min_reprocess_interval = CASE WHEN response_date IS NULL THEN INTERVAL '24 hours' ELSE INTERVAL '9 hours' END,
+                updated_at             = NOW()
+            WHERE last_transition_id = :transition_id
+        """,
+        values={"transition_id": transition_id},
+    )
+
+
+# ========================================================================================================================================================================
+# RESPOSTA DO RESPONSÁVEL (webhook meta / zapi)
+# ========================================================================================================================================================================
+async def atualiza_estado_resposta(conn, transition_id, response_date, message_status=None):
+    await conn.execute(
+        query="""
+            UPDATE lead_analysis_state
+            SET response_date          = :response_date,
+                last_message_status    = COALESCE(:message_status, last_message_status),
+                min_reprocess_interval = INTERVAL '9 hours',
+                updated_at             = NOW()
+            WHERE last_transition_id = :transition_id
+        """,
+        values={"transition_id": transition_id, "response_date": response_date, "message_status": message_status},
+    )
@@ -5,6 +5,7 @@
 import json, asyncio
 from log_config import logger, log_metadata
 from envio_mensagens import envia_mensagem_com_botao_whatsapp
+from estado_leads import atualiza_estado_mensagem_enviada
 
 
 # ================================================================================================================================================================================
@@ -164,6 +165,12 @@ async def atualiza_mensagem_enviada(db_core, registro_id, company_id, lead_id):
                 timeout=30
             )
 
+            # estado por lead (elegibilidade do status_analyzer): mensagem enviada aguardando resposta
+            try:
+                await asyncio.wait_for(atualiza_estado_mensagem_enviada(conn, str(registro_id)), timeout=30)
+            except Exception as e:
+                logger.warning(f"Erro ao atualizar lead_analysis_state (registro {registro_id}): {e}")
+
         return True
 
     except Exception as e:
@@ -0,0 +1,184 @@
+# ============================================================================================================================================
+# CODIFICADOR DO HISTÓRICO DE CONVERSA ENVIADO À GEMINI (PERFIS SELECIONÁVEIS) + ECONOMIA DE TOKENS POR PERFIL
+# ============================================================================================================================================
+# Perfis:
+#   classico : 1 bloco por mensagem "EMPRESA (dd/mm/yyyy hh:mm:ss):\n texto\n" (formato original)
+#   compacto : "[dd/mm/yyyy]" só quando o dia muda, "EMPRESA hh:mm: texto", mensagens seguidas do mesmo remetente
+#              agrupadas sob 1 cabeçalho (1 por linha) e repetições idênticas consecutivas no mesmo dia removidas
+#   enxuto   : compacto + sequências de emojis reduzidas ao 1º, espaços colapsados e mensagens longas já
+#              enviadas antes pelo mesmo remetente (textos prontos/bot) removidas
+# Cada item retornado começa com "EMPRESA", "LEAD" ou "[" (cabeçalho de dia), que é o que limitar_mensagens aceita.
+# ============================================================================================================================================
+import os, re
+
+
+CODIFICADOR_JANELA_MESCLA_MIN = float(os.getenv("CODIFICADOR_JANELA_MESCLA_MIN", "30"))   # intervalo máx. para agrupar mensagens do mesmo remetente
+CODIFICADOR_MIN_CARACTERES_REPETIDA = int(os.getenv("CODIFICADOR_MIN_CARACTERES_REPETIDA", "40"))   # perfil enxuto: abaixo disso repetições ("ok", "sim") são mantidas
+
+PERFIS_CODIFICADOR = {
+    "classico": {"compacto": False, "repetidas": None,           "emojis": False},
+    "compacto": {"compacto": True,  "repetidas": "consecutivas", "emojis": False},
+    "enxuto":   {"compacto": True,  "repetidas": "todas",        "emojis": True},
+}
+
+_EMOJI = "[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF]"
+_MODIFICADORES_EMOJI = "[\uFE0F\u200D\U0001F3FB-\U0001F3FF]*"
+_RE_SEQUENCIA_EMOJIS = re.compile(f"({_EMOJI}{_MODIFICADORES_EMOJI})(?:\\s*{_EMOJI}{_MODIFICADORES_EMOJI})+")
+_RE_ESPACOS = re.compile(r"[ \t]+")
+_RE_QUEBRAS = re.compile(r"\n\s*\n+")
+
+
+def formata_mensagem_historico(mensagem):
+    return f"{mensagem.de.upper()} ({mensagem.data_hora.strftime('%d/%m/%Y %H:%M:%S')}):\n {mensagem.mensagem}\n"
+
+
+def caracteres_formato_classico(mensagens):
+    """Tamanho que o histórico teria no perfil classico (linhas + separadores), sem montar o texto."""
+    return sum(len(formata_mensagem_historico(m)) for m in mensagens) + max(len(mensagens) - 1, 0)
+
+
+def _limpa_texto(texto, reduz_emojis):
+    texto = (texto or "").strip()
+    if reduz_emojis:
+        texto = _RE_SEQUENCIA_EMOJIS.sub(r"\1", texto)
+        texto = _RE_QUEBRAS.sub("\n", _RE_ESPACOS.sub(" ", texto))
+    return texto
+
+
+def codifica_conversa(mensagens, perfil="classico"):
+    """Lista de blocos de texto (ordem cronológica) no formato do perfil."""
+    opcoes = PERFIS_CODIFICADOR.get(perfil) or PERFIS_CODIFICADOR["classico"]
+    if not opcoes["compacto"]:
+        return [formata_mensagem_historico(m) for m in mensagens]
+
+    blocos = []
+    dia_atual = None
+    bloco_de, bloco_ultima_data, bloco_linhas = None, None, []
+    ultima_por_remetente = {}         # de -> último texto (repetidas consecutivas)
+    ja_enviadas = set()               # (de, texto) longos já incluídos (perfil enxuto)
+
+    def fecha_bloco():
+        if bloco_linhas:
+            blocos.append("\n".join(bloco_linhas))
+
+    for mensagem in mensagens:
+        texto = _limpa_texto(mensagem.mensagem, opcoes["emojis"])
+        if not texto:
+            continue
+        de = mensagem.de.upper()
+
+        # repetição consecutiva só no mesmo dia: follow-up reenviado em outro dia é evidência para a classificação
+        if opcoes["repetidas"] and ultima_por_remetente.get(de) == texto and bloco_de == de and mensagem.data_hora.date() == dia_atual:
+            continue
+        if opcoes["repetidas"] == "todas" and len(texto) >= CODIFICADOR_MIN_CARACTERES_REPETIDA:
+            if (de, texto) in ja_enviadas:
+                continue
+            ja_enviadas.add((de, texto))
+        ultima_por_remetente[de] = texto
+
+        data_hora = mensagem.data_hora
+        dia = data_hora.date()
+        if dia != dia_atual:
+            fecha_bloco()
+            bloco_de, bloco_linhas = None, []
+            blocos.append(f"[{data_hora.strftime('%d/%m/%Y')}]")
+            dia_atual = dia
+
+        mesmo_bloco = (
+            bloco_de == de
+            and (data_hora - bloco_ultima_data).total_seconds() <= CODIFICADOR_JANELA_MESCLA_MIN * 60
+        )
+        if mesmo_bloco:
+            bloco_linhas.append(texto)
+        else:
+            fecha_bloco()
+            bloco_de, bloco_linhas = de, [f"{de} {data_hora.strftime('%H:%M')}: {texto}"]
+        bloco_ultima_data = data_hora
+
+    fecha_bloco()
+    return blocos
+
+
+# ============================================================================================================================================
+# ORÇAMENTO NO PERFIL PARA A BUSCA EM STREAMING (MAIS NOVA -> MAIS ANTIGA)
+# ============================================================================================================================================
+class OrcamentoCodificado:
+    """
+    Caracteres que as mensagens vistas até agora ocupam no perfil, somadas da mais nova para a mais antiga.
+    Nos perfis compactos é um limite inferior do texto de codifica_conversa (cada mensagem conta só o texto,
+    como se entrasse agrupada; repetidas contam uma vez; cabeçalho de dia a cada troca): quem busca por ele nunca
+    traz menos do que limitar_mensagens manteria.
+    """
+
+    CARACTERES_CABECALHO_DIA = len("[dd/mm/yyyy]") + 1
+
+    def __init__(self, perfil="classico"):
+        self._opcoes = PERFIS_CODIFICADOR.get(perfil) or PERFIS_CODIFICADOR["classico"]
+        self._dia = None
+        self._posterior = None          # (de, texto, dia) da mensagem mais nova já contada
+        self._vistas = set()
+        self.caracteres = 0
+
+    def adiciona(self, mensagem):
+        opcoes = self._opcoes
+        if not opcoes["compacto"]:
+            self.caracteres += len(formata_mensagem_historico(mensagem)) + 1
+            return self.caracteres
+
+        texto = _limpa_texto(mensagem.mensagem, opcoes["emojis"])
+        if not texto:
+            return self.caracteres
+        de = mensagem.de.upper()
+        dia = mensagem.data_hora.date()
+
+        if opcoes["repetidas"] and self._posterior == (de, texto, dia):
+            return self.caracteres
+        self._posterior = (de, texto, dia)
+        if opcoes["repetidas"] == "todas" and len(texto) >= CODIFICADOR_MIN_CARACTERES_REPETIDA:
+            if (de, texto) in self._vistas:
+                return self.caracteres
+            self._vistas.add((de, texto))
+
+        if dia != self._dia:
+            self.caracteres += self.CARACTERES_CABECALHO_DIA
+            self._dia = dia
+        self.caracteres += len(texto) + 1
+        return self.caracteres
+
+
+# ============================================================================================================================================
+# ECONOMIA DE TOKENS POR PERFIL (MEDIDA CONTRA O usageMetadata DE CADA CHAMADA)
+# ============================================================================================================================================
+class EconomiaCodificador:
+    """
+    Para cada chamada: caracteres enviados (prompt + input no perfil usado), caracteres que o mesmo conteúdo teria
+    no perfil classico e promptTokenCount real. Os tokens do classico são estimados com a razão tokens/caractere
+    observada na própria chamada.
+    """
+
+    def __init__(self):
+        self._por_perfil = {}
+
+    def registra(self, perfil, caracteres_enviados, caracteres_classico, prompt_tokens):
+        if not caracteres_enviados or not prompt_tokens:
+            return
+        acumulado = self._por_perfil.setdefault(perfil, {"chamadas": 0, "prompt_tokens": 0, "prompt_tokens_classico": 0.0})
+        acumulado["chamadas"] += 1
+        acumulado["prompt_tokens"] += prompt_tokens
+        acumulado["prompt_tokens_classico"] += prompt_tokens * (caracteres_classico or caracteres_enviados) / caracteres_enviados
+
+    def estatisticas(self, reset=True):
+        resumo = {}
+        for perfil, acumulado in self._por_perfil.items():
+            classico = acumulado["prompt_tokens_classico"]
+            economizados = classico - acumulado["prompt_tokens"]
+            resumo[perfil] = {
+                "chamadas": acumulado["chamadas"],
+                "prompt_tokens": acumulado["prompt_tokens"],
+                "prompt_tokens_classico_estimados": int(classico),
+                "tokens_economizados": int(economizados),
+                "economia_pct": round(economizados / classico * 100, 1) if classico else 0.0,
+            }
+        if reset:
+            self._por_perfil = {}
+        return resumo
@@ -0,0 +1,312 @@
+# ============================================================================================================================================
+# CONTROLE DE CARGA DO CLIENTE GEMINI - CONCORRÊNCIA ADAPTATIVA (AIMD), ORÇAMENTO DE TOKENS E CIRCUIT BREAKER
+# ============================================================================================================================================
+import asyncio, time
+from datetime import datetime
+from contextlib import asynccontextmanager
+from collections import deque
+from log_config import logger
+
+
+# ================================================================================================================================================================================
+# CONCORRÊNCIA ADAPTATIVA (AIMD): +1 SLOT POR "JANELA" SAUDÁVEL, CORTE MULTIPLICATIVO EM 429/503
+# ================================================================================================================================================================================
+class ControleConcorrenciaAIMD:
+    """
+    Limite de chamadas simultâneas à Gemini que se ajusta sozinho:
+      - aumento aditivo: cada resposta OK abaixo da latência alvo de uma chamada que ocupou o último slot livre soma
+        1/limite (≈ +1 slot a cada `limite` respostas com o limite saturado; sem demanda o limite não sobe);
+      - redução multiplicativa: 429/503 (ou timeout) multiplica o limite por `fator_reducao`, no máximo 1x por `intervalo_reducao`
+        segundos, para que uma rajada de erros simultâneos não derrube o limite até o piso de uma vez.
+    """
+
+    def __init__(self, limite_inicial, piso, teto, latencia_alvo, fator_reducao=0.5, intervalo_reducao=5.0):
+        self.piso = max(1, int(piso))
+        self.teto = max(self.piso, int(teto))
+        self.latencia_alvo = latencia_alvo
+        self.fator_reducao = fator_reducao
+        self.intervalo_reducao = intervalo_reducao
+        self._limite = float(min(max(limite_inicial, self.piso), self.teto))
+        self._em_voo = 0
+        self._ultima_reducao = 0.0
+        self._cond = None
+        self._stats = {"chamadas": 0, "sobrecargas": 0, "aumentos": 0, "reducoes": 0, "espera_total": 0.0}
+
+    @property
+    def limite(self):
+        return int(self._limite)
+
+    def _condicao(self):
+        # criada sob demanda para ficar no event loop em uso (uvloop)
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @asynccontextmanager
+    async def slot(self):
+        """Ocupa 1 slot; o chamador informa o desfecho via registra(sobrecarga=...) no objeto devolvido."""
+        cond = self._condicao()
+        t0 = time.monotonic()
+        async with cond:
+            await cond.wait_for(lambda: self._em_voo < self.limite)
+            self._em_voo += 1
+            saturado = self._em_voo >= self.limite
+        self._stats["espera_total"] += time.monotonic() - t0
+
+        desfecho = _DesfechoChamada()
+        inicio = time.monotonic()
+        try:
+            yield desfecho
+        except asyncio.TimeoutError:
+            desfecho.registra(sobrecarga=True)
+            raise
+        finally:
+            self._ajusta(time.monotonic() - inicio, desfecho, saturado)
+            async with cond:
+                self._em_voo -= 1
+                cond.notify_all()
+
+    def _ajusta(self, latencia, desfecho, saturado):
+        self._stats["chamadas"] += 1
+        if desfecho.sobrecarga:
+            self._stats["sobrecargas"] += 1
+            agora = time.monotonic()
+            if agora - self._ultima_reducao >= self.intervalo_reducao:
+                self._ultima_reducao = agora
+                novo = max(self.piso, self._limite * self.fator_reducao)
+                if novo < self._limite:
+                    self._stats["reducoes"] += 1
+                self._limite = novo
+        elif desfecho.sucesso and saturado and latencia <= self.latencia_alvo:
+            antes = self.limite
+            self._limite = min(self.teto, self._limite + 1.0 / self._limite)
+            if self.limite > antes:
+                self._stats["aumentos"] += 1
+
+    def estatisticas(self, reset=True):
+        stats = {
+            "limite": self.limite,
+            "em_voo": self._em_voo,
+            "piso": self.piso,
+            "teto": self.teto,
+            **self._stats,
+            "espera_total": round(self._stats["espera_total"], 3),
+        }
+        if reset:
+            self._stats.update({"chamadas": 0, "sobrecargas": 0, "aumentos": 0, "reducoes": 0, "espera_total": 0.0})
+        return stats
+
+
+class _DesfechoChamada:
+    __slots__ = ("sucesso", "sobrecarga")
+
+    def __init__(self):
+        self.sucesso = False
+        self.sobrecarga = False
+
+    def registra(self, sucesso=False, sobrecarga=False):
+        self.sucesso = sucesso
+        self.sobrecarga = sobrecarga
+
+
+# ================================================================================================================================================================================
+# ORÇAMENTO DE TOKENS: TOKEN BUCKET (TPM) GLOBAL E POR COMPANY + COTA DIÁRIA POR COMPANY
+# ================================================================================================================================================================================
+class _BaldeTokens:
+    """Balde de tokens reabastecido continuamente (tpm/60 por segundo). Pode ficar negativo após reconciliação."""
+
+    __slots__ = ("capacidade", "por_segundo", "nivel", "_atualizado_em", "_fila")
+
+    def __init__(self, tpm):
+        self.capacidade = float(tpm)
+        self.por_segundo = tpm / 60.0
+        self.nivel = float(tpm)
+        self._atualizado_em = time.monotonic()
+        self._fila = None
+
+    def _reabastece(self):
+        agora = time.monotonic()
+        self.nivel = min(self.capacidade, self.nivel + (agora - self._atualizado_em) * self.por_segundo)
+        self._atualizado_em = agora
+
+    async def consome(self, tokens):
+        """Espera (em ordem de chegada) até haver saldo e debita. Pedidos maiores que a capacidade esperam o balde cheio."""
+        if self._fila is None:
+            self._fila = asyncio.Lock()
+        necessario = min(tokens, self.capacidade)
+        async with self._fila:
+            self._reabastece()
+            while self.nivel < necessario:
+                await asyncio.sleep((necessario - self.nivel) / self.por_segundo)
+                self._reabastece()
+            self.nivel -= tokens
+
+    def ajusta(self, delta):
+        self._reabastece()
+        self.nivel -= delta
+
+
+class ReservaTokens:
+    __slots__ = ("company_id", "estimados", "com_tpm")
+
+    def __init__(self, company_id, estimados, com_tpm):
+        self.company_id = company_id
+        self.estimados = estimados
+        self.com_tpm = com_tpm
+
+
+class LimitadorTokens:
+    """
+    Debita a estimativa de tokens antes de cada chamada (balde global + balde da company) e reconcilia com o
+    usageMetadata real depois. A cota diária por company conta só tokens reais (estimativas enquanto em voo).
+    tpm/tpm_por_company/cota_diaria <= 0 desligam o respectivo limite.
+    """
+
+    def __init__(self, tpm_global, tpm_por_company, cota_diaria_padrao, cotas_diarias_por_company=None):
+        self._global = _BaldeTokens(tpm_global) if tpm_global > 0 else None
+        self.tpm_por_company = tpm_por_company
+        self.cota_diaria_padrao = cota_diaria_padrao
+        self.cotas_diarias_por_company = {str(k): int(v) for k, v in (cotas_diarias_por_company or {}).items()}
+        self._baldes_company = {}
+        self._dia = None
+        self._usados_no_dia = {}      # company_id -> tokens (reais + estimados em voo)
+
+    def cota_diaria(self, company_id):
+        return self.cotas_diarias_por_company.get(str(company_id), self.cota_diaria_padrao)
+
+    def _vira_dia(self):
+        hoje = datetime.now().date()
+        if self._dia != hoje:
+            self._dia = hoje
+            self._usados_no_dia = {}
+
+    def saldo_diario(self, company_id):
+        """Tokens restantes hoje para a company (None = sem cota)."""
+        self._vira_dia()
+        cota = self.cota_diaria(company_id)
+        if cota <= 0:
+            return None
+        return cota - self._usados_no_dia.get(str(company_id), 0)
+
+    async def reserva(self, company_id, tokens_estimados, com_tpm=True):
+        """Retorna a ReservaTokens, ou None se a cota diária da company estiver esgotada."""
+        saldo = self.saldo_diario(company_id)
+        if saldo is not None and saldo < tokens_estimados:
+            return None
+
+        chave = str(company_id)
+        self._usados_no_dia[chave] = self._usados_no_dia.get(chave, 0) + tokens_estimados
+
+        if com_tpm:
+            if self.tpm_por_company > 0:
+                balde = self._baldes_company.get(chave)
+                if balde is None:
+                    balde = self._baldes_company[chave] = _BaldeTokens(self.tpm_por_company)
+                await balde.consome(tokens_estimados)
+            if self._global is not None:
+                await self._global.consome(tokens_estimados)
+
+        return ReservaTokens(chave, tokens_estimados, com_tpm)
+
+    def reconcilia(self, reserva, tokens_reais):
+        """Troca a estimativa pelo consumo real (0 quando a chamada falhou sem consumir)."""
+        if reserva is None:
+            return
+        delta = tokens_reais - reserva.estimados
+        self._vira_dia()
+        self._usados_no_dia[reserva.company_id] = max(0, self._usados_no_dia.get(reserva.company_id, 0) + delta)
+        if reserva.com_tpm:
+            if self._global is not None:
+                self._global.ajusta(delta)
+            balde = self._baldes_company.get(reserva.company_id)
+            if balde is not None:
+                balde.ajusta(delta)
+
+    def estatisticas(self):
+        self._vira_dia()
+        if self._global is not None:
+            self._global._reabastece()
+        return {
+            "tpm_saldo_global": int(self._global.nivel) if self._global is not None else None,
+            "tokens_hoje_por_company": dict(self._usados_no_dia),
+            "saldo_diario_por_company": {
+                company_id: self.saldo_diario(company_id)
+                for company_id in self._usados_no_dia
+                if self.cota_diaria(company_id) > 0
+            },
+        }
+
+
+# ================================================================================================================================================================================
+# CIRCUIT BREAKER POR MODELO (FECHADO -> ABERTO -> MEIO_ABERTO -> FECHADO)
+# ================================================================================================================================================================================
+class CircuitBreaker:
+    """
+    Abre quando, nas últimas `janela` chamadas (mínimo `min_amostras`), a fração de falhas chega a `taxa_falhas`
+    (chamadas acima de `latencia_max` segundos contam como falha). Aberto, recusa chamadas por `tempo_aberto`
+    segundos; depois libera até `sondas` chamadas de teste (meio aberto): todas OK fecham, qualquer falha reabre.
+    """
+
+    FECHADO, ABERTO, MEIO_ABERTO = "fechado", "aberto", "meio_aberto"
+
+    def __init__(self, nome, taxa_falhas, latencia_max, tempo_aberto, janela=20, min_amostras=5, sondas=2):
+        self.nome = nome
+        self.taxa_falhas = taxa_falhas
+        self.latencia_max = latencia_max
+        self.tempo_aberto = tempo_aberto
+        self.min_amostras = min_amostras
+        self.sondas = sondas
+        self.estado = self.FECHADO
+        self._resultados = deque(maxlen=janela)
+        self._aberto_em = 0.0
+        self._sondas_em_voo = 0
+        self._sondas_ok = 0
+
+    def _muda_estado(self, novo, motivo):
+        logger.warning(f"Circuit breaker Gemini [{self.nome}]: {self.estado} -> {novo} ({motivo})")
+        self.estado = novo
+        if novo == self.ABERTO:
+            self._aberto_em = time.monotonic()
+        elif novo == self.FECHADO:
+            self._resultados.clear()
+        self._sondas_em_voo = 0
+        self._sondas_ok = 0
+
+    def permite(self):
+        """True se a chamada pode seguir (no meio aberto, ocupa 1 das sondas)."""
+        if self.estado == self.ABERTO:
+            if time.monotonic() - self._aberto_em < self.tempo_aberto:
+                return False
+            self._muda_estado(self.MEIO_ABERTO, f"{self.tempo_aberto:.0f}s aberto, liberando {self.sondas} sondas")
+        if self.estado == self.MEIO_ABERTO:
+            if self._sondas_em_voo + self._sondas_ok >= self.sondas:
+                return False
+            self._sondas_em_voo += 1
+        return True
+
+    def registra(self, sucesso, latencia=0.0):
+        """sucesso=None: desfecho que não diz nada sobre a saúde da API (ex.: 400), só libera a sonda."""
+        falha = sucesso is False or (sucesso and latencia > self.latencia_max)
+
+        if self.estado == self.MEIO_ABERTO:
+            self._sondas_em_voo = max(0, self._sondas_em_voo - 1)
+            if sucesso is None:
+                return
+            if falha:
+                self._muda_estado(self.ABERTO, "falha na sonda")
+                return
+            self._sondas_ok += 1
+            if self._sondas_ok >= self.sondas:
+                self._muda_estado(self.FECHADO, f"{self._sondas_ok} sondas OK")
+            return
+
+        if sucesso is None or self.estado != self.FECHADO:
+            return
+        self._resultados.append(falha)
+        if len(self._resultados) >= self.min_amostras:
+            taxa = sum(self._resultados) / len(self._resultados)
+            if taxa >= self.taxa_falhas:
+                self._muda_estado(self.ABERTO, f"{taxa:.0%} de falhas/lentidão nas últimas {len(self._resultados)} chamadas")
+
+    def estatisticas(self):
+        return {"modelo": self.nome, "estado": self.estado, "falhas_janela": sum(self._resultados), "amostras_janela": len(self._resultados)}
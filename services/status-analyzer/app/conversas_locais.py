@@ -0,0 +1,193 @@
+# ============================================================================================================================================
+# STORE LOCAL DE CONVERSAS (SQLITE) - GUARDA MENSAGENS JÁ BAIXADAS DA EVOLUTION + WATERMARK POR LEAD
+# ============================================================================================================================================
+import sqlite3, threading, time
+from pathlib import Path
+from datetime import datetime
+from mensagem_lead import MensagemLead
+
+
+_conn = None
+_lock = threading.Lock()
+
+
+# ================================================================================================================================================================================
+# ABRE / FECHA STORE
+# ================================================================================================================================================================================
+def abre_conversas_locais(caminho_db):
+    """Abre (ou cria) o arquivo SQLite do store. Chamado 1x no início do serviço."""
+    global _conn
+    if _conn is not None:
+        return _conn
+
+    Path(caminho_db).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(caminho_db), check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS conversa_lead (
+            lead_id                  TEXT PRIMARY KEY,
+            company_id               TEXT,
+            dt_abertura_epoch        REAL,
+            ai_analysis_period       INTEGER,
+            ultimo_message_timestamp INTEGER,
+            atualizado_em            REAL
+        );
+        CREATE TABLE IF NOT EXISTS mensagem_lead (
+            lead_id           TEXT NOT NULL,
+            message_id        TEXT NOT NULL,
+            message_timestamp INTEGER NOT NULL,
+            de                TEXT,
+            data_hora         TEXT,
+            mensagem          TEXT,
+            jid_encontrado    TEXT,
+            PRIMARY KEY (lead_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_mensagem_lead_ts ON mensagem_lead (lead_id, message_timestamp);
+    """)
+    _conn = conn
+    return _conn
+
+
+def fecha_conversas_locais():
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+def conversas_locais_ativas():
+    return _conn is not None
+
+
+# ================================================================================================================================================================================
+# WATERMARKS
+# ================================================================================================================================================================================
+def carrega_watermarks(lead_ids):
+    """Retorna {lead_id: ultimo_message_timestamp} dos leads que já têm conversa no store."""
+    lead_ids = [str(lead_id) for lead_id in lead_ids]
+    if not lead_ids:
+        return {}
+    placeholders = ",".join("?" * len(lead_ids))
+    with _lock:
+        rows = _conn.execute(
+            f"SELECT lead_id, ultimo_message_timestamp FROM conversa_lead WHERE lead_id IN ({placeholders})",
+            lead_ids,
+        ).fetchall()
+    return {lead_id: ts for lead_id, ts in rows if ts is not None}
+
+
+# ================================================================================================================================================================================
+# GRAVA MENSAGENS NOVAS E DEVOLVE A CONVERSA COMPLETA
+# ================================================================================================================================================================================
+def mescla_e_carrega(lead_info, mensagens_novas):
+    """
+    Grava as mensagens novas do lead (ignorando as que já existem pelo message_id),
+    avança o watermark e retorna a conversa completa em ordem cronológica.
+    """
+    lead_id = str(lead_info.get("lead_id"))
+    agora = time.time()
+
+    with _lock:
+        cur = _conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            cur.executemany(
+                """
+                INSERT OR IGNORE INTO mensagem_lead
+                    (lead_id, message_id, message_timestamp, de, data_hora, mensagem, jid_encontrado)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        lead_id,
+                        m.message_id,
+                        int(m.message_timestamp),
+                        m.de,
+                        m.data_hora.isoformat() if m.data_hora else None,
+                        m.mensagem,
+                        m.jid_encontrado,
+                    )
+                    for m in mensagens_novas
+                ],
+            )
+            cur.execute(
+                """
+                INSERT INTO conversa_lead
+                    (lead_id, company_id, dt_abertura_epoch, ai_analysis_period, ultimo_message_timestamp, atualizado_em)
+                VALUES (?, ?, ?, ?, (SELECT MAX(message_timestamp) FROM mensagem_lead WHERE lead_id = ?), ?)
+                ON CONFLICT (lead_id) DO UPDATE SET
+                    company_id               = excluded.company_id,
+                    dt_abertura_epoch        = excluded.dt_abertura_epoch,
+                    ai_analysis_period       = excluded.ai_analysis_period,
+                    ultimo_message_timestamp = excluded.ultimo_message_timestamp,
+                    atualizado_em            = excluded.atualizado_em
+                """,
+                (
+                    lead_id,
+                    str(lead_info.get("company_id")),
+                    lead_info.get("dt_abertura_epoch"),
+                    lead_info.get("ai_analysis_period"),
+                    lead_id,
+                    agora,
+                ),
+            )
+            rows = cur.execute(
+                """
+                SELECT message_id, message_timestamp, de, data_hora, mensagem, jid_encontrado
+                FROM mensagem_lead
+                WHERE lead_id = ?
+                ORDER BY message_timestamp ASC, rowid ASC
+                """,
+                (lead_id,),
+            ).fetchall()
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    return [
+        MensagemLead(
+            de,
+            datetime.fromisoformat(data_hora) if data_hora else None,
+            mensagem,
+            jid_encontrado,
+            message_id,
+            message_timestamp,
+        )
+        for message_id, message_timestamp, de, data_hora, mensagem, jid_encontrado in rows
+    ]
+
+
+# ================================================================================================================================================================================
+# EVICÇÃO
+# ================================================================================================================================================================================
+def remove_leads(lead_ids):
+    """Remove do store leads finalizados (END_WON / END_LOST)."""
+    lead_ids = [str(lead_id) for lead_id in lead_ids]
+    if not lead_ids:
+        return 0
+    placeholders = ",".join("?" * len(lead_ids))
+    with _lock:
+        _conn.execute(f"DELETE FROM mensagem_lead WHERE lead_id IN ({placeholders})", lead_ids)
+        return _conn.execute(f"DELETE FROM conversa_lead WHERE lead_id IN ({placeholders})", lead_ids).rowcount
+
+
+def remove_expirados(dias_sem_atualizacao):
+    """
+    Remove leads fora do ai_analysis_period (contado da abertura do lead) e leads que saíram da
+    elegibilidade (não atualizados há mais de dias_sem_atualizacao, ex.: finalizados via webhook/app).
+    """
+    agora = time.time()
+    with _lock:
+        rows = _conn.execute(
+            """
+            SELECT lead_id
+            FROM conversa_lead
+            WHERE dt_abertura_epoch + COALESCE(ai_analysis_period, 30) * 86400 < ?
+               OR atualizado_em < ?
+            """,
+            (agora, agora - dias_sem_atualizacao * 86400),
+        ).fetchall()
+    return remove_leads([lead_id for (lead_id,) in rows])
@@ -0,0 +1,109 @@
+# ============================================================================================================================================
+# ESCALONADOR DE LEADS ENTRE COMPANIES - DEFICIT ROUND ROBIN (DRR) ALIMENTANDO 1 POOL DE WORKERS
+# ============================================================================================================================================
+import asyncio
+from collections import deque
+
+
+class EscalonadorDRR:
+    """
+    Fila justa entre companies: cada company tem sua fila de tarefas e, a cada volta do round robin, ganha
+    `peso` de crédito (deficit); uma tarefa custa 1. Company com 3 leads termina em poucas voltas, company com
+    100 continua usando a capacidade que sobrar. Tarefas são funções async sem argumentos.
+    """
+
+    def __init__(self):
+        self._filas = {}           # company_id -> deque[(tarefa, future)]
+        self._pesos = {}
+        self._deficit = {}
+        self._ativos = deque()     # companies com tarefas pendentes, na ordem do round robin
+        self._creditado = False    # company da vez já recebeu o crédito desta volta
+        self._cond = None
+        self._fechado = False
+
+    def _condicao(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def enfileira(self, company_id, tarefas, peso=1.0):
+        """Enfileira as tarefas da company e retorna os futures dos resultados (mesma ordem)."""
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in tarefas]
+        if not tarefas:
+            return futures
+
+        cond = self._condicao()
+        async with cond:
+            fila = self._filas.get(company_id)
+            if fila is None:
+                fila = self._filas[company_id] = deque()
+            if not fila:
+                self._ativos.append(company_id)
+                self._deficit[company_id] = 0.0
+            self._pesos[company_id] = max(float(peso), 0.01)
+            fila.extend(zip(tarefas, futures))
+            cond.notify(len(tarefas))
+        return futures
+
+    def _proxima(self):
+        while self._ativos:
+            company_id = self._ativos[0]
+            if not self._creditado:
+                self._deficit[company_id] += self._pesos[company_id]
+                self._creditado = True
+
+            fila = self._filas[company_id]
+            if self._deficit[company_id] >= 1.0:
+                self._deficit[company_id] -= 1.0
+                item = fila.popleft()
+                if not fila:
+                    self._ativos.popleft()
+                    self._deficit[company_id] = 0.0
+                    self._creditado = False
+                return item
+
+            self._ativos.rotate(-1)
+            self._creditado = False
+        return None
+
+    async def proxima(self):
+        """Próxima (tarefa, future) pela ordem DRR; None quando fechado e vazio."""
+        cond = self._condicao()
+        async with cond:
+            while True:
+                item = self._proxima()
+                if item is not None or self._fechado:
+                    return item
+                await cond.wait()
+
+    async def fecha(self):
+        cond = self._condicao()
+        async with cond:
+            self._fechado = True
+            cond.notify_all()
+
+    def pendentes(self):
+        return {company_id: len(fila) for company_id, fila in self._filas.items() if fila}
+
+
+async def worker_escalonador(escalonador):
+    """Consome tarefas do escalonador até ele ser fechado; erro numa tarefa vai para o future dela."""
+    while True:
+        item = await escalonador.proxima()
+        if item is None:
+            return
+        tarefa, future = item
+        try:
+            resultado = await tarefa()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        except BaseException:
+            # CancelledError etc. encerram o worker, mas quem aguarda o future não pode ficar pendurado
+            if not future.done():
+                future.cancel()
+            raise
+        else:
+            if not future.done():
+                future.set_result(resultado)
@@ -0,0 +1,203 @@
+# ============================================================================================================================================
+# EXECUÇÃO EM LOTE NA GEMINI (BATCH API) - AGRUPA PROMPTS DE VÁRIOS LEADS NUM JOB, FAZ POLLING E DEVOLVE CADA RESPOSTA AO SEU LEAD
+# ============================================================================================================================================
+import asyncio, aiohttp, time
+from datetime import datetime
+from log_config import logger
+
+
+ESTADOS_FINAIS_BATCH = {
+    "BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED",
+    "JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED",
+}
+
+_config = {
+    "url_base": "https://generativelanguage.googleapis.com/v1beta",
+    "modelo": "",
+    "api_key": "",
+    "max_requests": 500,
+    "max_espera": 30.0,
+    "intervalo_poll": 30.0,
+    "timeout": 6 * 3600.0,
+}
+_pendentes = []            # [(payload, future)]
+_timer = None
+_jobs_em_andamento = set()
+
+
+# ================================================================================================================================================================================
+# CONFIGURAÇÃO
+# ================================================================================================================================================================================
+def configura_gemini_batch(url_base, modelo, api_key, max_requests, max_espera, intervalo_poll, timeout):
+    _config.update({
+        "url_base": url_base.rstrip("/"),
+        "modelo": modelo,
+        "api_key": api_key,
+        "max_requests": max_requests,
+        "max_espera": max_espera,
+        "intervalo_poll": intervalo_poll,
+        "timeout": timeout,
+    })
+
+
+# ================================================================================================================================================================================
+# ENFILEIRA 1 REQUEST (GenerateContentRequest) E AGUARDA A RESPOSTA DO JOB
+# ================================================================================================================================================================================
+async def classifica_em_lote(session, payload, prazo=None):
+    """
+    Retorna o GenerateContentResponse (dict) do lead, ou None se o job falhar/expirar ou se o prazo (datetime)
+    passar antes: a espera é abandonada (lead volta no próximo ciclo) e o job para de ser consultado quando
+    nenhum lead dele ainda aguarda.
+    """
+    global _timer
+
+    espera_max = None
+    if prazo is not None:
+        espera_max = (prazo - datetime.now()).total_seconds()
+        if espera_max <= 0:
+            return None
+
+    future = asyncio.get_running_loop().create_future()
+    _pendentes.append((payload, future))
+
+    if len(_pendentes) >= _config["max_requests"]:
+        _dispara_job(session)
+    elif _timer is None:
+        _timer = asyncio.create_task(_dispara_apos_espera(session))
+
+    if espera_max is None:
+        return await future
+    try:
+        return await asyncio.wait_for(future, timeout=espera_max)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def aguarda_jobs_gemini_batch():
+    """Espera a fila esvaziar e todos os jobs em andamento terminarem (encerramento do serviço)."""
+    while _pendentes or _jobs_em_andamento or _timer is not None:
+        await asyncio.sleep(1)
+
+
+def _dispara_job(session):
+    lote = _pendentes[:_config["max_requests"]]
+    del _pendentes[:len(lote)]
+    lote = [(payload, future) for payload, future in lote if not future.done()]   # espera já abandonada pelo prazo
+    if lote:
+        task = asyncio.create_task(_executa_job(session, lote))
+        _jobs_em_andamento.add(task)
+        task.add_done_callback(_jobs_em_andamento.discard)
+
+
+async def _dispara_apos_espera(session):
+    global _timer
+    try:
+        await asyncio.sleep(_config["max_espera"])
+        while _pendentes:
+            _dispara_job(session)
+    finally:
+        _timer = None
+
+
+def _resolve(futures, resultado):
+    for future in futures:
+        if not future.done():
+            future.set_result(resultado)
+
+
+# ================================================================================================================================================================================
+# CRIA JOB, FAZ POLLING E DISTRIBUI AS RESPOSTAS
+# ================================================================================================================================================================================
+async def _executa_job(session, lote):
+    futures = [future for _, future in lote]
+    url_base, modelo, api_key = _config["url_base"], _config["modelo"], _config["api_key"]
+
+    body = {
+        "batch": {
+            "display_name": f"status-analyzer-{datetime.now().strftime('%Y%m%d%H%M%S')}",
+            "input_config": {
+                "requests": {
+                    "requests": [
+                        {"request": payload, "metadata": {"key": str(indice)}}
+                        for indice, (payload, _) in enumerate(lote)
+                    ]
+                }
+            },
+        }
+    }
+
+    try:
+        async with session.post(
+            f"{url_base}/models/{modelo}:batchGenerateContent?key={api_key}",
+            json=body,
+            timeout=aiohttp.ClientTimeout(total=300),
+        ) as response:
+            if response.status != 200:
+                logger.error(f"Erro {response.status} ao criar job em lote na Gemini: {await response.text()}")
+                _resolve(futures, None)
+                return
+            job = await response.json()
+
+        nome_job = job.get("name")
+        logger.info(f"Job em lote Gemini criado: {nome_job} ({len(lote)} requests)")
+
+        t0 = time.monotonic()
+        while not _job_finalizado(job):
+            if all(future.done() for future in futures):
+                logger.warning(f"Job em lote Gemini {nome_job} sem leads aguardando (prazo encerrado), deixando de consultar")
+                return
+            if time.monotonic() - t0 > _config["timeout"]:
+                logger.error(f"Job em lote Gemini {nome_job} excedeu {_config['timeout']:.0f}s, desistindo")
+                _resolve(futures, None)
+                return
+            await asyncio.sleep(_config["intervalo_poll"])
+            async with session.get(
+                f"{url_base}/{nome_job}?key={api_key}",
+                timeout=aiohttp.ClientTimeout(total=60),
+            ) as response:
+                if response.status != 200:
+                    logger.warning(f"Erro {response.status} ao consultar job em lote {nome_job}: {await response.text()}")
+                    continue
+                job = await response.json()
+
+        estado = _estado_job(job)
+        if estado not in ("BATCH_STATE_SUCCEEDED", "JOB_STATE_SUCCEEDED") and not job.get("response"):
+            logger.error(f"Job em lote Gemini {nome_job} finalizou com estado {estado}: {job.get('error')}")
+            _resolve(futures, None)
+            return
+
+        respostas = _extrai_respostas(job)
+        for posicao, item in enumerate(respostas):
+            chave = (item.get("metadata") or {}).get("key")
+            indice = int(chave) if chave is not None and str(chave).isdigit() else posicao
+            if 0 <= indice < len(futures) and not futures[indice].done():
+                if item.get("error"):
+                    logger.warning(f"Request {indice} do job {nome_job} falhou: {item.get('error')}")
+                futures[indice].set_result(item.get("response"))
+
+        logger.info(f"Job em lote Gemini {nome_job} concluído em {time.monotonic() - t0:.0f}s ({len(respostas)}/{len(lote)} respostas)")
+
+    except Exception as e:
+        logger.error(f"Erro no job em lote Gemini: {e}")
+    finally:
+        _resolve(futures, None)
+
+
+def _estado_job(job):
+    return (job.get("metadata") or {}).get("state") or job.get("state")
+
+
+def _job_finalizado(job):
+    return bool(job.get("done")) or _estado_job(job) in ESTADOS_FINAIS_BATCH
+
+
+def _extrai_respostas(job):
+    """Respostas inline do job (aceita o formato de operação e o de batch)."""
+    origens = (job.get("response") or {}, (job.get("metadata") or {}).get("output") or {}, job.get("output") or {})
+    for origem in origens:
+        inline = origem.get("inlinedResponses")
+        if isinstance(inline, dict):
+            inline = inline.get("inlinedResponses")
+        if inline:
+            return inline
+    return []
@@ -0,0 +1,125 @@
+# ============================================================================================================================================
+# SERVIDOR LOCAL QUE IMITA A API DA GEMINI (generateContent + batchGenerateContent + polling de batches) PARA TESTES SEM CUSTO
+#
+#   python gemini_stub_server.py                       (porta 8089, ou GEMINI_STUB_PORT)
+#   GEMINI_API_BASE=http://localhost:8089/v1beta GEMINI_MODO_BATCH=sempre python status_analyzer.py
+#
+# Resposta determinística: mantém o STATUS_ATUAL recebido no user_input com confiança "50".
+# ============================================================================================================================================
+import os, re, json, time, uuid
+from aiohttp import web
+
+
+GEMINI_STUB_PORT = int(os.getenv("GEMINI_STUB_PORT", "8089"))
+GEMINI_STUB_ATRASO_BATCH = float(os.getenv("GEMINI_STUB_ATRASO_BATCH", "5"))      # segundos até o job em lote concluir
+GEMINI_STUB_MODELOS_INDISPONIVEIS = {m for m in os.getenv("GEMINI_STUB_MODELOS_INDISPONIVEIS", "").split(",") if m}   # respondem 503 (teste de circuit breaker)
+
+_batches = {}       # id -> {"criado_em", "display_name", "requests"}
+
+
+def _texto_da_request(request_gemini):
+    partes = []
+    for content in request_gemini.get("contents", []):
+        for parte in content.get("parts", []):
+            partes.append(parte.get("text", ""))
+    return "\n".join(partes)
+
+
+def _responde(request_gemini):
+    """GenerateContentResponse simulado para uma GenerateContentRequest."""
+    user_input = _texto_da_request(request_gemini)
+    system = request_gemini.get("system_instruction") or request_gemini.get("systemInstruction") or {}
+    prompt = "\n".join(p.get("text", "") for p in system.get("parts", []))
+
+    match = re.search(r"STATUS_ATUAL:\s*(.+?)\s*-*\s*$", user_input, re.MULTILINE)
+    status_atual = match.group(1).strip() if match else ""
+
+    texto = json.dumps({
+        "ai_suggestion_status_name": status_atual,
+        "nome_lead": "",
+        "ai_confidence_level_output": "50",
+        "analise_ai": "Resposta simulada pelo gemini_stub_server (status mantido).",
+    }, ensure_ascii=False)
+
+    prompt_tokens = (len(prompt) + len(user_input)) // 4
+    completion_tokens = len(texto) // 4
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": texto}]}, "finishReason": "STOP"}],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": completion_tokens,
+            "totalTokenCount": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+# ================================================================================================================================================================================
+# ROTAS
+# ================================================================================================================================================================================
+async def modelo_acao(request):
+    acao = request.match_info["acao"]
+    body = await request.json()
+
+    if request.match_info["modelo"] in GEMINI_STUB_MODELOS_INDISPONIVEIS:
+        return web.json_response({"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE"}}, status=503)
+
+    if acao == "generateContent":
+        return web.json_response(_responde(body))
+
+    if acao == "batchGenerateContent":
+        batch = body.get("batch", {})
+        requests_batch = (((batch.get("input_config") or batch.get("inputConfig") or {}).get("requests") or {}).get("requests")) or []
+        batch_id = uuid.uuid4().hex[:16]
+        _batches[batch_id] = {
+            "criado_em": time.monotonic(),
+            "display_name": batch.get("display_name", ""),
+            "requests": requests_batch,
+        }
+        return web.json_response(_operacao(batch_id))
+
+    return web.json_response({"error": {"code": 404, "message": f"Ação {acao} não suportada"}}, status=404)
+
+
+async def consulta_batch(request):
+    batch_id = request.match_info["batch_id"]
+    if batch_id not in _batches:
+        return web.json_response({"error": {"code": 404, "message": "Batch não encontrado"}}, status=404)
+    return web.json_response(_operacao(batch_id))
+
+
+def _operacao(batch_id):
+    batch = _batches[batch_id]
+    nome = f"batches/{batch_id}"
+    concluido = time.monotonic() - batch["criado_em"] >= GEMINI_STUB_ATRASO_BATCH
+    operacao = {
+        "name": nome,
+        "metadata": {
+            "@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatch",
+            "name": nome,
+            "displayName": batch["display_name"],
+            "state": "BATCH_STATE_SUCCEEDED" if concluido else "BATCH_STATE_RUNNING",
+        },
+        "done": concluido,
+    }
+    if concluido:
+        operacao["response"] = {
+            "@type": "type.googleapis.com/google.ai.generativelanguage.v1main.GenerateContentBatchOutput",
+            "inlinedResponses": {
+                "inlinedResponses": [
+                    {"response": _responde(item.get("request", {})), "metadata": item.get("metadata", {})}
+                    for item in batch["requests"]
+                ]
+            },
+        }
+    return operacao
+
+
+def cria_app():
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1beta/models/{modelo}:{acao}", modelo_acao)
+    app.router.add_get("/v1beta/batches/{batch_id}", consulta_batch)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(cria_app(), port=GEMINI_STUB_PORT)
@@ -0,0 +1,177 @@
+# ============================================================================================================================================
+# SHARDING ENTRE RÉPLICAS - LEASES DE COMPANY NO DB CORE (CADA RÉPLICA PROCESSA SÓ AS COMPANIES QUE ARRENDOU)
+# ============================================================================================================================================
+# Tabelas (criadas no startup se não existirem):
+#   status_analyzer_replica        : 1 linha por réplica viva (heartbeat)
+#   status_analyzer_company_lease  : dono atual de cada company + validade do lease
+# Réplica que morre para de renovar; os leases dela expiram em LEASE_TTL e são assumidos pelas outras no próximo ciclo.
+# Réplica nova entra sem leases; as outras liberam o excedente da sua cota justa (ceil(companies / réplicas vivas)).
+# Conexão pelo pool do core (pgbouncer em modo transação), por isso lease em tabela e não advisory lock de sessão.
+# ============================================================================================================================================
+import asyncio, math, zlib
+from log_config import logger
+
+
+DDL_LEASES = [
+    """
+    CREATE TABLE IF NOT EXISTS status_analyzer_replica (
+        replica_id   text PRIMARY KEY,
+        heartbeat_at timestamptz NOT NULL DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS status_analyzer_company_lease (
+        company_id  text PRIMARY KEY,
+        replica_id  text NOT NULL,
+        expires_at  timestamptz NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_status_analyzer_company_lease_replica
+        ON status_analyzer_company_lease (replica_id)
+    """,
+]
+
+
+class LeasesCompanies:
+
+    def __init__(self, db_core, replica_id, ttl):
+        self.db_core = db_core
+        self.replica_id = replica_id
+        self.ttl = ttl
+        self._task_renovacao = None
+
+    # ============================================================================================================================================
+    # STARTUP / ENCERRAMENTO
+    # ============================================================================================================================================
+    async def inicia(self):
+        async with self.db_core.connection() as conn:
+            for ddl in DDL_LEASES:
+                await conn.execute(query=ddl)
+        await self._heartbeat()
+        self._task_renovacao = asyncio.create_task(self._renova_periodicamente())
+        logger.info(f"Sharding por leases ativo | réplica {self.replica_id} | ttl {self.ttl}s")
+
+    async def encerra(self):
+        """Libera os leases para que as outras réplicas assumam já no próximo ciclo."""
+        if self._task_renovacao is not None:
+            self._task_renovacao.cancel()
+            await asyncio.gather(self._task_renovacao, return_exceptions=True)
+        async with self.db_core.connection() as conn:
+            await conn.execute(
+                query="DELETE FROM status_analyzer_company_lease WHERE replica_id = :replica_id",
+                values={"replica_id": self.replica_id},
+            )
+            await conn.execute(
+                query="DELETE FROM status_analyzer_replica WHERE replica_id = :replica_id",
+                values={"replica_id": self.replica_id},
+            )
+
+    # ============================================================================================================================================
+    # HEARTBEAT + RENOVAÇÃO DOS LEASES (CICLOS LONGOS, EX.: MODO LOTE, NÃO PERDEM AS COMPANIES NO MEIO)
+    # ============================================================================================================================================
+    async def _heartbeat(self):
+        async with self.db_core.connection() as conn:
+            await conn.execute(
+                query="""
+                    INSERT INTO status_analyzer_replica (replica_id, heartbeat_at)
+                    VALUES (:replica_id, now())
+                    ON CONFLICT (replica_id) DO UPDATE SET heartbeat_at = now()
+                """,
+                values={"replica_id": self.replica_id},
+            )
+            await conn.execute(
+                query="""
+                    UPDATE status_analyzer_company_lease
+                    SET expires_at = now() + make_interval(secs => :ttl)
+                    WHERE replica_id = :replica_id
+                """,
+                values={"replica_id": self.replica_id, "ttl": self.ttl},
+            )
+
+    async def _renova_periodicamente(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self._heartbeat()
+            except Exception as e:
+                logger.error(f"Erro ao renovar leases da réplica {self.replica_id}: {e}")
+
+    # ============================================================================================================================================
+    # DISTRIBUI AS COMPANIES DO CICLO: RENOVA AS PRÓPRIAS, LIBERA EXCEDENTE, ASSUME LIVRES/EXPIRADAS ATÉ A COTA
+    # ============================================================================================================================================
+    async def companies_do_ciclo(self, companies_ids):
+        companies_ids = list(dict.fromkeys(str(c) for c in companies_ids))
+        if not companies_ids:
+            return set()
+
+        await self._heartbeat()
+
+        async with self.db_core.connection() as conn:
+            replicas_vivas = await conn.fetch_val(
+                query="""
+                    SELECT count(*)
+                    FROM status_analyzer_replica
+                    WHERE heartbeat_at > now() - make_interval(secs => :ttl)
+                """,
+                values={"ttl": self.ttl},
+            ) or 1
+            cota = math.ceil(len(companies_ids) / replicas_vivas)
+
+            await conn.execute(
+                query="DELETE FROM status_analyzer_replica WHERE heartbeat_at < now() - make_interval(secs => :expurgo)",
+                values={"expurgo": self.ttl * 10},
+            )
+
+            rows = await conn.fetch_all(
+                query="""
+                    SELECT company_id, replica_id
+                    FROM status_analyzer_company_lease
+                    WHERE company_id = ANY(CAST(:companies_ids AS text[]))
+                      AND expires_at > now()
+                """,
+                values={"companies_ids": companies_ids},
+            )
+            minhas = [r["company_id"] for r in rows if r["replica_id"] == self.replica_id]
+            de_outras = {r["company_id"] for r in rows if r["replica_id"] != self.replica_id}
+
+            # acima da cota (réplica nova entrou): devolve o excedente
+            if len(minhas) > cota:
+                excedente = minhas[cota:]
+                minhas = minhas[:cota]
+                await conn.execute(
+                    query="""
+                        DELETE FROM status_analyzer_company_lease
+                        WHERE replica_id = :replica_id AND company_id = ANY(CAST(:companies_ids AS text[]))
+                    """,
+                    values={"replica_id": self.replica_id, "companies_ids": excedente},
+                )
+                logger.info(f"Leases: {len(excedente)} companies devolvidas para rebalanceamento")
+
+            # abaixo da cota: tenta assumir livres/expiradas (ordem rotacionada por réplica para reduzir disputa)
+            faltam = cota - len(minhas)
+            if faltam > 0:
+                livres = [c for c in companies_ids if c not in de_outras and c not in minhas]
+                if livres:
+                    deslocamento = zlib.crc32(self.replica_id.encode()) % len(livres)
+                    candidatas = (livres[deslocamento:] + livres[:deslocamento])[:faltam]
+                    assumidas = await conn.fetch_all(
+                        query="""
+                            INSERT INTO status_analyzer_company_lease (company_id, replica_id, expires_at)
+                            SELECT c, :replica_id, now() + make_interval(secs => :ttl)
+                            FROM unnest(CAST(:companies_ids AS text[])) AS c
+                            ON CONFLICT (company_id) DO UPDATE
+                                SET replica_id = EXCLUDED.replica_id, expires_at = EXCLUDED.expires_at
+                                WHERE status_analyzer_company_lease.expires_at <= now()
+                                   OR status_analyzer_company_lease.replica_id = EXCLUDED.replica_id
+                            RETURNING company_id
+                        """,
+                        values={"replica_id": self.replica_id, "ttl": self.ttl, "companies_ids": candidatas},
+                    )
+                    minhas.extend(r["company_id"] for r in assumidas)
+
+        logger.info(
+            f"Leases: réplica {self.replica_id} com {len(minhas)}/{len(companies_ids)} companies "
+            f"(réplicas vivas: {replicas_vivas}, cota: {cota})"
+        )
+        return set(minhas)
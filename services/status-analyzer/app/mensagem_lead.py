@@ -0,0 +1,35 @@
+# ============================================================================================================================================
+# REGISTRO COMPACTO DE MENSAGEM (__slots__) COMPARTILHADO PELOS CAMINHOS DE KEYWORDS E IA
+# ============================================================================================================================================
+# Montado direto do record do banco (Evolution ou store local), sem dict intermediário nem serializa_metadata;
+# a mesma instância vai da busca até keywords, formatação do histórico e store local.
+# ============================================================================================================================================
+
+
+class MensagemLead:
+
+    __slots__ = ("de", "data_hora", "mensagem", "jid_encontrado", "message_id", "message_timestamp")
+
+    def __init__(self, de, data_hora, mensagem, jid_encontrado=None, message_id=None, message_timestamp=None):
+        self.de = de                                    # "EMPRESA" | "LEAD"
+        self.data_hora = data_hora                      # datetime naive no fuso da Evolution
+        self.mensagem = mensagem
+        self.jid_encontrado = jid_encontrado
+        self.message_id = message_id
+        self.message_timestamp = message_timestamp
+
+    @classmethod
+    def do_registro(cls, row, jid_encontrado=None, com_ids=False):
+        """
+        A partir de um record com as colunas de, data_hora, mensagem (+ message_id e message_timestamp
+        quando com_ids). Remove caracteres nulos do texto, como serializa_metadata.
+        """
+        mensagem = row["mensagem"]
+        if isinstance(mensagem, str) and "\u0000" in mensagem:
+            mensagem = mensagem.replace("\u0000", "")
+        if not com_ids:
+            return cls(row["de"], row["data_hora"], mensagem, jid_encontrado)
+        return cls(row["de"], row["data_hora"], mensagem, jid_encontrado, str(row["message_id"]), row["message_timestamp"])
+
+    def __repr__(self):
+        return f"MensagemLead({self.de!r}, {self.data_hora!r}, {self.mensagem!r})"
@@ -0,0 +1,149 @@
+# ============================================================================================================================================
+# MOTOR DE KEYPHRASES: NORMALIZAÇÃO POR TABELA DE TRADUÇÃO + AUTÔMATO AHO-CORASICK (1 PASSADA POR MENSAGEM)
+# ============================================================================================================================================
+import unicodedata
+from collections import deque
+
+
+# ================================================================================================================================================================================
+# NORMALIZAÇÃO PARA COMPARAÇÃO DE KEYWORDS
+# ================================================================================================================================================================================
+class _TabelaNormalizacaoKw(dict):
+    """Tabela para str.translate preenchida sob demanda: letras/números ficam, o resto vira espaço."""
+
+    def __missing__(self, codepoint):
+        categoria = unicodedata.category(chr(codepoint))
+        valor = codepoint if categoria[0] in ("L", "N") else " "
+        self[codepoint] = valor
+        return valor
+
+
+_TABELA_NORMALIZACAO_KW = _TabelaNormalizacaoKw()
+
+
+# Normaliza textos para comparação de keywords: remove acentos, pontuação e emojis,
+# mantém apenas letras, números e espaços, e colapsa múltiplos espaços.
+def normaliza_texto_para_kw(texto):
+    """Remove acentos/pontuação para comparação de keywords insensível a caso/acentos."""
+    if not texto:
+        return ""
+    texto = unicodedata.normalize("NFKD", texto).lower().translate(_TABELA_NORMALIZACAO_KW)
+    return " ".join(texto.split())
+
+
+# ================================================================================================================================================================================
+# AUTÔMATO AHO-CORASICK
+# ================================================================================================================================================================================
+class AutomatoKeyphrases:
+    """
+    Compila N keyphrases (já normalizadas) num autômato; busca() devolve todas as ocorrências
+    (posição inicial, índice da keyphrase) em uma única varredura do texto.
+    """
+
+    __slots__ = ("_goto", "_falha", "_saidas", "_tamanhos")
+
+    def __init__(self, keyphrases):
+        self._goto = [{}]
+        self._falha = [0]
+        self._saidas = [()]
+        self._tamanhos = [len(k) for k in keyphrases]
+
+        # trie
+        for indice, keyphrase in enumerate(keyphrases):
+            estado = 0
+            for ch in keyphrase:
+                proximo = self._goto[estado].get(ch)
+                if proximo is None:
+                    proximo = len(self._goto)
+                    self._goto[estado][ch] = proximo
+                    self._goto.append({})
+                    self._falha.append(0)
+                    self._saidas.append(())
+                estado = proximo
+            self._saidas[estado] = self._saidas[estado] + (indice,)
+
+        # links de falha (BFS) e saídas herdadas
+        fila = deque(self._goto[0].values())
+        while fila:
+            estado = fila.popleft()
+            for ch, proximo in self._goto[estado].items():
+                fila.append(proximo)
+                falha = self._falha[estado]
+                while falha and ch not in self._goto[falha]:
+                    falha = self._falha[falha]
+                destino = self._goto[falha].get(ch, 0)
+                self._falha[proximo] = destino if destino != proximo else 0
+                self._saidas[proximo] = self._saidas[proximo] + self._saidas[self._falha[proximo]]
+
+    def busca(self, texto):
+        """Lista de (posição inicial, índice da keyphrase), em ordem de término no texto."""
+        goto, falha, saidas, tamanhos = self._goto, self._falha, self._saidas, self._tamanhos
+        ocorrencias = []
+        estado = 0
+        for posicao, ch in enumerate(texto):
+            while estado and ch not in goto[estado]:
+                estado = falha[estado]
+            estado = goto[estado].get(ch, 0)
+            if saidas[estado]:
+                for indice in saidas[estado]:
+                    ocorrencias.append((posicao - tamanhos[indice] + 1, indice))
+        return ocorrencias
+
+    def conta_sem_sobreposicao(self, texto):
+        """
+        Ocorrências por keyphrase com a mesma semântica de str.count (não sobrepostas, da esquerda
+        para a direita), agrupadas por índice: {indice: [posições]}.
+        """
+        por_indice = {}
+        fim_ultima = {}
+        for inicio, indice in sorted(self.busca(texto)):
+            if inicio < fim_ultima.get(indice, 0):
+                continue
+            fim_ultima[indice] = inicio + self._tamanhos[indice]
+            por_indice.setdefault(indice, []).append(inicio)
+        return por_indice
+
+
+# ================================================================================================================================================================================
+# CACHE DO MOTOR POR COMPANY (INVALIDADO QUANDO AS CONFIGS DE KEYPHRASE MUDAM)
+# ================================================================================================================================================================================
+_cache_motor_kw = {}       # company_id -> (assinatura, kw_entries, automato)
+
+
+def monta_kw_entries(status_configs):
+    """Monta lista de keywords válidas (ignora se não houver frase ou se não estiver ativada)."""
+    kw_entries = []
+    for status in status_configs:
+        if not status.get("kw_analysis"):
+            continue
+        raw_phrase = status.get("kw_keyphrase") or ""
+        capture_value = "{{valor_conversao}}" in raw_phrase
+        phrase_for_match = raw_phrase.replace("{{valor_conversao}}", "")
+        normalized_phrase = normaliza_texto_para_kw(phrase_for_match)
+        if not normalized_phrase:
+            continue
+        kw_entries.append({
+            "status_name": status["status_name"],
+            "status_code": status["status_code"],
+            "kw_keyphrase": raw_phrase,
+            "kw_keyphrase_normalized": normalized_phrase,
+            "capture_value": capture_value,
+        })
+    return kw_entries
+
+
+def obtem_motor_kw(company_id, status_configs):
+    """Retorna (kw_entries, autômato) da company, recompilando só quando as configs de keyphrase mudam."""
+    assinatura = tuple(
+        (s.get("status_name"), s.get("status_code"), s.get("kw_keyphrase"))
+        for s in status_configs
+        if s.get("kw_analysis")
+    )
+    em_cache = _cache_motor_kw.get(company_id)
+    if em_cache is not None and em_cache[0] == assinatura:
+        return em_cache[1], em_cache[2]
+
+    kw_entries = monta_kw_entries(status_configs)
+    automato = AutomatoKeyphrases([k["kw_keyphrase_normalized"] for k in kw_entries]) if kw_entries else None
+    _cache_motor_kw[company_id] = (assinatura, kw_entries, automato)
+    return kw_entries, automato
@@ -0,0 +1,108 @@
+# ============================================================================================================================================
+# RESUMO ROLANTE DA CONVERSA POR LEAD (DB CORE) - RESUMO GERADO PELO MODELO ATÉ UM WATERMARK + ÚLTIMO STATUS SUGERIDO
+# ============================================================================================================================================
+# Tabela (criada no startup se não existir):
+#   lead_conversation_summary : 1 linha por lead com o resumo das mensagens até o watermark
+# O watermark é por mensagem: (watermark_data_hora, watermark_qtd_mesmo_instante) = segundo da última mensagem resumida e
+# quantas mensagens desse mesmo segundo já entraram no resumo (data_hora tem resolução de segundo; ordem da busca é estável).
+# Nas análises seguintes a IA recebe "resumo + mensagens após o watermark"; o resumo é regenerado (resumo anterior +
+# mensagens novas mais antigas) quando o trecho após o watermark cresce demais. Fica no core (e não no store local)
+# para sobreviver a restart e troca de réplica.
+# ============================================================================================================================================
+import asyncio
+
+
+DDL_RESUMOS = [
+    """
+    CREATE TABLE IF NOT EXISTS lead_conversation_summary (
+        lead_id                 text PRIMARY KEY,
+        company_id              text NOT NULL,
+        resumo                  text NOT NULL,
+        watermark_data_hora     timestamp NOT NULL,
+        watermark_qtd_mesmo_instante integer NOT NULL DEFAULT 0,
+        qtd_mensagens           integer NOT NULL DEFAULT 0,
+        ultimo_status_sugerido  text,
+        atualizado_em           timestamptz NOT NULL DEFAULT now()
+    )
+    """,
+    # tabelas criadas antes do watermark por mensagem (0 = mensagens do segundo do watermark voltam a ser enviadas)
+    """
+    ALTER TABLE lead_conversation_summary
+        ADD COLUMN IF NOT EXISTS watermark_qtd_mesmo_instante integer NOT NULL DEFAULT 0
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_lead_conversation_summary_company
+        ON lead_conversation_summary (company_id)
+    """,
+]
+
+
+async def cria_resumos_conversa(db_core):
+    async with db_core.connection() as conn:
+        for ddl in DDL_RESUMOS:
+            await conn.execute(query=ddl)
+
+
+async def carrega_resumo(db_core, lead_id):
+    """{"resumo", "watermark_data_hora", "watermark_qtd_mesmo_instante", "qtd_mensagens", "ultimo_status_sugerido"} ou None."""
+    async with db_core.connection() as conn:
+        row = await asyncio.wait_for(
+            conn.fetch_one(
+                query="""
+                    SELECT resumo, watermark_data_hora, watermark_qtd_mesmo_instante, qtd_mensagens, ultimo_status_sugerido
+                    FROM lead_conversation_summary
+                    WHERE lead_id = :lead_id
+                """,
+                values={"lead_id": str(lead_id)},
+            ),
+            timeout=30
+        )
+    return dict(row) if row else None
+
+
+async def salva_resumo(db_core, lead_id, company_id, resumo, watermark_data_hora, watermark_qtd_mesmo_instante, qtd_mensagens,
+                       ultimo_status_sugerido):
+    async with db_core.connection() as conn:
+        await asyncio.wait_for(
+            conn.execute(
+                query="""
+                    INSERT INTO lead_conversation_summary
+                        (lead_id, company_id, resumo, watermark_data_hora, watermark_qtd_mesmo_instante, qtd_mensagens,
+                         ultimo_status_sugerido, atualizado_em)
+                    VALUES (:lead_id, :company_id, :resumo, :watermark_data_hora, :watermark_qtd_mesmo_instante, :qtd_mensagens,
+                            :ultimo_status_sugerido, now())
+                    ON CONFLICT (lead_id) DO UPDATE SET
+                        company_id             = EXCLUDED.company_id,
+                        resumo                 = EXCLUDED.resumo,
+                        watermark_data_hora    = EXCLUDED.watermark_data_hora,
+                        watermark_qtd_mesmo_instante = EXCLUDED.watermark_qtd_mesmo_instante,
+                        qtd_mensagens          = EXCLUDED.qtd_mensagens,
+                        ultimo_status_sugerido = COALESCE(EXCLUDED.ultimo_status_sugerido, lead_conversation_summary.ultimo_status_sugerido),
+                        atualizado_em          = now()
+                """,
+                values={
+                    "lead_id": str(lead_id),
+                    "company_id": str(company_id),
+                    "resumo": resumo,
+                    "watermark_data_hora": watermark_data_hora,
+                    "watermark_qtd_mesmo_instante": watermark_qtd_mesmo_instante,
+                    "qtd_mensagens": qtd_mensagens,
+                    "ultimo_status_sugerido": ultimo_status_sugerido,
+                },
+            ),
+            timeout=30
+        )
+
+
+async def atualiza_status_resumo(db_core, lead_id, status_sugerido):
+    """Registra o status sugerido pela última análise (vai no cabeçalho do resumo na próxima)."""
+    async with db_core.connection() as conn:
+        await conn.execute(
+            query="""
+                UPDATE lead_conversation_summary
+                SET ultimo_status_sugerido = :status_sugerido, atualizado_em = now()
+                WHERE lead_id = :lead_id
+            """,
+            values={"lead_id": str(lead_id), "status_sugerido": status_sugerido},
+        )
+
@@ -1,17 +1,29 @@
 # ============================================================================================================================================
 # ANALISA CONVERSAS DOS LEADS COM AI E SUGERE UM NOVO STATUS PRO LEAD
 # ============================================================================================================================================
-import os, sys, aiohttp, json, asyncio, uvloop, re, unicodedata
+import os, sys, aiohttp, json, asyncio, uvloop, re, hashlib, random, socket
 from pathlib import Path
-from datetime import datetime, time, timezone
+from datetime import datetime, time, timezone, timedelta
+from zoneinfo import ZoneInfo
+from contextvars import ContextVar
 
 _app = Path(__file__).resolve().parent
 for _sub in ("logging", "db", "utils", "api"):
     sys.path.append(str(_app / _sub))
 from log_config import logger, log_ip, log_host, log_action, log_metadata
-from db_connections_async import conecta_leaper_db_core, conecta_leaper_db_gateway, conecta_leaper_db_evo
+from db_connections_async import conecta_leaper_db_core, conecta_leaper_db_gateway, obtem_pool_evo, fecha_pools_evo_ociosos, fecha_pools_evo, estatisticas_pools_evo
 from utils import serializa_metadata
+from estado_leads import cria_estado_leads, estado_leads_existe, monta_upsert_estado_leads
 from leaper_core_apis import get_auth_token_company_leaper, change_lead_status, send_lead_conversion_value
+from motor_keywords import normaliza_texto_para_kw, obtem_motor_kw
+from conversas_locais import abre_conversas_locais, fecha_conversas_locais, conversas_locais_ativas, carrega_watermarks, mescla_e_carrega, remove_leads, remove_expirados
+from gemini_batch import configura_gemini_batch, classifica_em_lote, aguarda_jobs_gemini_batch
+from controle_gemini import ControleConcorrenciaAIMD, LimitadorTokens, CircuitBreaker
+from escalonador_leads import EscalonadorDRR, worker_escalonador
+from leases_companies import LeasesCompanies
+from mensagem_lead import MensagemLead
+from resumos_conversa import cria_resumos_conversa, carrega_resumo, salva_resumo, atualiza_status_resumo
+from codificador_conversa import PERFIS_CODIFICADOR, EconomiaCodificador, OrcamentoCodificado, codifica_conversa, caracteres_formato_classico
 
 
 # ========================================================================================================================================================================
@@ -25,6 +37,29 @@ SERVER_HOST = os.getenv("SERVER_HOST")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 WORKERS_GLOBAIS = 4
 
+# POOL EVOLUTION: 1 conexão por lead simultâneo (4 companies x 4 leads)
+EVO_POOL_MAX_SIZE = int(os.getenv("EVO_POOL_MAX_SIZE", str(WORKERS_GLOBAIS * 4)))
+
+# INSTÂNCIAS EM PARALELO: orçamento global de instâncias simultâneas e limite por host Evolution
+PROCESSA_INSTANCIAS_EM_PARALELO = os.getenv("PROCESSA_INSTANCIAS_EM_PARALELO", "false").lower() == "true"
+MAX_INSTANCIAS_SIMULTANEAS = int(os.getenv("MAX_INSTANCIAS_SIMULTANEAS", "4"))
+MAX_INSTANCIAS_POR_HOST = int(os.getenv("MAX_INSTANCIAS_POR_HOST", "2"))
+
+# SHARDING ENTRE RÉPLICAS: CADA RÉPLICA PROCESSA SÓ AS COMPANIES QUE ARRENDOU NO DB CORE
+SHARDING_ATIVO = os.getenv("SHARDING_ATIVO", "false").lower() == "true"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = int(os.getenv("LEASE_TTL", "600"))
+
+# VÍNCULO DO USER MICROSERVICE NAS COMPANIES: INCREMENTAL POR company.created_at, RECONCILIAÇÃO COMPLETA NO STARTUP E A CADA INTERVALO
+MICROSERVICE_RECONCILIACAO_INTERVALO = float(os.getenv("MICROSERVICE_RECONCILIACAO_INTERVALO", "21600"))
+MICROSERVICE_SOBREPOSICAO_WATERMARK = timedelta(minutes=int(os.getenv("MICROSERVICE_SOBREPOSICAO_WATERMARK_MIN", "60")))   # cobre commits atrasados
+_vinculo_microservice = {"watermark": None, "ultima_reconciliacao": None}
+
+# ROTAS COMPANY -> (evo_db_host, evo_db_name) EM CACHE: INCREMENTAL POR created_at/updated_at DO "instance", RECARGA COMPLETA A CADA TTL
+ROTAS_INSTANCIAS_TTL = float(os.getenv("ROTAS_INSTANCIAS_TTL", "3600"))
+ROTAS_INSTANCIAS_SOBREPOSICAO = timedelta(minutes=int(os.getenv("ROTAS_INSTANCIAS_SOBREPOSICAO_MIN", "10")))
+_rotas_instancias = {"por_company": {}, "watermark": None, "carregado_em": None, "forcar": False, "expr_alterado_em": None}
+
 
 
 # ================================================================================================================================================================================
@@ -34,6 +69,22 @@ WORKERS_GLOBAIS = 4
 # QTD MÁX DE LEADS POR EXECUÇÃO ------------------------------------------------------------------------------------------------------------------------------------------------
 MAX_LEADS_POR_RODADA = 100
 
+# AGENDAMENTO DOS CICLOS: EMENDA O PRÓXIMO CICLO ENQUANTO HOUVER BACKLOG, SÓ DORME QUANDO OCIOSO ----------------------------------------------------------------------------
+CICLO_INTERVALO_OCIOSO = float(os.getenv("CICLO_INTERVALO_OCIOSO", "300"))     # intervalo entre inícios de ciclo sem backlog
+CICLO_INTERVALO_MINIMO = float(os.getenv("CICLO_INTERVALO_MINIMO", "5"))       # folga mínima entre ciclos
+CICLO_JITTER = float(os.getenv("CICLO_JITTER", "10"))
+
+# QTD DE LEADS POR CONSULTA EM LOTE NA TABELA "Message" DA EVOLUTION -----------------------------------------------------------------------------------------------------
+TAMANHO_LOTE_MENSAGENS = int(os.getenv("TAMANHO_LOTE_MENSAGENS", "25"))
+# BUSCA POR LEAD EM STREAMING (cursor no servidor, da mais nova para a mais antiga, para ao encher o orçamento do prompt) no lugar do lote
+BUSCA_MENSAGENS_STREAMING = os.getenv("BUSCA_MENSAGENS_STREAMING", "false").lower() == "true"
+FUSO_EVOLUTION = ZoneInfo("America/Sao_Paulo")
+
+# STORE LOCAL DE CONVERSAS (busca incremental na Evolution) ----------------------------------------------------------------------------------------------------------------------
+CONVERSAS_LOCAIS_ATIVO = os.getenv("CONVERSAS_LOCAIS_ATIVO", "true").lower() == "true"
+CONVERSAS_LOCAIS_DB = os.getenv("CONVERSAS_LOCAIS_DB", str(Path(__file__).resolve().parent / "data" / "conversas_locais.sqlite3"))
+CONVERSAS_LOCAIS_DIAS_SEM_ATUALIZACAO = int(os.getenv("CONVERSAS_LOCAIS_DIAS_SEM_ATUALIZACAO", "3"))
+
 # DEFAULT DE CONTEXTO DO NEGÓCIO ---------------------------------------------------------------------------------------------------------------------------------------------
 DEFAULT_BUSINESS_CONTEXT = "Negócio local que atende via WhatsApp. Interesse real dos clientes pelos produtos/serviços se manifesta através de perguntas específicas sobre o produto/serviço, não curiosidade geral."
 
@@ -63,10 +114,99 @@ STATUS_EMOJIS = {
 GEMINI_TIMEOUT = 120
 GEMINI_MAX_RETRIES = 3
 GEMINI_MODELO = "gemini-3-flash-preview"
-GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODELO}:generateContent"
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")   # aponte para o gemini_stub_server.py em testes locais
+GEMINI_URL = f"{GEMINI_API_BASE}/models/{{modelo}}:generateContent"
 LIMITE_TOKENS_MODELO = 1000000
 QTD_MEDIA_CARACTERES_POR_TOKEN = 4
 
+# TRUNCAMENTO DO HISTÓRICO ------------------------------------------------------------------------------------------------------------------------------------------------------------
+# quem corta é o orçamento em tokens (estimados pelo calibrador), limitado a 90% da janela do modelo; padrão = mesmo
+# tamanho de histórico de antes (~250 mil caracteres a QTD_MEDIA_CARACTERES_POR_TOKEN)
+LIMITE_TOKENS_HISTORICO = min(
+    int(os.getenv("LIMITE_TOKENS_HISTORICO", str(int(((LIMITE_TOKENS_MODELO / QTD_MEDIA_CARACTERES_POR_TOKEN) - 100) / QTD_MEDIA_CARACTERES_POR_TOKEN)))),
+    int(LIMITE_TOKENS_MODELO * 0.9),
+)
+# rede de segurança em caracteres: com o calibrador limitado a CALIBRACAO_MAX_CARACTERES_POR_TOKEN, nunca corta antes do orçamento de tokens
+CALIBRACAO_MIN_CARACTERES_POR_TOKEN = 1.0
+CALIBRACAO_MAX_CARACTERES_POR_TOKEN = 8.0
+LIMITE_CARACTERES_HISTORICO = LIMITE_TOKENS_HISTORICO * CALIBRACAO_MAX_CARACTERES_POR_TOKEN
+POLITICA_TRUNCAMENTO = os.getenv("POLITICA_TRUNCAMENTO", "tail")          # "tail" | "head_tail"
+TRUNCAMENTO_MAX_MSGS_INICIO = int(os.getenv("TRUNCAMENTO_MAX_MSGS_INICIO", "3"))
+CALIBRACAO_TOKENS_ALPHA = 0.1
+
+# GRAVAÇÃO EM LOTE NA lead_status_transition ---------------------------------------------------------------------------------------------------------------------------------
+TRACKING_EM_LOTE = os.getenv("TRACKING_EM_LOTE", "true").lower() == "true"
+TRACKING_LOTE_MAX_LINHAS = int(os.getenv("TRACKING_LOTE_MAX_LINHAS", "50"))
+TRACKING_LOTE_MAX_ESPERA = float(os.getenv("TRACKING_LOTE_MAX_ESPERA", "1.0"))
+
+# CONCORRÊNCIA ADAPTATIVA (AIMD) DAS CHAMADAS À GEMINI --------------------------------------------------------------------------------------------------------------------------
+GEMINI_CONCORRENCIA_INICIAL = int(os.getenv("GEMINI_CONCORRENCIA_INICIAL", "8"))
+GEMINI_CONCORRENCIA_PISO = int(os.getenv("GEMINI_CONCORRENCIA_PISO", "2"))
+GEMINI_CONCORRENCIA_TETO = int(os.getenv("GEMINI_CONCORRENCIA_TETO", "64"))
+GEMINI_LATENCIA_ALVO = float(os.getenv("GEMINI_LATENCIA_ALVO", "30"))         # segundos; acima disso o limite para de crescer
+controle_concorrencia_gemini = ControleConcorrenciaAIMD(
+    GEMINI_CONCORRENCIA_INICIAL, GEMINI_CONCORRENCIA_PISO, GEMINI_CONCORRENCIA_TETO, GEMINI_LATENCIA_ALVO,
+)
+
+# CIRCUIT BREAKER DA GEMINI + MODELO ALTERNATIVO (FAILOVER) --------------------------------------------------------------------------------------------------------------------
+GEMINI_MODELO_FAILOVER = os.getenv("GEMINI_MODELO_FAILOVER", "")            # vazio = sem failover, só falha rápido
+GEMINI_BREAKER_TAXA_FALHAS = float(os.getenv("GEMINI_BREAKER_TAXA_FALHAS", "0.5"))
+GEMINI_BREAKER_LATENCIA_MAX = float(os.getenv("GEMINI_BREAKER_LATENCIA_MAX", "90"))
+GEMINI_BREAKER_TEMPO_ABERTO = float(os.getenv("GEMINI_BREAKER_TEMPO_ABERTO", "60"))
+breakers_gemini = [
+    CircuitBreaker(modelo, GEMINI_BREAKER_TAXA_FALHAS, GEMINI_BREAKER_LATENCIA_MAX, GEMINI_BREAKER_TEMPO_ABERTO)
+    for modelo in dict.fromkeys(m for m in (GEMINI_MODELO, GEMINI_MODELO_FAILOVER) if m)
+]
+
+# ORÇAMENTO DE TOKENS DA GEMINI (0 = sem limite) --------------------------------------------------------------------------------------------------------------------------------
+GEMINI_TPM_GLOBAL = int(os.getenv("GEMINI_TPM_GLOBAL", "0"))
+GEMINI_TPM_POR_COMPANY = int(os.getenv("GEMINI_TPM_POR_COMPANY", "0"))
+GEMINI_COTA_DIARIA_TOKENS_COMPANY = int(os.getenv("GEMINI_COTA_DIARIA_TOKENS_COMPANY", "0"))
+GEMINI_COTAS_DIARIAS_POR_COMPANY = json.loads(os.getenv("GEMINI_COTAS_DIARIAS_POR_COMPANY", "{}"))    # {"<company_id>": tokens}
+limitador_tokens_gemini = LimitadorTokens(
+    GEMINI_TPM_GLOBAL, GEMINI_TPM_POR_COMPANY, GEMINI_COTA_DIARIA_TOKENS_COMPANY, GEMINI_COTAS_DIARIAS_POR_COMPANY,
+)
+_companies_cota_esgotada = {}    # company_id -> início (loop.time) da última rodada com a cota diária esgotada
+
+# GEMINI EM LOTE (BATCH API, ~50% DO CUSTO, RESPOSTA ASSÍNCRONA) ----------------------------------------------------------------------------------------------------------------
+GEMINI_MODO_BATCH = os.getenv("GEMINI_MODO_BATCH", "off")                  # "off" | "sempre" | "fora_do_horario"
+GEMINI_BATCH_MAX_REQUESTS = int(os.getenv("GEMINI_BATCH_MAX_REQUESTS", "500"))
+GEMINI_BATCH_MAX_ESPERA = float(os.getenv("GEMINI_BATCH_MAX_ESPERA", "30"))
+GEMINI_BATCH_INTERVALO_POLL = float(os.getenv("GEMINI_BATCH_INTERVALO_POLL", "30"))
+GEMINI_BATCH_TIMEOUT = float(os.getenv("GEMINI_BATCH_TIMEOUT", str(6 * 3600)))
+modo_batch_ai = ContextVar("MODO_BATCH_AI", default=False)
+prazo_batch_ai = ContextVar("PRAZO_BATCH_AI", default=None)   # "fora_do_horario": espera pelos jobs termina quando o horário comercial começa
+# ESCALONADOR DE LEADS (DRR ENTRE COMPANIES -> 1 POOL DE WORKERS POR CICLO) ---------------------------------------------------------------------------------------------------
+WORKERS_LEADS = int(os.getenv("WORKERS_LEADS", str(WORKERS_GLOBAIS * 4)))
+WORKERS_LEADS_BATCH = int(os.getenv("WORKERS_LEADS_BATCH", "500"))       # em lote os workers só aguardam o job, então o pool é bem maior
+COMPANIES_SIMULTANEAS = int(os.getenv("COMPANIES_SIMULTANEAS", "4"))     # companies consultando elegibilidade/preparando ao mesmo tempo
+PESOS_COMPANY = json.loads(os.getenv("PESOS_COMPANY", "{}"))               # {"<company_id>": peso}; padrão 1
+
+# ESTADO POR LEAD (lead_analysis_state) NO LUGAR DO DISTINCT ON SOBRE O HISTÓRICO DE lead_status_transition -------------------------------------------------------------------
+ESTADO_LEADS_ATIVO = os.getenv("ESTADO_LEADS_ATIVO", "true").lower() == "true"
+# "existe": tabela pronta no banco (criada por qualquer réplica) -> todo INSERT de tracking faz o upsert, mesmo com ESTADO_LEADS_ATIVO=false
+# "ativo":  elegibilidade lê o estado (ESTADO_LEADS_ATIVO e tabela pronta)
+_estado_leads = {"existe": False, "ativo": False}
+
+# CODIFICAÇÃO DO HISTÓRICO ENVIADO À IA ("classico" | "compacto" | "enxuto", ver codificador_conversa.py) -----------------------------------------------------------------
+CODIFICADOR_CONVERSA_PERFIL = os.getenv("CODIFICADOR_CONVERSA_PERFIL", "classico")
+if CODIFICADOR_CONVERSA_PERFIL not in PERFIS_CODIFICADOR:
+    CODIFICADOR_CONVERSA_PERFIL = "classico"
+economia_codificador = EconomiaCodificador()
+codificacao_conversa = ContextVar("CODIFICACAO_CONVERSA", default=None)   # {"perfil", "caracteres_classico"} da chamada em andamento
+
+# RESUMO ROLANTE DA CONVERSA: IA RECEBE "RESUMO ATÉ O WATERMARK + MENSAGENS NOVAS" EM VEZ DO HISTÓRICO INTEIRO ----------------------------------------------------------------
+# Precisa do histórico completo do lead: leads buscados em streaming (só a janela do orçamento + mensagens da EMPRESA das
+# keywords) seguem sem resumo, com o histórico truncado de sempre. Rebuscar o período inteiro anularia o ganho de memória.
+RESUMO_CONVERSA_ATIVO = os.getenv("RESUMO_CONVERSA_ATIVO", "false").lower() == "true"
+RESUMO_MIN_CARACTERES = int(os.getenv("RESUMO_MIN_CARACTERES", "12000"))               # históricos menores vão inteiros
+RESUMO_MENSAGENS_RECENTES = int(os.getenv("RESUMO_MENSAGENS_RECENTES", "20"))           # sempre enviadas na íntegra, nunca resumidas
+RESUMO_DELTA_MAX_CARACTERES = int(os.getenv("RESUMO_DELTA_MAX_CARACTERES", "8000"))     # acima disso (fora as recentes) o resumo é regenerado
+_resumos_conversa = {"ativo": False}   # só liga depois que a tabela existe (criada no startup)
+
+# PULA A IA QUANDO CONVERSA + STATUS ATUAL + CONFIGS NÃO MUDARAM DESDE A ÚLTIMA ANÁLISE -----------------------------------------------------------------------------------------
+PULA_AI_SEM_ALTERACAO = os.getenv("PULA_AI_SEM_ALTERACAO", "true").lower() == "true"
+
 # PROMPT --------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 PROMPT = f"""Você é especialista em analisar troca de mensagens entre lead (potencial cliente) e empresa, o seu objetivo é classificar a conversa em status pré-determinados de acordo com o desenrolar da conversa.
 
@@ -128,6 +268,54 @@ Considere este contexto a respeito da empresa e de suas atividades para que voc
 - Em seu output você SEMPRE deve informar qual o "ai_suggestion_status_name" (SEMPRE), "ai_confidence_level_output" (SEMPRE), "analise_ai" (SEMPRE), o "nome_lead" (se disponível), e "valor" (se disponível).
 """
 
+# MESMO PROMPT, COM O PASSO #1 DESCREVENDO O FORMATO DOS PERFIS "compacto" / "enxuto"
+PROMPT_COMPACTO = PROMPT.replace(
+    """STATUS_ATUAL: EM ANDAMENTO  
+EMPRESA (dd/mm/yyyy hh:mm:ss): Mensagem 01  
+LEAD (dd/mm/yyyy hh:mm:ss): Mensagem 02  
+EMPRESA (dd/mm/yyyy hh:mm:ss): Mensagem 03  
+LEAD (dd/mm/yyyy hh:mm:ss): Mensagem 04  
+
+Importante: STATUS_ATUAL contém o status atual da conversa.
+""",
+    """STATUS_ATUAL: EM ANDAMENTO  
+[dd/mm/yyyy]  
+EMPRESA hh:mm: Mensagem 01  
+LEAD hh:mm: Mensagem 02  
+Mensagem 03  
+[dd/mm/yyyy]  
+EMPRESA hh:mm: Mensagem 04  
+
+Importante: STATUS_ATUAL contém o status atual da conversa.
+A data [dd/mm/yyyy] aparece apenas quando o dia muda e vale para as mensagens abaixo dela; cada cabeçalho traz o remetente e a hora (hh:mm).
+Linhas sem cabeçalho (como a Mensagem 03) são mensagens seguidas do mesmo remetente do cabeçalho anterior, enviadas logo em seguida.
+Mensagens repetidas idênticas foram omitidas e sequências de emojis podem ter sido reduzidas a um só.
+""",
+)
+
+PROMPTS_POR_PERFIL = {"classico": PROMPT, "compacto": PROMPT_COMPACTO, "enxuto": PROMPT_COMPACTO}
+
+# COMPLEMENTO DO PROMPT QUANDO O HISTÓRICO VEM COMO RESUMO + MENSAGENS APÓS O RESUMO
+PROMPT_COMPLEMENTO_RESUMO = """
+# Histórico resumido
+Em conversas longas, antes das mensagens você receberá um bloco RESUMO_CONVERSA com o resumo de todas as mensagens trocadas até a data indicada e o último status sugerido na análise anterior, seguido de MENSAGENS_APOS_RESUMO com as mensagens posteriores no formato do Passo #1.
+Considere o resumo como parte do histórico (ele substitui as mensagens antigas) e dê mais peso às mensagens posteriores quando houver conflito.
+"""
+
+# PROMPT DE GERAÇÃO DO RESUMO
+PROMPT_RESUMO = """Você resume conversas de WhatsApp entre uma empresa e um lead (potencial cliente). O resumo substituirá as mensagens antigas em análises futuras do andamento da negociação, então não pode perder nada relevante para isso.
+
+Você receberá opcionalmente RESUMO_ANTERIOR (resumo das mensagens mais antigas) e, em seguida, MENSAGENS (as mensagens seguintes, em ordem cronológica). Gere um único resumo atualizado cobrindo tudo.
+
+O resumo deve:
+- Ser factual e em ordem cronológica, com as datas dos marcos importantes.
+- Preservar: nome do lead, produtos/serviços de interesse, valores e orçamentos citados (e quem os informou), objeções, prazos e compromissos, sinais de fechamento, de desistência ou de perda de interesse, e quem deixou de responder a quem.
+- Deixar claro quem disse o quê (EMPRESA ou LEAD).
+- Ter no máximo 300 palavras, sem opiniões nem classificação de status.
+
+Responda SEMPRE em JSON no formato {"resumo": "texto do resumo"}.
+"""
+
 
 
 # ================================================================================================================================================================================
@@ -143,59 +331,103 @@ async def checa_se_esta_dentro_do_horario():
         time(9, 0) <= hora_atual <= time(19, 0)                
     )
     return dentro_do_horario
+
+
+def inicio_proximo_horario_comercial(agora=None):
+    """Próximo seg-sex 9h (mesma janela de checa_se_esta_dentro_do_horario)."""
+    agora = agora or datetime.now()
+    inicio = datetime.combine(agora.date(), time(9, 0))
+    if inicio <= agora:
+        inicio += timedelta(days=1)
+    while inicio.weekday() > 4:
+        inicio += timedelta(days=1)
+    return inicio
     
     
 # ================================================================================================================================================================================
-# LIMITAR HISTÓRICO DE CONVERSAS A N CARACTERES
+# ESTIMADOR DE TOKENS CALIBRADO PELO promptTokenCount DEVOLVIDO PELA GEMINI
 # ================================================================================================================================================================================
-def limitar_mensagens(mensagens_formatadas):
-    """Limita histórico enviado à IA pelo tamanho máximo de contexto do modelo."""
+_calibracao_tokens = {"caracteres_por_token": float(QTD_MEDIA_CARACTERES_POR_TOKEN), "amostras": 0}
 
-    # Define o limite de caracteres baseado no modelo
-    limite_caracteres = (LIMITE_TOKENS_MODELO / QTD_MEDIA_CARACTERES_POR_TOKEN) - 100
 
-    # Junta todas as mensagens em um único texto
-    texto_completo = "\n".join(mensagens_formatadas)
+def estima_tokens(qtd_caracteres):
+    return int(qtd_caracteres / _calibracao_tokens["caracteres_por_token"]) + 1
 
-    # Se o texto completo estiver dentro do limite, retorne-o
-    if len(texto_completo) <= limite_caracteres:
-        return texto_completo
 
-    # Caso contrário, limita as mensagens do fim para o início, considerando somente as linhas que
-    # começam com "EMPRESA" ou "LEAD"
-    linhas_validas = []
-    for linha in reversed(mensagens_formatadas):
-        if linha.startswith("EMPRESA") or linha.startswith("LEAD"):
-            # Insere no início da lista
-            linhas_validas.insert(0, linha)
-            # Verifica se o texto atual excede o limite
-            if len("\n".join(linhas_validas)) > limite_caracteres:
-                linhas_validas.pop(0)  # Remove a mensagem mais antiga, se ultrapassar o limite
-                break
+def calibra_estimador_tokens(qtd_caracteres, prompt_tokens):
+    """Média móvel exponencial de caracteres/token a partir do usageMetadata real de cada chamada."""
+    if not qtd_caracteres or not prompt_tokens:
+        return
+    observado = min(max(qtd_caracteres / prompt_tokens, CALIBRACAO_MIN_CARACTERES_POR_TOKEN), CALIBRACAO_MAX_CARACTERES_POR_TOKEN)
+    if _calibracao_tokens["amostras"] == 0:
+        _calibracao_tokens["caracteres_por_token"] = observado
+    else:
+        _calibracao_tokens["caracteres_por_token"] += CALIBRACAO_TOKENS_ALPHA * (observado - _calibracao_tokens["caracteres_por_token"])
+    _calibracao_tokens["amostras"] += 1
 
-    return "\n".join(linhas_validas)
-    
 
+# ================================================================================================================================================================================
+# LIMITAR HISTÓRICO DE CONVERSAS A N CARACTERES / TOKENS
+# ================================================================================================================================================================================
+def limitar_mensagens(mensagens_formatadas, limite_caracteres=None, limite_tokens=None, politica=None):
+    """
+    Limita histórico enviado à IA pelo tamanho máximo de contexto do modelo, em uma única passada
+    da mensagem mais nova para a mais antiga (contagem acumulada de caracteres e tokens estimados).
+    Política "head_tail": preserva o início da conversa até o 1º contato do lead + as mais recentes.
+    """
+    limite_caracteres = LIMITE_CARACTERES_HISTORICO if limite_caracteres is None else limite_caracteres
+    limite_tokens = LIMITE_TOKENS_HISTORICO if limite_tokens is None else limite_tokens
+    politica = POLITICA_TRUNCAMENTO if politica is None else politica
+
+    # Caminho rápido: soma dos tamanhos (+ separadores) sem montar o texto
+    total_caracteres = sum(len(linha) for linha in mensagens_formatadas) + max(len(mensagens_formatadas) - 1, 0)
+    if total_caracteres <= limite_caracteres and estima_tokens(total_caracteres) <= limite_tokens:
+        return "\n".join(mensagens_formatadas)
+
+    # Caso contrário, considera somente as linhas que começam com "EMPRESA" ou "LEAD" (ou "[", cabeçalho de dia dos perfis compactos)
+    linhas_validas = [linha for linha in mensagens_formatadas if linha.startswith(("EMPRESA", "LEAD", "["))]
+
+    # Início preservado (head_tail): mensagens até o 1º contato do lead, limitado a TRUNCAMENTO_MAX_MSGS_INICIO
+    inicio = []
+    if politica == "head_tail":
+        for linha in linhas_validas[:TRUNCAMENTO_MAX_MSGS_INICIO]:
+            inicio.append(linha)
+            if linha.startswith("LEAD"):
+                break
 
-# Normaliza textos para comparação de keywords: remove acentos, pontuação e emojis,
-# mantém apenas letras, números e espaços, e colapsa múltiplos espaços.
-def normaliza_texto_para_kw(texto):
-    """Remove acentos/pontuação para comparação de keywords insensível a caso/acentos."""
-    if not texto:
-        return ""
-    texto = unicodedata.normalize("NFKD", texto)
-    partes = []
-    for ch in texto.lower():
-        categoria = unicodedata.category(ch)
-        if categoria.startswith("L") or categoria.startswith("N"):
-            partes.append(ch)
-        elif ch.isspace():
-            partes.append(" ")
-        else:
-            partes.append(" ")
-    texto_normalizado = "".join(partes)
-    texto_normalizado = re.sub(r"\s+", " ", texto_normalizado).strip()
-    return texto_normalizado
+    # reserva espaço para a linha "[... N mensagens omitidas ...]"
+    usados = sum(len(linha) + 1 for linha in inicio) + (40 if inicio else 0)
+    if usados > limite_caracteres or estima_tokens(usados) > limite_tokens:
+        inicio, usados = [], 0
+
+    # Fim: da mais nova para a mais antiga até estourar o orçamento restante. Nos perfis compactos o dia vem num
+    # cabeçalho "[dd/mm/yyyy]" separado: cada linha reserva espaço para o seu, reemitido antes do 1º bloco mantido
+    candidatas = linhas_validas[len(inicio):]
+    cabecalhos, cabecalho = [], None
+    for linha in candidatas:
+        if linha.startswith("["):
+            cabecalho = linha
+        cabecalhos.append(cabecalho)
+
+    fim_invertido = []
+    for linha, cabecalho in zip(reversed(candidatas), reversed(cabecalhos)):
+        custo = len(linha) + 1
+        reserva = len(cabecalho) + 1 if cabecalho and not linha.startswith("[") else 0
+        if usados + custo + reserva - 1 > limite_caracteres or estima_tokens(usados + custo + reserva - 1) > limite_tokens:
+            break
+        fim_invertido.append(linha)
+        usados += custo
+    if fim_invertido and not fim_invertido[-1].startswith("["):
+        cabecalho = cabecalhos[len(candidatas) - len(fim_invertido)]
+        if cabecalho:
+            fim_invertido.append(cabecalho)
+    fim_invertido.reverse()
+
+    omitidas = len(linhas_validas) - len(inicio) - len(fim_invertido)
+    if inicio and omitidas > 0:
+        return "\n".join(inicio + [f"[... {omitidas} mensagens omitidas ...]"] + fim_invertido)
+    return "\n".join(inicio + fim_invertido)
+    
 
 
 def to_naive_datetime(dt):
@@ -242,9 +474,138 @@ def extrai_valor_conversao(texto):
 
 
 # ================================================================================================================================================================================
-# CONSULTA LISTA DE INSTANCIAS 
+# CONSULTA LISTA DE INSTANCIAS (ROTAS COMPANY -> EVOLUTION EM CACHE, ATUALIZAÇÃO INCREMENTAL)
 # ================================================================================================================================================================================
-async def consulta_instancias_wpp(db_gateway):
+COMPANY_ID_BRAINCO = "304dc0de-000d-4449-8602-60cc7ab9dbf8"
+
+QUERY_ROTAS_INSTANCIAS_COMPLETA = f"""
+    SELECT DISTINCT ON (company_id)
+      company_id,
+      json_raw::json->>'instanceHost' AS instance_host,
+      json_raw::json->>'instanceNode' AS instance_node,
+      MAX({{alterado_em}}) OVER () AS watermark
+    FROM "instance"
+    WHERE company_id IS NOT NULL
+      AND company_id != '{COMPANY_ID_BRAINCO}'    -- BRAINCO
+      -- AND company_id = '00b4190c-9c5f-4afe-aaf7-47bbd9d5356f'     -- CREATTIVE
+    ORDER BY company_id, created_at DESC, id DESC
+"""
+
+# só companies com instância criada/alterada desde o watermark; JSON parseado apenas da instância mais recente delas
+QUERY_ROTAS_INSTANCIAS_INCREMENTAL = f"""
+    WITH alteradas AS (
+      SELECT company_id, {{alterado_em}} AS alterado_em
+      FROM "instance"
+      WHERE company_id IS NOT NULL
+        AND company_id != '{COMPANY_ID_BRAINCO}'    -- BRAINCO
+        AND {{alterado_em}} >= :desde
+    )
+    SELECT DISTINCT ON (i.company_id)
+      i.company_id,
+      i.json_raw::json->>'instanceHost' AS instance_host,
+      i.json_raw::json->>'instanceNode' AS instance_node,
+      (SELECT MAX(alterado_em) FROM alteradas) AS watermark
+    FROM "instance" i
+    WHERE i.company_id IN (SELECT company_id FROM alteradas)
+    ORDER BY i.company_id, i.created_at DESC, i.id DESC
+"""
+
+
+# "instance".updated_at nem sempre existe no gateway: detectado 1x via information_schema; sem ela o watermark é só
+# por created_at (instâncias novas entram no incremental; alteração de host/node de instância existente só na recarga completa do TTL)
+EXPR_ALTERADO_EM_COM_UPDATED_AT = "COALESCE(updated_at, created_at)"
+EXPR_ALTERADO_EM_SEM_UPDATED_AT = "created_at"
+
+
+async def detecta_expr_alterado_em(db_gateway):
+    async with db_gateway.connection() as conn:
+        row = await asyncio.wait_for(
+            conn.fetch_one(
+                query="""
+                    SELECT EXISTS (
+                        SELECT 1
+                        FROM information_schema.columns
+                        WHERE table_schema = current_schema()
+                          AND table_name = 'instance'
+                          AND column_name = 'updated_at'
+                    ) AS tem_updated_at
+                """
+            ),
+            timeout=30
+        )
+    if row and row["tem_updated_at"]:
+        return EXPR_ALTERADO_EM_COM_UPDATED_AT
+    logger.warning('"instance".updated_at não existe: rotas de instâncias com watermark só por created_at')
+    return EXPR_ALTERADO_EM_SEM_UPDATED_AT
+
+
+def rota_da_instancia(instance_host, instance_node):
+    """(evo_db_host, evo_db_name) a partir de instanceHost/instanceNode do json_raw."""
+    instance_node = instance_node.strip() if instance_node else None
+    instance_host = instance_host.strip() if instance_host else None
+
+    # Fallback do host conforme regras
+    if not instance_host:
+        instance_host = "db-evolution-intances-v1-do-user-16037229-0.i"
+
+    # Deriva o nome do DB a partir do node (mantendo tua lógica atual)
+    if not instance_node:
+        evo_db_name = "defaultdb"
+    else:
+        node_suffix = instance_node.split(".")[-1]  # ex: v1.n2 -> "n2"
+        evo_db_name = f"evolution_{node_suffix}"
+
+    return instance_host, evo_db_name
+
+
+def forca_atualizacao_rotas_instancias():
+    """Próxima consulta_instancias_wpp recarrega todas as rotas (ex.: falha ao conectar num host do cache)."""
+    _rotas_instancias["forcar"] = True
+
+
+async def atualiza_rotas_instancias(db_gateway, forca_atualizacao=False):
+    agora = asyncio.get_running_loop().time()
+    carregado_em = _rotas_instancias["carregado_em"]
+    completa = (
+        forca_atualizacao
+        or _rotas_instancias["forcar"]
+        or _rotas_instancias["watermark"] is None
+        or carregado_em is None
+        or agora - carregado_em >= ROTAS_INSTANCIAS_TTL
+    )
+
+    if _rotas_instancias["expr_alterado_em"] is None:
+        _rotas_instancias["expr_alterado_em"] = await detecta_expr_alterado_em(db_gateway)
+    alterado_em = _rotas_instancias["expr_alterado_em"]
+
+    if completa:
+        query, values = QUERY_ROTAS_INSTANCIAS_COMPLETA.format(alterado_em=alterado_em), {}
+    else:
+        query = QUERY_ROTAS_INSTANCIAS_INCREMENTAL.format(alterado_em=alterado_em)
+        values = {"desde": _rotas_instancias["watermark"] - ROTAS_INSTANCIAS_SOBREPOSICAO}
+
+    async with db_gateway.connection() as conn:
+        rows = await asyncio.wait_for(
+            conn.fetch_all(query=query, values=values),
+            timeout=30
+        )
+
+    rotas = {} if completa else _rotas_instancias["por_company"]
+    for row in rows:
+        rotas[str(row["company_id"])] = rota_da_instancia(row["instance_host"], row["instance_node"])
+        if row["watermark"] is not None:
+            _rotas_instancias["watermark"] = row["watermark"]
+
+    _rotas_instancias["por_company"] = rotas
+    if completa:
+        _rotas_instancias["carregado_em"] = agora
+        _rotas_instancias["forcar"] = False
+        logger.info(f"Rotas de instâncias recarregadas: {len(rotas)} companies")
+    elif rows:
+        logger.info(f"Rotas de instâncias atualizadas: {len(rows)} companies alteradas")
+
+
+async def consulta_instancias_wpp(db_gateway, forca_atualizacao=False):
     """
     Consulta todas as companies e suas instâncias associadas,
     retornando agrupadas no formato esperado:
@@ -253,54 +614,24 @@ async def consulta_instancias_wpp(db_gateway):
         {"evo_db_host": "db-evolution-intances-v1", "evo_db_name": "evolution_n4", "companies_ids": [4, 5]},
         ...
     ]
+    As rotas vêm do cache (_rotas_instancias); se a atualização falhar, segue com o cache anterior.
     """
     # -------------------------------------------------------------------
-    # 1. Query: busca todas as instâncias válidas
+    # 1. Atualiza o cache de rotas (incremental ou completo)
     # -------------------------------------------------------------------
-    query_gateway = """
-        SELECT *
-        FROM (
-          SELECT DISTINCT ON (company_id)
-            company_id,
-            json_raw::json->>'instanceHost' AS instance_host,
-            json_raw::json->>'instanceNode' AS instance_node
-          FROM "instance"
-          WHERE company_id IS NOT NULL
-            AND company_id != '304dc0de-000d-4449-8602-60cc7ab9dbf8'    -- BRAINCO
-            -- AND company_id = '00b4190c-9c5f-4afe-aaf7-47bbd9d5356f'     -- CREATTIVE
-          ORDER BY company_id, created_at DESC, id DESC
-        ) t
-        ORDER BY instance_host NULLS LAST, instance_node NULLS LAST
-    """
-
-    async with db_gateway.connection() as conn:
-        rows = await asyncio.wait_for(
-            conn.fetch_all(query=query_gateway),
-            timeout=30
-        )
+    try:
+        await atualiza_rotas_instancias(db_gateway, forca_atualizacao)
+    except Exception as e:
+        if not _rotas_instancias["por_company"]:
+            raise
+        logger.error(f"Erro ao atualizar rotas de instâncias, usando cache anterior: {e}")
 
     # -------------------------------------------------------------------
-    # 2. Normaliza resultados e agrupa por (host, nome do banco)
+    # 2. Agrupa por (host, nome do banco)
     # -------------------------------------------------------------------
     agrupado = {}  # chave: (evo_db_host, evo_db_name) -> lista de company_id
 
-    for row in rows:
-        company_id = str(row["company_id"])
-        instance_node = (row["instance_node"] or "").strip() if row["instance_node"] else None
-        instance_host = (row["instance_host"] or "").strip() if row["instance_host"] else None
-
-        # Fallback do host conforme regras
-        if not instance_host:
-            instance_host = "db-evolution-intances-v1-do-user-16037229-0.i"
-
-        # Deriva o nome do DB a partir do node (mantendo tua lógica atual)
-        if not instance_node:
-            evo_db_name = "defaultdb"
-        else:
-            node_suffix = instance_node.split(".")[-1]  # ex: v1.n2 -> "n2"
-            evo_db_name = f"evolution_{node_suffix}"
-
-        chave = (instance_host, evo_db_name)
+    for company_id, chave in _rotas_instancias["por_company"].items():
         agrupado.setdefault(chave, []).append(company_id)
 
     # -------------------------------------------------------------------
@@ -310,9 +641,9 @@ async def consulta_instancias_wpp(db_gateway):
         {
             "evo_db_host": host,
             "evo_db_name": dbname,
-            "companies_ids": companies
+            "companies_ids": sorted(agrupado[(host, dbname)])
         }
-        for (host, dbname), companies in agrupado.items()
+        for host, dbname in sorted(agrupado)
     ]
 
     # Caso nenhuma instância encontrada
@@ -324,16 +655,31 @@ async def consulta_instancias_wpp(db_gateway):
         }]
 
     return instancias_companies
-    
+
 
 # ================================================================================================================================================================================
 # PROVISÓRIO - QUERY PRA GARANTIR QUE USER MICROSERVICE TENHA AUTH EM TODAS COMPANIES
 # ================================================================================================================================================================================
 async def add_user_microservice_companies(db_core):
+    """
+    Garante o user microservice como admin em todas as companies. Reconciliação completa (anti-join em
+    todas as companies) no primeiro ciclo e a cada MICROSERVICE_RECONCILIACAO_INTERVALO; nos demais ciclos
+    só olha companies criadas a partir do maior company.created_at já coberto (menos uma sobreposição).
+    """
 
     user_id_microservice = "49e3a5ec-24a2-4ce4-b707-6ddbec07d8f0"
 
-    query = """
+    agora = asyncio.get_running_loop().time()
+    ultima_reconciliacao = _vinculo_microservice["ultima_reconciliacao"]
+    completo = (
+        _vinculo_microservice["watermark"] is None
+        or ultima_reconciliacao is None
+        or agora - ultima_reconciliacao >= MICROSERVICE_RECONCILIACAO_INTERVALO
+    )
+
+    filtro_incremental = "" if completo else "AND c.created_at >= :desde"
+
+    query = f"""
         INSERT INTO user_role_company (user_id, company_id, user_role)
         SELECT
             :user_id,
@@ -343,110 +689,162 @@ async def add_user_microservice_companies(db_core):
         LEFT JOIN user_role_company urc
             ON urc.company_id = c.id AND urc.user_id = :user_id
         WHERE urc.company_id IS NULL
+          {filtro_incremental}
         RETURNING company_id;
     """
 
+    values = {"user_id": user_id_microservice}
+    if not completo:
+        values["desde"] = _vinculo_microservice["watermark"] - MICROSERVICE_SOBREPOSICAO_WATERMARK
+
     try:
         async with db_core.connection() as conn:
+            # watermark lido antes do INSERT: company criada durante o comando entra no próximo incremental
+            novo_watermark = await asyncio.wait_for(
+                conn.fetch_val(query="SELECT MAX(created_at) FROM company"),
+                timeout=60
+            )
+
             # Executa e retorna todas as company_id inseridas
             rows = await asyncio.wait_for(
-                conn.fetch_all(query=query, values={"user_id": user_id_microservice}),
+                conn.fetch_all(query=query, values=values),
                 timeout=300
             )
 
-            if not rows:
-                #logger.info("Nenhuma nova empresa precisava ser vinculada ao microservice.")
-                return []
+        if novo_watermark is not None:
+            _vinculo_microservice["watermark"] = novo_watermark
+        if completo:
+            _vinculo_microservice["ultima_reconciliacao"] = agora
+
+        if not rows:
+            #logger.info("Nenhuma nova empresa precisava ser vinculada ao microservice.")
+            return []
 
-            company_ids = [r["company_id"] for r in rows]
-            logger.info(f"Usuário microservice adicionado como admin em {len(company_ids)} empresas.")
-            return company_ids
+        company_ids = [r["company_id"] for r in rows]
+        logger.info(
+            f"Usuário microservice adicionado como admin em {len(company_ids)} empresas "
+            f"({'reconciliação completa' if completo else 'incremental'})."
+        )
+        return company_ids
 
     except Exception as e:
         logger.error(f"Erro ao adicionar microservice nas companies: {e}")
         return []
-        
 
 
 
-    
-        
+
 # ================================================================================================================================================================================
 # CONSULTA LEADS NO DB
 # ================================================================================================================================================================================
-async def consulta_leads_disponiveis_para_classificar(db_core, company_id, max_leads_por_rodada):
-    try:
-        async with db_core.connection() as conn_core:
-            # Query de leads aptos: respeita período, janelas de reexecução e flag da company.
-            query_core = """
-                WITH ult_exec AS (
+# última execução por lead: tabela de estado (lookup indexado) ou, sem ela, DISTINCT ON sobre o histórico
+# ({filtro_company} restringe a 1 company ou à lista de companies da instância)
+ULT_EXEC_ESTADO = """
+                    SELECT
+                        lead_id,
+                        last_execution_date,
+                        last_kw_execution_date,
+                        last_ai_fingerprint,
+                        min_reprocess_interval
+                    FROM lead_analysis_state
+                    WHERE {filtro_company}
+                """
+
+ULT_EXEC_HISTORICO = """
                     SELECT DISTINCT ON (lead_id)
                         lead_id,
                         execution_date AS last_execution_date,
                         execution_date_kw AS last_kw_execution_date,
+                        metadata->>'ai_fingerprint' AS last_ai_fingerprint,
                         CASE
                             WHEN message_sent_date IS NOT NULL AND response_date IS NULL THEN INTERVAL '24 hours'
                             ELSE INTERVAL '9 hours'
                         END AS min_reprocess_interval
                     FROM lead_status_transition
-                    WHERE company_id = :company_id
+                    WHERE {filtro_company}
                     ORDER BY lead_id, execution_date DESC
+                """
+
+FILTRO_COMPANY = "company_id = :company_id"
+FILTRO_COMPANIES = "company_id = ANY(CAST(:companies_ids AS uuid[]))"
+
+
+def monta_query_leads_elegiveis(filtro_company):
+    """
+    Query de leads aptos: respeita período, janelas de reexecução e flag da company.
+    Limite de MAX_LEADS_POR_RODADA aplicado por company (ROW_NUMBER particionado), de modo que a mesma
+    query serve para 1 company ou para todas as companies de uma instância.
+    """
+    ult_exec = (ULT_EXEC_ESTADO if _estado_leads["ativo"] else ULT_EXEC_HISTORICO).format(filtro_company=filtro_company)
+    return f"""
+                WITH ult_exec AS ({ult_exec}),
+                elegiveis AS (
+                    SELECT
+                        l.company_id AS company_id,
+                        (c.metadata->>'service_ai_config_phonenumber') AS tel_resp_company,
+                        c.business_context AS business_context,
+                        COALESCE((c.metadata->>'ai_analysis_period')::int, 30) AS ai_analysis_period,
+                        l.id AS lead_id,
+                        l.phone AS tel_lead,
+                        l.lid AS lid,
+                        s.status AS pre_status_name,
+                        s.id AS pre_status_id,
+                        s.code AS pre_status_code,
+                        u.last_execution_date,
+                        u.last_kw_execution_date,
+                        u.last_ai_fingerprint,
+                        l.created_at AS dt_abertura_lead,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY l.company_id ORDER BY u.last_execution_date ASC NULLS FIRST
+                        ) AS posicao_company,
+                        COUNT(*) OVER (PARTITION BY l.company_id) AS total_elegiveis
+                    FROM lead l
+                    JOIN company c ON l.company_id = c.id
+                    JOIN lead_status ls ON l.id = ls.lead_id
+                    JOIN status s ON ls.status_id = s.id
+                    LEFT JOIN ult_exec u ON l.id = u.lead_id
+                    WHERE l.{filtro_company}
+                      AND (
+                            (c.metadata->>'service_ai_config_only_tracked') = 'false'
+                            OR l.source IN ('METAADS_SITE', 'METAADS_MSG', 'GOOGLE_SITE')
+                          )
+                      -- AND l.source IN ('METAADS_SITE', 'METAADS_MSG', 'GOOGLE_SITE')
+                      AND s.code NOT IN ('END_WON', 'END_LOST')
+                      AND (c.metadata->>'status_transition_auto') = 'true'
+                      AND COALESCE((c.metadata->>'disabled')::boolean, false) = false
+                      AND (c.metadata->>'service_ai_config_phonenumber') IS NOT NULL
+                      AND (
+                            (l.phone IS NOT NULL AND trim(l.phone) <> '')
+                            OR (l.lid IS NOT NULL AND trim(l.lid) <> '')
+                          )
+                      AND (
+                            (u.last_execution_date IS NULL AND l.created_at < NOW() - INTERVAL '3 hours')
+                            OR (
+                                u.last_execution_date IS NOT NULL
+                                AND u.last_execution_date < NOW() - u.min_reprocess_interval
+                            )
+                          )
+                      AND l.created_at >= NOW() - (
+                            COALESCE((c.metadata->>'ai_analysis_period')::int, 30) * INTERVAL '1 day'
+                          )
                 )
-                SELECT
-                    l.company_id AS company_id,
-                    (c.metadata->>'service_ai_config_phonenumber') AS tel_resp_company,
-                    c.business_context AS business_context,
-                    COALESCE((c.metadata->>'ai_analysis_period')::int, 30) AS ai_analysis_period,
-                    l.id AS lead_id,
-                    l.phone AS tel_lead,
-                    l.lid AS lid,
-                    s.status AS pre_status_name,
-                    s.id AS pre_status_id,
-                    s.code AS pre_status_code,
-                    u.last_execution_date,
-                    u.last_kw_execution_date,
-                    l.created_at AS dt_abertura_lead
-                FROM lead l
-                JOIN company c ON l.company_id = c.id
-                JOIN lead_status ls ON l.id = ls.lead_id
-                JOIN status s ON ls.status_id = s.id
-                LEFT JOIN ult_exec u ON l.id = u.lead_id
-                WHERE l.company_id = :company_id
-                  AND (
-                        (c.metadata->>'service_ai_config_only_tracked') = 'false'
-                        OR l.source IN ('METAADS_SITE', 'METAADS_MSG', 'GOOGLE_SITE')
-                      )
-                  -- AND l.source IN ('METAADS_SITE', 'METAADS_MSG', 'GOOGLE_SITE')
-                  AND s.code NOT IN ('END_WON', 'END_LOST')
-                  AND (c.metadata->>'status_transition_auto') = 'true'
-                  AND COALESCE((c.metadata->>'disabled')::boolean, false) = false
-                  AND (c.metadata->>'service_ai_config_phonenumber') IS NOT NULL
-                  AND (
-                        (l.phone IS NOT NULL AND trim(l.phone) <> '')
-                        OR (l.lid IS NOT NULL AND trim(l.lid) <> '')
-                      )
-                  AND (
-                        (u.last_execution_date IS NULL AND l.created_at < NOW() - INTERVAL '3 hours')
-                        OR (
-                            u.last_execution_date IS NOT NULL
-                            AND u.last_execution_date < NOW() - u.min_reprocess_interval
-                        )
-                      )
-                  AND l.created_at >= NOW() - (
-                        COALESCE((c.metadata->>'ai_analysis_period')::int, 30) * INTERVAL '1 day'
-                      )
-                ORDER BY u.last_execution_date ASC NULLS FIRST
-                LIMIT :max_leads_por_rodada;
+                SELECT *
+                FROM elegiveis
+                WHERE posicao_company <= :max_leads_por_rodada
+                ORDER BY company_id, posicao_company;
             """
 
- 
+
+async def consulta_leads_disponiveis_para_classificar(db_core, company_id, max_leads_por_rodada):
+    try:
+        async with db_core.connection() as conn_core:
             values = {
                 "company_id": company_id,
                 "max_leads_por_rodada": max_leads_por_rodada
             }
 
             rows = await asyncio.wait_for(
-                conn_core.fetch_all(query=query_core, values=values),
+                conn_core.fetch_all(query=monta_query_leads_elegiveis(FILTRO_COMPANY), values=values),
                 timeout=300
             )
             return [serializa_metadata(dict(row)) for row in rows]
@@ -454,13 +852,48 @@ async def consulta_leads_disponiveis_para_classificar(db_core, company_id, max_l
     except Exception as e:
         logger.error(f"Erro ao buscar leads disponíveis para classificar: {e}")
         return []
-        
 
-    
+
+# ================================================================================================================================================================================
+# CONSULTA LEADS DISPONÍVEIS DE TODAS AS COMPANIES DA INSTÂNCIA (1 QUERY POR INSTÂNCIA, LIMITE POR COMPANY)
+# ================================================================================================================================================================================
+async def consulta_leads_disponiveis_instancia(db_core, companies_ids, max_leads_por_rodada):
+    """
+    Retorna {company_id: [leads]} com até max_leads_por_rodada leads por company, ou None em caso de erro
+    (quem chama volta para a consulta por company).
+    """
+    companies_ids = [str(c) for c in companies_ids]
+    if not companies_ids:
+        return {}
+
+    try:
+        async with db_core.connection() as conn_core:
+            values = {
+                "companies_ids": companies_ids,
+                "max_leads_por_rodada": max_leads_por_rodada
+            }
+
+            rows = await asyncio.wait_for(
+                conn_core.fetch_all(query=monta_query_leads_elegiveis(FILTRO_COMPANIES), values=values),
+                timeout=300
+            )
+
+        leads_por_company = {company_id: [] for company_id in companies_ids}
+        for row in rows:
+            leads_por_company.setdefault(str(row["company_id"]), []).append(serializa_metadata(dict(row)))
+        return leads_por_company
+
+    except Exception as e:
+        logger.error(f"Erro ao buscar leads disponíveis da instância: {e}")
+        return None
+
+
+
 # ================================================================================================================================================================================
 # BUSCA MENSAGENS LEAD
 # ================================================================================================================================================================================
-async def busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_lead):
+def monta_query_mensagens_lead(company_id, tel_lead, lid, dt_abertura_lead, ordem="ASC"):
+    """(query, values) das mensagens do lead na Evolution, ou (None, None) sem phone/lid."""
 
     # Monta condições de match dinamicamente (phone e/ou lid)
     match_conditions = []
@@ -479,7 +912,7 @@ async def busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_le
         match_conditions.append("a.key->>'remoteJidAlt' = :lid_jid")
 
     if not match_conditions:
-        return []
+        return None, None
 
     match_clause = " OR ".join(match_conditions)
 
@@ -503,8 +936,16 @@ async def busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_le
           AND b."name" = :company_id
           AND ({match_clause})
           AND a."messageTimestamp" > EXTRACT(EPOCH FROM (:dt_abertura_lead AT TIME ZONE 'America/Sao_Paulo'))
-        ORDER BY a."messageTimestamp" ASC
+        ORDER BY a."messageTimestamp" {ordem}, a.id {ordem}
     """
+    return query_evo, values
+
+
+async def busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_lead):
+
+    query_evo, values = monta_query_mensagens_lead(company_id, tel_lead, lid, dt_abertura_lead)
+    if query_evo is None:
+        return []
 
     async with db_evo.connection() as conn:  # pega e devolve conexão
         rows = await asyncio.wait_for(
@@ -512,11 +953,225 @@ async def busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_le
             timeout=300
         )
 
-    return [serializa_metadata(dict(row)) for row in rows]
+    return [MensagemLead.do_registro(row, row["jid_encontrado"]) for row in rows]
+
+
+# ================================================================================================================================================================================
+# BUSCA MENSAGENS LEAD EM STREAMING (CURSOR NO SERVIDOR, MAIS NOVA -> MAIS ANTIGA, PARA AO ENCHER O ORÇAMENTO)
+# ================================================================================================================================================================================
+async def busca_mensagens_lead_streaming(db_evo, company_id, tel_lead, lid, dt_abertura_lead, dt_corte_kw=None,
+                                         limite_caracteres=None, limite_tokens=None):
+    """
+    Mesmo resultado de busca_mensagens_lead (ordem cronológica), mas só materializa as mensagens que cabem no
+    orçamento do prompt (tamanho no perfil do codificador ativo, ver OrcamentoCodificado; política "tail"), mais
+    uma para limitar_mensagens perceber o corte. Depois de cheio o orçamento, continua só enquanto houver mensagens da EMPRESA posteriores
+    a dt_corte_kw (janela das keywords), guardando apenas essas; a primeira mensagem anterior ao corte encerra o cursor.
+    """
+    limite_caracteres = LIMITE_CARACTERES_HISTORICO if limite_caracteres is None else limite_caracteres
+    limite_tokens = LIMITE_TOKENS_HISTORICO if limite_tokens is None else limite_tokens
+    dt_corte_kw = to_naive_datetime(dt_corte_kw)
+
+    query_evo, values = monta_query_mensagens_lead(company_id, tel_lead, lid, dt_abertura_lead, ordem="DESC")
+    if query_evo is None:
+        return []
+
+    mensagens_invertidas = []
+    orcamento = OrcamentoCodificado(CODIFICADOR_CONVERSA_PERFIL)
+
+    async def consome_cursor():
+        orcamento_cheio = False
+        async with db_evo.connection() as conn:
+            async for row in conn.iterate(query=query_evo, values=values):
+                if orcamento_cheio:
+                    data_hora = to_naive_datetime(row["data_hora"])
+                    if dt_corte_kw is None or data_hora is None or data_hora <= dt_corte_kw:
+                        break
+                    if row["de"] == "EMPRESA":
+                        mensagens_invertidas.append(MensagemLead.do_registro(row, row["jid_encontrado"]))
+                    continue
+
+                mensagem = MensagemLead.do_registro(row, row["jid_encontrado"])
+                mensagens_invertidas.append(mensagem)
+                usados = orcamento.adiciona(mensagem)
+                if usados - 1 > limite_caracteres or estima_tokens(usados - 1) > limite_tokens:
+                    orcamento_cheio = True
+
+    await asyncio.wait_for(consome_cursor(), timeout=300)
+
+    mensagens_invertidas.reverse()
+    return mensagens_invertidas
+
+
+# ================================================================================================================================================================================
+# BUSCA IDS DA INSTANCIA EVOLUTION DA COMPANY (1x POR COMPANY)
+# ================================================================================================================================================================================
+async def busca_ids_instancia_evo(db_evo, company_id):
+    query_evo = """
+        SELECT id
+        FROM "Instance"
+        WHERE "name" = :company_id
+    """
+    async with db_evo.connection() as conn:
+        rows = await asyncio.wait_for(
+            conn.fetch_all(query=query_evo, values={"company_id": company_id}),
+            timeout=60
+        )
+    return [str(row["id"]) for row in rows]
+
+
+def jids_do_lead(tel_lead, lid):
+    """JIDs possíveis do lead na Evolution (telefone e/ou lid)."""
+    jids = []
+    if tel_lead and str(tel_lead).strip():
+        jids.append(f"{tel_lead}@s.whatsapp.net")
+    if lid and str(lid).strip():
+        jids.append(f"{lid}@lid")
+    return jids
+
+
+def epoch_abertura_lead(dt_abertura_lead):
+    """Equivalente em Python a EXTRACT(EPOCH FROM (:dt_abertura_lead AT TIME ZONE 'America/Sao_Paulo'))."""
+    if dt_abertura_lead is None:
+        return 0
+    if isinstance(dt_abertura_lead, str):
+        dt_abertura_lead = datetime.fromisoformat(dt_abertura_lead)
+    if dt_abertura_lead.tzinfo is None:
+        return dt_abertura_lead.replace(tzinfo=FUSO_EVOLUTION).timestamp()
+    return dt_abertura_lead.astimezone(FUSO_EVOLUTION).replace(tzinfo=timezone.utc).timestamp()
+
+
+# ================================================================================================================================================================================
+# BUSCA MENSAGENS DE UM LOTE DE LEADS (1 QUERY POR LOTE)
+# ================================================================================================================================================================================
+async def busca_mensagens_leads_lote(db_evo, instance_ids, leads_infos, cortes_por_lead=None):
+    """
+    Busca as conversas de vários leads da mesma company numa única query (array de JIDs)
+    e separa as linhas por lead_id em Python. Retorna {lead_id: [mensagens]}.
+    cortes_por_lead: {lead_id: menor messageTimestamp (inclusivo)}; sem corte usa a abertura do lead.
+    """
+    cortes_por_lead = cortes_por_lead or {}
+    mensagens_por_lead = {lead_info.get("lead_id"): [] for lead_info in leads_infos}
+
+    # jid -> leads e corte (messageTimestamp mínimo, inclusivo) por lead
+    leads_por_jid = {}
+    corte_por_lead = {}
+    for lead_info in leads_infos:
+        lead_id = lead_info.get("lead_id")
+        corte = cortes_por_lead.get(lead_id)
+        if corte is None:
+            # messageTimestamp é inteiro: "> abertura" equivale a ">= floor(abertura) + 1"
+            corte = int(epoch_abertura_lead(lead_info.get("dt_abertura_lead"))) + 1
+        corte_por_lead[lead_id] = corte
+        for jid in jids_do_lead(lead_info.get("tel_lead"), lead_info.get("lid")):
+            leads_por_jid.setdefault(jid, []).append(lead_id)
+
+    if not instance_ids or not leads_por_jid:
+        return mensagens_por_lead
+
+    jids = list(leads_por_jid)
+    cortes_jids = [min(corte_por_lead[lead_id] for lead_id in leads_por_jid[jid]) for jid in jids]
+
+    query_evo = """
+        SELECT
+            a.id AS message_id,
+            CASE
+                WHEN (a.key->>'fromMe') = 'true' THEN 'EMPRESA'
+                ELSE 'LEAD'
+            END AS de,
+            to_timestamp(a."messageTimestamp") AT TIME ZONE 'America/Sao_Paulo' AS data_hora,
+            a.message->>'conversation' AS mensagem,
+            a.key->>'remoteJid' AS remote_jid,
+            a.key->>'remoteJidAlt' AS remote_jid_alt,
+            a."messageTimestamp" AS message_timestamp
+        FROM "Message" a
+        WHERE a."instanceId" = ANY(CAST(:instance_ids AS text[]))
+          AND a."messageType" = 'conversation'
+          AND a.message->>'conversation' IS NOT NULL
+          AND (
+                a.key->>'remoteJid' = ANY(CAST(:jids AS text[]))
+                OR a.key->>'remoteJidAlt' = ANY(CAST(:jids AS text[]))
+              )
+          AND a."messageTimestamp" >= :corte_min
+          AND EXISTS (
+                SELECT 1
+                FROM unnest(CAST(:jids AS text[]), CAST(:cortes AS bigint[])) AS c(jid, corte)
+                WHERE (a.key->>'remoteJid' = c.jid OR a.key->>'remoteJidAlt' = c.jid)
+                  AND a."messageTimestamp" >= c.corte
+              )
+        ORDER BY a."messageTimestamp" ASC, a.id ASC
+    """
+    values = {
+        "instance_ids": list(instance_ids),
+        "jids": jids,
+        "cortes": cortes_jids,
+        "corte_min": min(cortes_jids),
+    }
+
+    async with db_evo.connection() as conn:
+        rows = await asyncio.wait_for(
+            conn.fetch_all(query=query_evo, values=values),
+            timeout=300
+        )
+
+    for row in rows:
+        remote_jid = row["remote_jid"]
+        remote_jid_alt = row["remote_jid_alt"]
+        leads_da_linha = set(leads_por_jid.get(remote_jid, ())) | set(leads_por_jid.get(remote_jid_alt, ()))
+        if not leads_da_linha:
+            continue
+        mensagem = MensagemLead.do_registro(row, remote_jid or remote_jid_alt, com_ids=True)
+        for lead_id in leads_da_linha:
+            if mensagem.message_timestamp >= corte_por_lead[lead_id]:
+                mensagens_por_lead[lead_id].append(mensagem)
+
+    return mensagens_por_lead
+
+
+# ================================================================================================================================================================================
+# BUSCA INCREMENTAL: SÓ MENSAGENS APÓS O WATERMARK DO STORE LOCAL + MESCLA COM O HISTÓRICO SALVO
+# ================================================================================================================================================================================
+async def busca_mensagens_leads_incremental(db_evo, instance_ids, leads_infos):
+    """
+    Com o store local ativo, busca na Evolution apenas mensagens com messageTimestamp >= último
+    visto por lead (o próprio segundo do watermark é rebuscado; duplicadas são ignoradas pelo message_id).
+    Sem store, equivale a busca_mensagens_leads_lote.
+    """
+    if not conversas_locais_ativas():
+        return await busca_mensagens_leads_lote(db_evo, instance_ids, leads_infos)
+
+    lead_ids = [lead_info.get("lead_id") for lead_info in leads_infos]
+    watermarks = await asyncio.to_thread(carrega_watermarks, lead_ids)
+
+    mensagens_novas_por_lead = await busca_mensagens_leads_lote(db_evo, instance_ids, leads_infos, watermarks)
+
+    mensagens_por_lead = {}
+    for lead_info in leads_infos:
+        lead_id = lead_info.get("lead_id")
+        lead_store = {
+            "lead_id": lead_id,
+            "company_id": lead_info.get("company_id"),
+            "dt_abertura_epoch": epoch_abertura_lead(lead_info.get("dt_abertura_lead")),
+            "ai_analysis_period": lead_info.get("ai_analysis_period"),
+        }
+        mensagens_por_lead[lead_id] = await asyncio.to_thread(
+            mescla_e_carrega, lead_store, mensagens_novas_por_lead.get(lead_id, [])
+        )
+
+    return mensagens_por_lead
+
+
+# ================================================================================================================================================================================
+# DESCARTA CONVERSA LOCAL DE LEAD FINALIZADO
+# ================================================================================================================================================================================
+async def descarta_conversa_local(lead_id, status_code):
+    if status_code not in ("END_WON", "END_LOST") or not conversas_locais_ativas():
+        return
+    try:
+        await asyncio.to_thread(remove_leads, [lead_id])
+    except Exception as e:
+        logger.warning(f"Erro ao remover conversa local do lead {lead_id}: {e}")
 
 
-    
-    
 # ================================================================================================================================================================================
 # CONSULTA ID DO STATUS SUGERIDO PELA AI
 # ================================================================================================================================================================================
@@ -560,13 +1215,9 @@ async def consulta_id_status(db_core, company_id, status_value, tipo_status):
         
       
 # ================================================================================================================================================================================
-# BUSCA CONFIGS DE STATUS - TRAZ SOMENTE STATUS PERMITIDOS PARA A AI UTILIZAR
+# COLUNAS NORMALIZADAS DAS CONFIGS DE STATUS (USADAS POR busca_status_configs E PELO CATÁLOGO)
 # ================================================================================================================================================================================
-async def busca_status_configs(db_core, company_id):
-    try:
-        query = """
-            WITH norm AS (
-              SELECT
+COLUNAS_STATUS_CONFIG = """
                 status AS status_name,
                 code   AS status_code,
                 status_ai_identification AS status_description,
@@ -621,7 +1272,17 @@ async def busca_status_configs(db_core, company_id):
                   END,
                   FALSE
                 ) AS kw_analysis,
-                metadata->>'kwKeyphrase' AS kw_keyphrase
+                metadata->>'kwKeyphrase' AS kw_keyphrase"""
+
+
+# ================================================================================================================================================================================
+# BUSCA CONFIGS DE STATUS - TRAZ SOMENTE STATUS PERMITIDOS PARA A AI UTILIZAR
+# ================================================================================================================================================================================
+async def busca_status_configs(db_core, company_id):
+    try:
+        query = f"""
+            WITH norm AS (
+              SELECT{COLUNAS_STATUS_CONFIG}
               FROM status
               WHERE company_id = :company_id
                 AND code IS DISTINCT FROM 'LEAD_START'
@@ -664,19 +1325,144 @@ async def busca_status_configs(db_core, company_id):
                 "kw_keyphrase": row["kw_keyphrase"],
             })
 
-        return result
+        return result
+
+    except Exception as e:
+        logger.exception(f"Erro ao buscar status configs para a empresa {company_id}: {e}")
+        return []
+        
+        
+        
+        
+# ================================================================================================================================================================================
+# CATÁLOGO DE STATUS EM MEMÓRIA (TODAS AS COMPANIES) - SUBSTITUI busca_status_configs / consulta_id_status POR LEAD
+# ================================================================================================================================================================================
+# company_id -> {"assinatura": (max updated_at, qtd), "configs": [...], "id_por_nome": {}, "id_por_codigo": {}}
+_catalogo_status = {}
+
+
+async def atualiza_catalogo_status(db_core, companies_ids):
+    """
+    Carrega o catálogo de status das companies em 2 queries por ciclo: assinatura (MAX(updated_at), COUNT)
+    de todas e configs completas só das companies cuja assinatura mudou.
+    """
+    companies_ids = [str(c) for c in companies_ids]
+    if not companies_ids:
+        return 0
+
+    try:
+        query_assinatura = """
+            SELECT company_id, MAX(updated_at) AS max_updated_at, COUNT(*) AS qtd
+            FROM status
+            WHERE company_id = ANY(CAST(:companies_ids AS uuid[]))
+            GROUP BY company_id
+        """
+        async with db_core.connection() as conn:
+            rows = await asyncio.wait_for(
+                conn.fetch_all(query=query_assinatura, values={"companies_ids": companies_ids}),
+                timeout=300
+            )
+
+        assinaturas = {str(row["company_id"]): (row["max_updated_at"], row["qtd"]) for row in rows}
+
+        # companies sem status deixam de ter catálogo
+        for company_id in companies_ids:
+            if company_id not in assinaturas:
+                _catalogo_status[company_id] = {"assinatura": None, "configs": [], "id_por_nome": {}, "id_por_codigo": {}}
+
+        alteradas = [
+            company_id for company_id, assinatura in assinaturas.items()
+            if _catalogo_status.get(company_id, {}).get("assinatura") != assinatura
+        ]
+        if not alteradas:
+            return 0
+
+        query_configs = f"""
+            SELECT
+              id AS status_id,
+              company_id,{COLUNAS_STATUS_CONFIG}
+            FROM status
+            WHERE company_id = ANY(CAST(:companies_ids AS uuid[]))
+            ORDER BY company_id, id
+        """
+        async with db_core.connection() as conn:
+            rows = await asyncio.wait_for(
+                conn.fetch_all(query=query_configs, values={"companies_ids": alteradas}),
+                timeout=300
+            )
+
+        novos = {
+            company_id: {"assinatura": assinaturas[company_id], "configs": [], "id_por_nome": {}, "id_por_codigo": {}, "_vistos": set()}
+            for company_id in alteradas
+        }
+        for row in rows:
+            catalogo = novos[str(row["company_id"])]
+            status_id = serializa_metadata(row["status_id"])
+            catalogo["id_por_nome"].setdefault(row["status_name"], status_id)
+            catalogo["id_por_codigo"].setdefault(row["status_code"], status_id)
+
+            # mesmas regras de busca_status_configs: sem LEAD_START, só status com IA ou keyword ativas
+            if row["status_code"] == "LEAD_START":
+                continue
+            if row["ai_suggestion"] is False and not row["kw_analysis"]:
+                continue
+            config = {
+                "status_name": row["status_name"],
+                "status_code": row["status_code"],
+                "status_description": row["status_description"],
+                "ai_automation_mode": row["ai_automation_mode"],
+                "ai_suggestion": row["ai_suggestion"],
+                "ai_confidence_level_min_config": row["ai_confidence_level_min_config"],
+                "kw_analysis": row["kw_analysis"],
+                "kw_keyphrase": row["kw_keyphrase"],
+            }
+            chave_config = tuple(config.values())
+            if chave_config in catalogo["_vistos"]:
+                continue
+            catalogo["_vistos"].add(chave_config)
+            catalogo["configs"].append(config)
+
+        for company_id, catalogo in novos.items():
+            catalogo.pop("_vistos")
+            _catalogo_status[company_id] = catalogo
+
+        logger.info(f"Catálogo de status atualizado para {len(alteradas)} companies")
+        return len(alteradas)
 
     except Exception as e:
-        logger.exception(f"Erro ao buscar status configs para a empresa {company_id}: {e}")
-        return []
-        
-        
-        
-        
+        logger.error(f"Erro ao atualizar catálogo de status: {e}")
+        return 0
+
+
+async def obtem_status_configs(db_core, company_id):
+    """Configs de status da company pelo catálogo; fallback para a query por company."""
+    catalogo = _catalogo_status.get(str(company_id))
+    if catalogo is not None:
+        return catalogo["configs"]
+    return await busca_status_configs(db_core, company_id)
+
+
+async def obtem_id_status(db_core, company_id, status_value, tipo_status):
+    """ID do status pelo catálogo (por nome ou código); fallback para consulta_id_status."""
+    catalogo = _catalogo_status.get(str(company_id))
+    if catalogo is not None:
+        indice = catalogo["id_por_codigo"] if tipo_status == "status_code" else catalogo["id_por_nome"]
+        status_id = indice.get(status_value)
+        if status_id is not None:
+            return status_id
+    return await consulta_id_status(db_core, company_id, status_value, tipo_status)
+
+
 # ================================================================================================================================================================================
 # INSERE REGISTRO NA TB DE TRACKING
 # ================================================================================================================================================================================
-async def insere_registro_ai_tracking(db_core, company_id, lead_id, execution_date, execution_date_ai, execution_date_kw, message_schedule_date, metadata):
+COLUNAS_TRACKING = (
+    "company_id", "lead_id", "execution_date", "pre_status", "sugested_status_ai", "execution_date_ai",
+    "execution_date_kw", "message_schedule_date", "message_status", "pos_status_kw", "metadata",
+)
+
+
+def monta_valores_tracking(company_id, lead_id, execution_date, execution_date_ai, execution_date_kw, message_schedule_date, metadata):
     
     # PARA SALVAR NA TB DE TRACKING USA OS NAMES AO INVÉS DE CODES OU IDS
     pre_status = metadata.get("pre_status_name")
@@ -694,75 +1480,228 @@ async def insere_registro_ai_tracking(db_core, company_id, lead_id, execution_da
     else:
         message_status = None
 
+    return {
+        "company_id": company_id,
+        "lead_id": lead_id,
+        "execution_date": execution_date,
+        "pre_status": pre_status,
+        "sugested_status_ai": sugested_status_ai,
+        "execution_date_ai": execution_date_ai,
+        "execution_date_kw": execution_date_kw,
+        "message_schedule_date": message_schedule_date,
+        "message_status": message_status,
+        "pos_status_kw": pos_status_kw,
+        "metadata": json.dumps(serializa_metadata(metadata), ensure_ascii=False)
+    }
+
+
+async def verifica_estado_leads(db_core):
+    """Liga o upsert (e, com ESTADO_LEADS_ATIVO, a leitura) assim que lead_analysis_state existir no banco."""
+    if _estado_leads["existe"]:
+        return
     try:
-        query = """
-            INSERT INTO lead_status_transition (
-                company_id,
-                lead_id,
-                execution_date,
-                pre_status,
-                sugested_status_ai,
-                execution_date_ai,
-                execution_date_kw,
-                message_schedule_date,
-                message_status,
-                pos_status_kw,
-                metadata,
-                created_at,
-                updated_at
-            )
-            VALUES (
-                :company_id,
-                :lead_id,
-                :execution_date,
-                :pre_status,
-                :sugested_status_ai,
-                :execution_date_ai,
-                :execution_date_kw,
-                :message_schedule_date,
-                :message_status,
-                :pos_status_kw,
-                CAST(:metadata AS JSONB),
-                NOW(),
-                NOW()
-            )
-            RETURNING id
-        """
+        existe = await estado_leads_existe(db_core)
+    except Exception as e:
+        logger.warning(f"Erro ao verificar lead_analysis_state: {e}")
+        return
+    if existe:
+        _estado_leads["existe"] = True
+        _estado_leads["ativo"] = ESTADO_LEADS_ATIVO
+        logger.info(f"Estado por lead (lead_analysis_state) disponível; leitura na elegibilidade {'ativa' if ESTADO_LEADS_ATIVO else 'desligada'}")
 
-        values = {
-            "company_id": company_id,
-            "lead_id": lead_id,
-            "execution_date": execution_date,
-            "pre_status": pre_status,
-            "sugested_status_ai": sugested_status_ai,
-            "execution_date_ai": execution_date_ai,
-            "execution_date_kw": execution_date_kw,
-            "message_schedule_date": message_schedule_date,
-            "message_status": message_status,
-            "pos_status_kw": pos_status_kw,
-            "metadata": json.dumps(serializa_metadata(metadata), ensure_ascii=False)
-        }
 
-        async with db_core.connection() as conn:  # abre e devolve conexão automaticamente
-            row = await asyncio.wait_for(
-                conn.fetch_one(query=query, values=values),
-                timeout=300
-            )
+def monta_query_insert_tracking(qtd_linhas, com_estado=True):
+    """
+    INSERT de N linhas em lead_status_transition num único comando, com parâmetros nomeados por linha (:campo_N).
+    Cada linha é um INSERT próprio numa CTE (linha_N) e o resultado traz "ordem" = N junto do id: a ordem do RETURNING
+    não é garantida pelo Postgres e o id volta para o future certo por ela, qualquer que seja o tipo do id.
+    Com lead_analysis_state existente (e com_estado), o mesmo comando atualiza o estado.
+    """
+    retorno = "id"
+    if com_estado and _estado_leads["existe"]:
+        retorno = "id, lead_id, company_id, execution_date, execution_date_kw, metadata, message_status, message_sent_date, response_date"
+
+    ctes_linhas = []
+    for i in range(qtd_linhas):
+        params = [
+            f"CAST(:metadata_{i} AS JSONB)" if coluna == "metadata" else f":{coluna}_{i}"
+            for coluna in COLUNAS_TRACKING
+        ]
+        ctes_linhas.append(f"""
+        linha_{i} AS (
+            INSERT INTO lead_status_transition ({", ".join(COLUNAS_TRACKING)}, created_at, updated_at)
+            VALUES ({", ".join(params)}, NOW(), NOW())
+            RETURNING {retorno}
+        )""")
+
+    novos = "\n            UNION ALL ".join(f"SELECT {i} AS ordem, * FROM linha_{i}" for i in range(qtd_linhas))
+    ctes = ",".join(ctes_linhas) + f""",
+        novos AS (
+            {novos}
+        )"""
+
+    if retorno != "id":
+        ctes += f""",
+        estado AS (
+            {monta_upsert_estado_leads("novos")}
+        )"""
+
+    return f"""
+        WITH {ctes}
+        SELECT ordem, id FROM novos
+    """
 
-        return serializa_metadata(row["id"]) if row else None
+
+async def insere_lote_tracking(db_core, lista_values, com_estado=True):
+    """Insere N registros numa única query; retorna os ids na mesma ordem de lista_values (casados pela "ordem")."""
+    query = monta_query_insert_tracking(len(lista_values), com_estado)
+    values = {
+        f"{coluna}_{i}": linha[coluna]
+        for i, linha in enumerate(lista_values)
+        for coluna in COLUNAS_TRACKING
+    }
+
+    async with db_core.connection() as conn:  # abre e devolve conexão automaticamente
+        rows = await asyncio.wait_for(
+            conn.fetch_all(query=query, values=values),
+            timeout=300
+        )
+
+    ids = [None] * len(lista_values)
+    for row in rows:
+        ids[row["ordem"]] = serializa_metadata(row["id"])
+    return ids
+
+
+# ================================================================================================================================================================================
+# ESCRITOR EM LOTE DA TB DE TRACKING (AGRUPA INSERTS DE TODOS OS LEADS EM PARALELO)
+# ================================================================================================================================================================================
+_tracking_buffer = []          # [(db_core, values, future | None)]
+_tracking_timer = None
+
+
+async def descarrega_tracking():
+    """
+    Grava tudo que está no buffer. Em falha do lote, tenta linha a linha com INSERT simples (sem o upsert do estado),
+    para que um erro em lead_analysis_state não custe registros de tracking.
+    """
+    global _tracking_buffer
+    while _tracking_buffer:
+        pendentes, _tracking_buffer = _tracking_buffer[:TRACKING_LOTE_MAX_LINHAS], _tracking_buffer[TRACKING_LOTE_MAX_LINHAS:]
+        db_core = pendentes[0][0]
+
+        try:
+            ids = await insere_lote_tracking(db_core, [values for _, values, _ in pendentes])
+        except Exception as e:
+            logger.error(f"Erro ao inserir lote de {len(pendentes)} registros em lead_status_transition, gravando individualmente: {e}")
+            if _estado_leads["existe"]:
+                logger.warning(f"lead_analysis_state não atualizado para {len(pendentes)} registros do lote")
+            ids = []
+            for _, values, _ in pendentes:
+                try:
+                    ids.extend(await insere_lote_tracking(db_core, [values], com_estado=False))
+                except Exception as e_linha:
+                    logger.error(f"Erro ao inserir registro em lead_status_transition: {e_linha}")
+                    ids.append(None)
+
+        for (_, _, future), inserted_id in zip(pendentes, ids):
+            if future is not None and not future.done():
+                future.set_result(inserted_id)
+
+
+async def _descarrega_tracking_apos_espera():
+    global _tracking_timer
+    try:
+        await asyncio.sleep(TRACKING_LOTE_MAX_ESPERA)
+        await descarrega_tracking()
+    except Exception as e:
+        logger.error(f"Erro ao descarregar buffer de tracking: {e}")
+    finally:
+        _tracking_timer = None
+
+
+async def encerra_tracking():
+    """Espera o flush agendado em andamento e grava o que restar no buffer (encerramento do serviço)."""
+    if _tracking_timer is not None:
+        await _tracking_timer
+    await descarrega_tracking()
+
+
+async def insere_registro_ai_tracking(db_core, company_id, lead_id, execution_date, execution_date_ai, execution_date_kw, message_schedule_date, metadata, aguarda_id=True):
+    """
+    Registra a execução em lead_status_transition. Com TRACKING_EM_LOTE, a linha vai para um buffer
+    gravado em INSERT multi-linha (por tamanho ou tempo); aguarda_id=False não espera o flush e retorna None.
+    """
+    global _tracking_timer
+
+    try:
+        values = monta_valores_tracking(company_id, lead_id, execution_date, execution_date_ai, execution_date_kw, message_schedule_date, metadata)
+
+        if not TRACKING_EM_LOTE:
+            ids = await insere_lote_tracking(db_core, [values])
+            return ids[0] if ids else None
+
+        future = asyncio.get_running_loop().create_future() if aguarda_id else None
+        _tracking_buffer.append((db_core, values, future))
+
+        if len(_tracking_buffer) >= TRACKING_LOTE_MAX_LINHAS:
+            await descarrega_tracking()
+        elif _tracking_timer is None:
+            _tracking_timer = asyncio.create_task(_descarrega_tracking_apos_espera())
+
+        return await future if future is not None else None
 
     except Exception as e:
         logger.error(f"Erro ao inserir registro em lead_status_transition: {e}")
         return None
 
 
+
         
         
         
+# ================================================================================================================================================================================
+# EXTRAI TEXTO + TOTAL DE TOKENS DE UM GenerateContentResponse (SÍNCRONO OU LOTE)
+# ================================================================================================================================================================================
+def extrai_resposta_gemini(data, prompt_injetado, user_input, modo="sync"):
+    resposta_ai = data["candidates"][0]["content"]["parts"][0]["text"]
+    usage = data.get("usageMetadata", {})
+    prompt_tokens = usage.get("promptTokenCount", 0)
+    completion_tokens = usage.get("candidatesTokenCount", 0)
+    total_tokens = usage.get("totalTokenCount", 0)
+    logger.info(f"Sucesso API Gemini ({modo}): {prompt_tokens} prompt_tokens; {completion_tokens} completion_tokens; {total_tokens} total_tokens")
+    calibra_estimador_tokens(len(prompt_injetado) + len(user_input), prompt_tokens)
+    codificacao = codificacao_conversa.get()
+    if codificacao:
+        economia_codificador.registra(codificacao["perfil"], len(prompt_injetado) + len(user_input), codificacao["caracteres_classico"], prompt_tokens)
+    logger.info(f"Resposta AI: {resposta_ai}")
+    return resposta_ai, total_tokens or (prompt_tokens + completion_tokens)
+
+
+
 # ================================================================================================================================================================================
 # CLASSIFICA HISTÓRICO DE CONVERSA COM AI
 # ================================================================================================================================================================================
-async def classifica_historico_com_ai(session, prompt_injetado, user_input):
+async def classifica_historico_com_ai(session, prompt_injetado, user_input, company_id=None, response_schema=None):
+    """Retorna o texto da resposta, "" em erro ou None com a cota diária de tokens da company esgotada (IA não chamada)."""
+
+    # ORÇAMENTO DE TOKENS: debita a estimativa antes (espera a vez se o TPM estiver estourado) e reconcilia com o real
+    tokens_estimados = estima_tokens(len(prompt_injetado) + len(user_input))
+    reserva = await limitador_tokens_gemini.reserva(company_id, tokens_estimados, com_tpm=not modo_batch_ai.get())
+    if reserva is None:
+        logger.warning(f"Cota diária de tokens esgotada ({limitador_tokens_gemini.saldo_diario(company_id)} restantes, {tokens_estimados} estimados), IA não acionada")
+        return None
+
+    tokens_reais = 0
+    try:
+        resposta_ai, tokens_reais = await _chama_gemini(session, prompt_injetado, user_input, response_schema)
+        return resposta_ai
+    finally:
+        limitador_tokens_gemini.reconcilia(reserva, tokens_reais)
+
+
+async def _chama_gemini(session, prompt_injetado, user_input, response_schema=None):
+    """Chamada à Gemini (síncrona com retries, ou via job em lote). Retorna (texto, total_tokens). Schema padrão: classificação."""
 
     headers = {
         "Content-Type": "application/json",
@@ -777,7 +1716,7 @@ async def classifica_historico_com_ai(session, prompt_injetado, user_input):
         ],
         "generationConfig": {
             "responseMimeType": "application/json",
-            "responseSchema": {
+            "responseSchema": response_schema or {
                 "type": "OBJECT",
                 "properties": {
                     "ai_suggestion_status_name": {"type": "STRING"},
@@ -791,50 +1730,78 @@ async def classifica_historico_com_ai(session, prompt_injetado, user_input):
         }
     }
 
-    url = f"{GEMINI_URL}?key={GEMINI_API_KEY}"
+    # modo lote: a request entra no próximo job da Batch API e a task do lead aguarda o resultado
+    if modo_batch_ai.get():
+        data = await classifica_em_lote(session, payload, prazo_batch_ai.get())
+        if not data:
+            logger.warning("Sem resposta do job em lote da Gemini, lead será reprocessado no próximo ciclo")
+            return "", 0
+        try:
+            return extrai_resposta_gemini(data, prompt_injetado, user_input, modo="batch")
+        except Exception as e:
+            logger.error(f"Resposta inválida do job em lote da Gemini: {e}")
+            return "", 0
 
     for tentativa in range(1, GEMINI_MAX_RETRIES + 1):
+
+        # circuit breaker: usa o 1º modelo com circuito fechado (ou sonda liberada); todos abertos -> falha rápido
+        breaker = next((b for b in breakers_gemini if b.permite()), None)
+        if breaker is None:
+            logger.warning(f"Circuit breaker Gemini aberto para {', '.join(b.nome for b in breakers_gemini)}, IA não acionada")
+            return "", 0
+        if breaker.nome != GEMINI_MODELO:
+            logger.info(f"Usando modelo alternativo {breaker.nome} (circuit breaker de {GEMINI_MODELO} aberto)")
+
+        url = f"{GEMINI_URL.format(modelo=breaker.nome)}?key={GEMINI_API_KEY}"
+        saude_api = None            # True = OK, False = falha/indisponibilidade, None = não conta para o breaker
+        inicio = asyncio.get_running_loop().time()
+
         try:
-            async with session.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=aiohttp.ClientTimeout(total=GEMINI_TIMEOUT)
-            ) as response:
-
-                if response.status == 200:
-                    data = await response.json()
-                    resposta_ai = data["candidates"][0]["content"]["parts"][0]["text"]
-                    usage = data.get("usageMetadata", {})
-                    prompt_tokens = usage.get("promptTokenCount", 0)
-                    completion_tokens = usage.get("candidatesTokenCount", 0)
-                    total_tokens = usage.get("totalTokenCount", 0)
-                    logger.info(f"Sucesso API Gemini: {prompt_tokens} prompt_tokens; {completion_tokens} completion_tokens; {total_tokens} total_tokens")
-                    logger.info(f"Resposta AI: {resposta_ai}")
-                    return resposta_ai
-                else:
+            # slot do controle AIMD: o desfecho (OK / 429-503) ajusta o limite de chamadas simultâneas
+            async with controle_concorrencia_gemini.slot() as desfecho:
+                inicio = asyncio.get_running_loop().time()
+                async with session.post(
+                    url,
+                    json=payload,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=GEMINI_TIMEOUT)
+                ) as response:
+
+                    if response.status == 200:
+                        data = await response.json()
+                        desfecho.registra(sucesso=True)
+                        saude_api = True
+                        return extrai_resposta_gemini(data, prompt_injetado, user_input)
+
                     error_message = await response.text()
-                    log = logger.warning if tentativa < GEMINI_MAX_RETRIES else logger.error
-                    log(f"Erro {response.status} ao chamar Gemini (tentativa {tentativa}/{GEMINI_MAX_RETRIES}): {error_message}")
-                    if response.status in (429, 500, 502, 503) and tentativa < GEMINI_MAX_RETRIES:
-                        await asyncio.sleep(2 ** tentativa)
-                        continue
-                    return ""
+                    desfecho.registra(sobrecarga=response.status in (429, 503))
+                    saude_api = False if response.status == 429 or response.status >= 500 else None
+
+            log = logger.warning if tentativa < GEMINI_MAX_RETRIES else logger.error
+            log(f"Erro {response.status} ao chamar Gemini (tentativa {tentativa}/{GEMINI_MAX_RETRIES}): {error_message}")
+            if response.status in (429, 500, 502, 503) and tentativa < GEMINI_MAX_RETRIES:
+                await asyncio.sleep(2 ** tentativa)
+                continue
+            return "", 0
 
         except asyncio.TimeoutError as e:
+            saude_api = False
             log = logger.warning if tentativa < GEMINI_MAX_RETRIES else logger.error
             log(f"Timeout ao chamar Gemini (tentativa {tentativa}/{GEMINI_MAX_RETRIES}): {e}")
         except aiohttp.ClientError as e:
+            saude_api = False
             log = logger.warning if tentativa < GEMINI_MAX_RETRIES else logger.error
             log(f"Erro de cliente aiohttp ao chamar Gemini (tentativa {tentativa}/{GEMINI_MAX_RETRIES}): {e}")
         except Exception as e:
             log = logger.warning if tentativa < GEMINI_MAX_RETRIES else logger.error
             log(f"Erro genérico ao chamar Gemini (tentativa {tentativa}/{GEMINI_MAX_RETRIES}): {e}")
+        finally:
+            breaker.registra(saude_api, asyncio.get_running_loop().time() - inicio)
 
         if tentativa < GEMINI_MAX_RETRIES:
             await asyncio.sleep(2 ** tentativa)
 
-    return ""
+    return "", 0
     
 
 
@@ -882,24 +1849,8 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
     pre_status_name = lead_info.get("pre_status_name", "")
     pre_status_code = lead_info.get("pre_status_code", "")
 
-    # Monta lista de keywords válidas (ignora se não houver frase ou se não estiver ativada)
-    kw_entries = []
-    for status in status_configs:
-        if not status.get("kw_analysis"):
-            continue
-        raw_phrase = status.get("kw_keyphrase") or ""
-        capture_value = "{{valor_conversao}}" in raw_phrase
-        phrase_for_match = raw_phrase.replace("{{valor_conversao}}", "")
-        normalized_phrase = normaliza_texto_para_kw(phrase_for_match)
-        if not normalized_phrase:
-            continue
-        kw_entries.append({
-            "status_name": status["status_name"],
-            "status_code": status["status_code"],
-        "kw_keyphrase": raw_phrase,
-        "kw_keyphrase_normalized": normalized_phrase,
-        "capture_value": capture_value
-    })
+    # Keywords válidas + autômato compilado (cache por company até mudar o kwKeyphrase)
+    kw_entries, automato_kw = obtem_motor_kw(company_id, status_configs)
 
     if not kw_entries:
         return {"status": "none"}
@@ -908,25 +1859,19 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
     dt_ultima_kw_exec = lead_info.get("last_kw_execution_date") or lead_info.get("dt_abertura_lead")
     dt_ultima_kw_exec_naive = to_naive_datetime(dt_ultima_kw_exec)
 
-    # Filtra apenas mensagens da empresa, posteriores ao último run de KW
+    # Filtra apenas mensagens da empresa, posteriores ao último run de KW (mesmos registros, sem cópia)
     mensagens_kw = []
     for mensagem in mensagens:
-        if mensagem.get("de") != "EMPRESA":
+        if mensagem.de != "EMPRESA":
             continue
-        msg_dt_raw = mensagem.get("data_hora")
-        msg_dt = to_naive_datetime(msg_dt_raw)
+        msg_dt = to_naive_datetime(mensagem.data_hora)
         if msg_dt is None:
             continue
         if dt_ultima_kw_exec_naive and msg_dt <= dt_ultima_kw_exec_naive:
             continue
-        texto = mensagem.get("mensagem") or ""
-        if not texto.strip():
+        if not mensagem.mensagem or not mensagem.mensagem.strip():
             continue
-        mensagens_kw.append({
-            "datetime": msg_dt,
-            "raw_datetime": msg_dt_raw,
-            "texto": texto
-        })
+        mensagens_kw.append(mensagem)
 
     if not mensagens_kw:
         return {"status": "none"}
@@ -940,7 +1885,7 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
     async def resolve_status_id(status_name):
         if status_name in status_id_cache:
             return status_id_cache[status_name]
-        status_id = await consulta_id_status(db_core, company_id, status_name, "status_name")
+        status_id = await obtem_id_status(db_core, company_id, status_name, "status_name")
         status_id_cache[status_name] = status_id
         return status_id
 
@@ -948,12 +1893,13 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
     total_messages = len(mensagens_kw)
 
     for msg_index, mensagem in enumerate(mensagens_kw):
-        texto_normalizado = normaliza_texto_para_kw(mensagem["texto"])
+        texto_normalizado = normaliza_texto_para_kw(mensagem.mensagem)
         if not texto_normalizado:
             continue
-        for status in kw_entries:
-            occurrences = texto_normalizado.count(status["kw_keyphrase_normalized"])
-            for occurrence_index in range(occurrences):
+        # 1 varredura por mensagem; mantém a ordem de aplicação por keyword (ordem das configs)
+        ocorrencias_por_kw = automato_kw.conta_sem_sobreposicao(texto_normalizado)
+        for kw_index, status in enumerate(kw_entries):
+            for occurrence_index in range(len(ocorrencias_por_kw.get(kw_index, ()))):
                 # Resolve ID e aplica status via API
                 target_status_id = await resolve_status_id(status["status_name"])
                 if not target_status_id:
@@ -969,11 +1915,12 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
                 if not status_change:
                     logger.error(f"falha ao atualizar status {status['status_name']} via keyword")
                     return {"status": "error"}
+                await descarta_conversa_local(lead_id, status["status_code"])
 
                 # Captura valor (quando placeholder presente) e envia conversão se for END_WON
                 valor_conversao = None
                 if status.get("capture_value"):
-                    valor_conversao = extrai_valor_conversao(mensagem["texto"])
+                    valor_conversao = extrai_valor_conversao(mensagem.mensagem)
 
                     if valor_conversao not in (None, "", " ", 0, "0"):
                         status_send_conversion_value = await send_lead_conversion_value(http_session, token, lead_id, valor_conversao)
@@ -996,7 +1943,7 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
                     "kw_status_id": target_status_id,
                     "kw_status_name": status["status_name"],
                     "kw_status_code": status["status_code"],
-                    "kw_message_timestamp": mensagem["raw_datetime"].isoformat(),
+                    "kw_message_timestamp": mensagem.data_hora.isoformat(),
                     "kw_active": bool(status.get("kw_analysis")),
                     "ai_active": bool(status.get("ai_suggestion")),
                 }
@@ -1012,7 +1959,8 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
                     None,
                     execution_date,
                     None,
-                    metadata_tracking
+                    metadata_tracking,
+                    aguarda_id=False
                 )
 
                 logger.info(f"keyword '{status['kw_keyphrase']}' acionou status {status['status_name']} (mensagem {msg_index + 1}/{total_messages})")
@@ -1029,10 +1977,33 @@ async def processa_keywords(db_core, http_session, lead_info, status_configs, me
 
 
         
+# ================================================================================================================================================================================
+# FINGERPRINT DA ANÁLISE (CONVERSA LIMITADA + STATUS ATUAL + CONFIGS DE STATUS DA COMPANY)
+# ================================================================================================================================================================================
+def calcula_fingerprint_ai(mensagens_limitadas, pre_status_id, status_configs_ai, business_context):
+    """Hash do que determina a resposta da IA; se igual ao da última análise, a chamada ao modelo é dispensável."""
+    conteudo = json.dumps(
+        {
+            "mensagens": mensagens_limitadas,
+            "pre_status_id": str(pre_status_id),
+            "status_configs": sorted(
+                ([s.get("status_name"), s.get("status_code"), s.get("status_description"), s.get("ai_automation_mode"),
+                  s.get("ai_confidence_level_min_config")] for s in status_configs_ai),
+                key=lambda s: str(s[0]),
+            ),
+            "business_context": business_context,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+
 # ================================================================================================================================================================================
 # PROCESSA AI + WHATSAPP
 # ================================================================================================================================================================================
-async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensagens_limitadas, auth_token_company):
+async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensagens_limitadas, auth_token_company, caracteres_classico=None, com_resumo=False):
     """Fluxo de IA: monta prompt, consulta modelo, decide auto-update ou confirmação."""
 
     start_datetime = datetime.now()
@@ -1057,7 +2028,10 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     
     # PROMPT ----------------------------------------------------------------------------------------------------------
     business_context = business_context if business_context.strip() not in (None, "", "0", 0) else DEFAULT_BUSINESS_CONTEXT
-    prompt_injetado  = PROMPT.replace("PLACEHOLDER_BUSINESS_CONTEXT", business_context)
+    prompt_perfil    = PROMPTS_POR_PERFIL[CODIFICADOR_CONVERSA_PERFIL]
+    prompt_injetado  = prompt_perfil.replace("PLACEHOLDER_BUSINESS_CONTEXT", business_context)
+    if com_resumo:
+        prompt_injetado += PROMPT_COMPLEMENTO_RESUMO
 
     # monta lista de status disponíveis
     status_parts, status_names = [], []
@@ -1073,11 +2047,42 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     ).replace(
         "PLACEHOLDER_EXEMPLO_STATUS", " / ".join(status_names)
     )
+
+    # FINGERPRINT: CONVERSA, STATUS E CONFIGS IGUAIS À ÚLTIMA ANÁLISE -> NÃO CHAMA A IA -----------------------------
+    ai_fingerprint = calcula_fingerprint_ai(mensagens_limitadas, pre_status_id, status_configs_ai, business_context)
+    if PULA_AI_SEM_ALTERACAO and ai_fingerprint == lead_info.get("last_ai_fingerprint"):
+        metadata_tracking = {
+            "executor": "ai",
+            "ai_action": "skip_unchanged",
+            "ai_fingerprint": ai_fingerprint,
+            "manager_phone": tel_resp_company,
+            "lead_phone": tel_lead,
+            "lead_lid": lid,
+            "pre_status_id": pre_status_id,
+            "pre_status_name": pre_status_name,
+            "pre_status_code": pre_status_code,
+        }
+        await insere_registro_ai_tracking(db_core, company_id, lead_id, start_datetime, None, None, None, metadata_tracking, aguarda_id=False)
+        logger.info("Conversa, status e configs sem alteração desde a última análise, IA não acionada")
+        return "skip_unchanged"
     
     # CHAMADA À GEMINI ------------------------------------------------------------------------------------------------
+    # mesma chamada no perfil classico: prompt original + histórico com caracteres_classico
+    codificacao_conversa.set({
+        "perfil": CODIFICADOR_CONVERSA_PERFIL,
+        "caracteres_classico": (
+            len(prompt) - len(prompt_perfil) + len(PROMPT)
+            + len(user_input) - len(mensagens_limitadas) + (caracteres_classico or len(mensagens_limitadas))
+        ),
+    })
     ai_datetime = datetime.now()
-    resposta_ai = await classifica_historico_com_ai(http_session, prompt, user_input)
-    
+    resposta_ai = await classifica_historico_com_ai(http_session, prompt, user_input, company_id)
+
+    # cota esgotada não é erro: sem tracking, o lead volta a ser elegível quando a cota renovar
+    if resposta_ai is None:
+        logger.info("Lead não analisado: cota diária de tokens da company esgotada")
+        return "quota_exhausted"
+
     if not resposta_ai:
         logger.error("Resposta vazia da IA")
         return False
@@ -1108,6 +2113,11 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     if not ai_suggestion_status_name:
         logger.error("AI não sugeriu um status para o lead, ignorando lead")
         return False
+    if com_resumo:
+        try:
+            await atualiza_status_resumo(db_core, lead_id, ai_suggestion_status_name)
+        except Exception as e:
+            logger.warning(f"Erro ao registrar status sugerido no resumo da conversa: {e}")
     if not nome_lead:
         logger.info("AI não conseguiu encontrar o nome_lead")
 
@@ -1130,7 +2140,7 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     ai_suggestion_status_code = config_sugestoes_por_status["status_code"] if config_sugestoes_por_status else None
 
     # BUSCA ID PELO STATUS LEGÍVEL ------------------------------------------------------------------------------------
-    ai_suggestion_status_id = await consulta_id_status(db_core, company_id, ai_suggestion_status_name, "status_name")
+    ai_suggestion_status_id = await obtem_id_status(db_core, company_id, ai_suggestion_status_name, "status_name")
 
     # REGRAS DE INVERSÃO (baseadas em CODE) ---------------------------------------------------------------------------
     # reversed a partir do CODE; NAME sempre legível
@@ -1144,7 +2154,7 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
         config_reversed = next((s for s in status_configs_ai if s.get("status_code") == reversed_ai_suggestion_status_code),{})
         reversed_ai_suggestion_status_name = config_reversed.get("status_name")  # ex.: "Finalizado Perdido" / "Finalizado Convertido"
         # 3) busca o ID pelo CODE (aqui sim, passa code e diz que o campo é "status_code")
-        reversed_ai_suggestion_status_id = await consulta_id_status(db_core, company_id, reversed_ai_suggestion_status_code, "status_code")
+        reversed_ai_suggestion_status_id = await obtem_id_status(db_core, company_id, reversed_ai_suggestion_status_code, "status_code")
 
     # NÍVEL DE CONFIANÇA PARAMETRIZADO NO FRONT
     ai_confidence_level_min_config = float(config_sugestoes_por_status.get("ai_confidence_level_min_config") or 0)                                                                               # FALLBACK = 0
@@ -1152,6 +2162,7 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     # METADATA TRACKING ------------------------------------------------------------------------------------------------
     metadata_tracking = {
         "executor": "ai",
+        "ai_fingerprint": ai_fingerprint,
         "manager_phone": tel_resp_company,
         "lead_phone": tel_lead,
         "lead_lid": lid,
@@ -1178,7 +2189,7 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     # SE O STATUS SUGERIDO É IGUAL AO STATUS ATUAL, MARCA COMO KEEP_SAME_STATUS E ENCERRA EXECUÇÃO
     if ai_suggestion_status_id == pre_status_id:
         metadata_tracking["ai_action"] = "keep_same_status"
-        await insere_registro_ai_tracking(db_core, company_id, lead_id, start_datetime, ai_datetime, None, None, metadata_tracking)
+        await insere_registro_ai_tracking(db_core, company_id, lead_id, start_datetime, ai_datetime, None, None, metadata_tracking, aguarda_id=False)
         logger.info("status_sugerido_ai = pre_status_name, não enviando solicitação de confirmação")
         return "keep_same_status"
         
@@ -1205,11 +2216,12 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
         status_change = await change_lead_status(http_session, auth_token_app_leaper, lead_id, ai_suggestion_status_id)
         if status_change:
             logger.info("Status do lead atualizado com sucesso")
+            await descarta_conversa_local(lead_id, ai_suggestion_status_code)
         else:
             logger.error("Erro ao atualizar status do lead")
 
         # Tracking (sem confirmação)
-        await insere_registro_ai_tracking(db_core, company_id, lead_id, start_datetime, ai_datetime, None, None, metadata_tracking)
+        await insere_registro_ai_tracking(db_core, company_id, lead_id, start_datetime, ai_datetime, None, None, metadata_tracking, aguarda_id=False)
         return "auto_update"
 
 
@@ -1232,11 +2244,104 @@ async def processa_ai(db_core, http_session, lead_info, status_configs_ai, mensa
     
 
 
+# ================================================================================================================================================================================
+# RESUMO ROLANTE DA CONVERSA (RESUMO ATÉ O WATERMARK + MENSAGENS POSTERIORES)
+# ================================================================================================================================================================================
+async def gera_resumo_conversa(session, company_id, resumo_anterior, mensagens):
+    """Resumo (texto) de resumo_anterior + mensagens pela Gemini, ou None em erro."""
+    partes = []
+    if resumo_anterior:
+        partes.append(f"RESUMO_ANTERIOR:\n{resumo_anterior}")
+    partes.append("MENSAGENS:\n" + limitar_mensagens(codifica_conversa(mensagens, CODIFICADOR_CONVERSA_PERFIL)))
+
+    # fora da conta de economia do codificador (não é a chamada de classificação)
+    codificacao_conversa.set(None)
+    resposta = await classifica_historico_com_ai(
+        session, PROMPT_RESUMO, "\n\n".join(partes), company_id,
+        response_schema={"type": "OBJECT", "properties": {"resumo": {"type": "STRING"}}, "required": ["resumo"]},
+    )
+    if not resposta:
+        return None
+    try:
+        resposta_json, _ = json.JSONDecoder().raw_decode(resposta.replace("```json", "").replace("```", "").strip())
+    except json.JSONDecodeError as e:
+        logger.error(f"Erro ao converter o resumo da IA para JSON: {e}")
+        return None
+    return (resposta_json.get("resumo") or "").strip() or None
+
+
+def separa_apos_watermark(mensagens, watermark_data_hora, qtd_mesmo_instante):
+    """Mensagens depois do watermark: as do próprio segundo entram a partir da (qtd_mesmo_instante + 1)-ésima."""
+    posteriores = []
+    vistas_no_instante = 0
+    for mensagem in mensagens:
+        if mensagem.data_hora < watermark_data_hora:
+            continue
+        if mensagem.data_hora == watermark_data_hora and vistas_no_instante < qtd_mesmo_instante:
+            vistas_no_instante += 1
+            continue
+        posteriores.append(mensagem)
+    return posteriores
+
+
+async def monta_historico_com_resumo(db_core, session, lead_info, mensagens):
+    """
+    Histórico "RESUMO_CONVERSA + MENSAGENS_APOS_RESUMO" do lead, ou None para usar o histórico completo.
+    Gera o resumo se não houver (tudo menos as RESUMO_MENSAGENS_RECENTES) e o regenera a partir do resumo
+    anterior + mensagens novas mais antigas quando elas passam de RESUMO_DELTA_MAX_CARACTERES.
+    """
+    company_id = lead_info.get("company_id", "")
+    lead_id = lead_info.get("lead_id", "")
+
+    resumo = await carrega_resumo(db_core, lead_id)
+    # resumo de conversa que não bate com as mensagens atuais (ex.: período de análise mudou) é descartado
+    if resumo and (not mensagens or resumo["watermark_data_hora"] < mensagens[0].data_hora):
+        resumo = None
+
+    if resumo:
+        posteriores = separa_apos_watermark(mensagens, resumo["watermark_data_hora"], resumo["watermark_qtd_mesmo_instante"])
+    else:
+        posteriores = list(mensagens)
+
+    antigas = posteriores[:-RESUMO_MENSAGENS_RECENTES] if len(posteriores) > RESUMO_MENSAGENS_RECENTES else []
+    if antigas and (resumo is None or caracteres_formato_classico(antigas) > RESUMO_DELTA_MAX_CARACTERES):
+        texto_resumo = await gera_resumo_conversa(session, company_id, resumo["resumo"] if resumo else None, antigas)
+        if texto_resumo:
+            # watermark por mensagem: segundo da última resumida + quantas desse segundo já estão no resumo
+            watermark_data_hora = antigas[-1].data_hora
+            qtd_mesmo_instante = sum(1 for m in antigas if m.data_hora == watermark_data_hora)
+            if resumo and resumo["watermark_data_hora"] == watermark_data_hora:
+                qtd_mesmo_instante += resumo["watermark_qtd_mesmo_instante"]
+            resumo = {
+                "resumo": texto_resumo,
+                "watermark_data_hora": watermark_data_hora,
+                "watermark_qtd_mesmo_instante": qtd_mesmo_instante,
+                "qtd_mensagens": (resumo["qtd_mensagens"] if resumo else 0) + len(antigas),
+                "ultimo_status_sugerido": resumo["ultimo_status_sugerido"] if resumo else None,
+            }
+            await salva_resumo(
+                db_core, lead_id, company_id, resumo["resumo"], resumo["watermark_data_hora"],
+                resumo["watermark_qtd_mesmo_instante"], resumo["qtd_mensagens"], resumo["ultimo_status_sugerido"],
+            )
+            posteriores = posteriores[len(antigas):]
+            logger.info(f"Resumo da conversa atualizado ({resumo['qtd_mensagens']} mensagens até {resumo['watermark_data_hora']})")
+
+    if not resumo:
+        return None
+
+    return (
+        f"RESUMO_CONVERSA (mensagens até {resumo['watermark_data_hora'].strftime('%d/%m/%Y %H:%M')}; "
+        f"último status sugerido: {resumo['ultimo_status_sugerido'] or '-'}):\n{resumo['resumo']}\n\n"
+        f"MENSAGENS_APOS_RESUMO:\n{limitar_mensagens(codifica_conversa(posteriores, CODIFICADOR_CONVERSA_PERFIL))}"
+    )
+
+
+
 # ================================================================================================================================================================================
 # PROCESSA 1 LEAD
 # ================================================================================================================================================================================
-async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company):
-    """Processa um lead: busca mensagens, roda keywords primeiro, depois IA se precisar."""
+async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company, mensagens=None):
+    """Processa um lead: busca mensagens (se não vierem do lote), roda keywords primeiro, depois IA se precisar."""
     try:
         company_id       = lead_info.get("company_id", "")
         tel_resp_company = lead_info.get("tel_resp_company", "")
@@ -1265,7 +2370,14 @@ async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
         # -------------------------------------------------------------------
         # BUSCA MENSAGENS DO LEAD
         # -------------------------------------------------------------------
-        mensagens = await busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_lead)
+        historico_completo = True
+        if mensagens is None and POLITICA_TRUNCAMENTO == "tail":
+            # memória limitada pelo orçamento do prompt, não pelo tamanho da conversa (histórico parcial: sem resumo rolante)
+            historico_completo = False
+            dt_corte_kw = lead_info.get("last_kw_execution_date") or dt_abertura_lead
+            mensagens = await busca_mensagens_lead_streaming(db_evo, company_id, tel_lead, lid, dt_abertura_lead, dt_corte_kw)
+        elif mensagens is None:
+            mensagens = await busca_mensagens_lead(db_evo, company_id, tel_lead, lid, dt_abertura_lead)
         
         if not mensagens:
             logger.warning("Lead ignorado: sem mensagens.")
@@ -1276,17 +2388,14 @@ async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
                 "message": "Lead without messages"
             }
             await insere_registro_ai_tracking(
-                db_core, company_id, lead_id, datetime.now(), None, None, None, metadata_tracking
+                db_core, company_id, lead_id, datetime.now(), None, None, None, metadata_tracking, aguarda_id=False
             )
             return {"processado": False, "agendadas": 0}
 
         # -------------------------------------------------------------------
         # FORMATA HISTÓRICO DE MENSAGENS
         # -------------------------------------------------------------------
-        mensagens_formatadas = [
-            f"{m['de'].upper()} ({m['data_hora'].strftime('%d/%m/%Y %H:%M:%S')}):\n {m['mensagem']}\n"
-            for m in mensagens
-        ]
+        mensagens_formatadas = codifica_conversa(mensagens, CODIFICADOR_CONVERSA_PERFIL)
         mensagens_limitadas = limitar_mensagens(mensagens_formatadas)
 
         # conta qtd de mensagnes e faz regra cruzada com dt hr abertura lead / ult data execuccao'
@@ -1300,7 +2409,7 @@ async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
         # -------------------------------------------------------------------
         # BUSCA CONFIGS DE STATUS
         # -------------------------------------------------------------------
-        status_configs = await busca_status_configs(db_core, company_id)
+        status_configs = await obtem_status_configs(db_core, company_id)
 
         # -------------------------------------------------------------------
         # PROCESSA KEYWORDS
@@ -1323,19 +2432,41 @@ async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
             logger.info("sem status habilitados para AI")
             return {"processado": False, "agendadas": 0}
 
-        resultado_ai = await processa_ai(db_core, session, lead_info, status_configs_ai, mensagens_limitadas, auth_token_company)
+        # conversa longa: resumo até o watermark + mensagens posteriores no lugar do histórico inteiro
+        com_resumo = False
+        # (só com o histórico completo: o resumo e o watermark assumem que mensagens cobre todo o período do lead)
+        if (RESUMO_CONVERSA_ATIVO and _resumos_conversa["ativo"] and historico_completo
+                and len(mensagens_limitadas) >= RESUMO_MIN_CARACTERES):
+            try:
+                historico_com_resumo = await monta_historico_com_resumo(db_core, session, lead_info, mensagens)
+            except Exception as e:
+                logger.warning(f"Erro ao montar histórico com resumo, enviando histórico completo: {e}")
+                historico_com_resumo = None
+            if historico_com_resumo:
+                mensagens_limitadas, com_resumo = historico_com_resumo, True
+
+        # tamanho do mesmo histórico no perfil classico e sem resumo (base da economia de tokens do codificador)
+        if CODIFICADOR_CONVERSA_PERFIL == "classico" and not com_resumo:
+            caracteres_classico = len(mensagens_limitadas)
+        else:
+            caracteres_classico = min(
+                caracteres_formato_classico(mensagens),
+                int(LIMITE_TOKENS_HISTORICO * _calibracao_tokens["caracteres_por_token"]),
+            )
+
+        resultado_ai = await processa_ai(db_core, session, lead_info, status_configs_ai, mensagens_limitadas, auth_token_company, caracteres_classico, com_resumo)
 
         # -------------------------------------------------------------------
         # RETORNO PADRONIZADO
         # -------------------------------------------------------------------
         # Só conta como "agendada" quando realmente agendou mensagem de confirmação
         agendada = 1 if resultado_ai == "confirmation_scheduled" else 0
-        processado = resultado_ai in ("keep_same_status", "auto_update", "confirmation_scheduled")
+        processado = resultado_ai in ("keep_same_status", "auto_update", "confirmation_scheduled", "skip_unchanged")
 
         return {
             "processado": processado,
             "agendadas": agendada,
-            "via": "ai"
+            "via": {"skip_unchanged": "ai_sem_alteracao", "quota_exhausted": "ai_cota_esgotada"}.get(resultado_ai, "ai")
         }
 
     except Exception as e:
@@ -1350,21 +2481,46 @@ async def processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
 # ================================================================================================================================================================================
 # PROCESSA COMPANY
 # ================================================================================================================================================================================
-async def processa_company(db_core, db_evo, session, company_id, sem_company):
+def pula_company_cota_esgotada(company_id):
+    """
+    Cota diária de tokens sem saldo nem para o prompt: a IA recusaria todos os leads, que seguem elegíveis (sem tracking).
+    Para não rebuscar as conversas a cada ciclo até a cota renovar, a company roda no máximo 1x por CICLO_INTERVALO_OCIOSO
+    (só as keywords têm efeito) e fica fora do backlog.
+    """
+    saldo = limitador_tokens_gemini.saldo_diario(company_id)
+    if saldo is None or saldo >= estima_tokens(len(PROMPTS_POR_PERFIL[CODIFICADOR_CONVERSA_PERFIL])):
+        _companies_cota_esgotada.pop(str(company_id), None)
+        return False
+    agora = asyncio.get_running_loop().time()
+    ultima = _companies_cota_esgotada.get(str(company_id))
+    if ultima is not None and agora - ultima < CICLO_INTERVALO_OCIOSO:
+        return True
+    _companies_cota_esgotada[str(company_id)] = agora
+    return False
+
+
+async def processa_company(db_core, db_evo, session, company_id, sem_company, escalonador, leads_infos=None):
     """
-    Processa todos os leads de uma company em paralelo (máx. 4 por vez),
-    captura erros individuais sem interromper o restante e retorna um resumo final.
+    Prepara a company (leads elegíveis, token, lotes de mensagens) sob sem_company e entrega os leads ao
+    escalonador DRR do ciclo, que os distribui de forma justa entre companies para o pool de workers.
+    leads_infos já vem da consulta da instância; None faz a consulta só desta company.
+    Captura erros individuais sem interromper o restante e retorna um resumo final.
     """
     log_metadata.set({"company_id": company_id})
 
-    async with sem_company:
-        try:
+    try:
+        if pula_company_cota_esgotada(company_id):
+            logger.info(f"Cota diária de tokens esgotada ({limitador_tokens_gemini.saldo_diario(company_id)} restantes), company fora desta rodada")
+            return {"company_id": company_id, "leads": 0, "processados": 0, "agendados": 0, "backlog": 0}
+
+        async with sem_company:
             logger.info(f"Iniciando processamento da company {company_id}")
 
             # -------------------------------------------------------------------
             # 1. Carrega leads disponíveis para processamento -> fazer regras mais amplas e dps cruzar com qtd de mensagens pra limitar mais
             # -------------------------------------------------------------------
-            leads_infos = await consulta_leads_disponiveis_para_classificar(db_core, company_id, MAX_LEADS_POR_RODADA)
+            if leads_infos is None:
+                leads_infos = await consulta_leads_disponiveis_para_classificar(db_core, company_id, MAX_LEADS_POR_RODADA)
 
             if not leads_infos:
                 logger.info(f"Sem leads disponíveis")
@@ -1375,79 +2531,127 @@ async def processa_company(db_core, db_evo, session, company_id, sem_company):
                 logger.error(f"{company_id}: não foi possível obter auth_token_company, pulando processamento")
                 return {"company_id": company_id, "leads": len(leads_infos), "processados": 0, "agendados": 0}
 
-            # -------------------------------------------------------------------
-            # 2. Cria subtarefas paralelas com limite de 4 leads simultâneos
-            # -------------------------------------------------------------------
-            sem_leads = asyncio.Semaphore(4)
+            instance_ids = await busca_ids_instancia_evo(db_evo, company_id)
 
-            async def processa_lead_com_limite(lead_info):
-                async with sem_leads:
+        # -------------------------------------------------------------------
+        # 2. Entrega os leads ao escalonador (1 tarefa por lead).
+        #    Mensagens buscadas em lote (TAMANHO_LOTE_MENSAGENS leads por query),
+        #    disparado quando o primeiro lead do lote começa a ser processado
+        #    (com BUSCA_MENSAGENS_STREAMING, cada lead busca as suas em streaming).
+        # -------------------------------------------------------------------
+        lotes_leads = [
+            leads_infos[i:i + TAMANHO_LOTE_MENSAGENS]
+            for i in range(0, len(leads_infos), TAMANHO_LOTE_MENSAGENS)
+        ]
+        tasks_lotes = {}
+
+        async def mensagens_do_lote(indice_lote):
+            task_lote = tasks_lotes.get(indice_lote)
+            if task_lote is None:
+                task_lote = asyncio.create_task(busca_mensagens_leads_incremental(db_evo, instance_ids, lotes_leads[indice_lote]))
+                tasks_lotes[indice_lote] = task_lote
+            return await task_lote
+
+        def tarefa_lead(indice_lead, lead_info):
+            async def executa():
+                try:
                     try:
-                        return await processa_lead(db_core, db_evo, session, lead_info, auth_token_company)
+                        if BUSCA_MENSAGENS_STREAMING:
+                            # busca individual em streaming dentro de processa_lead
+                            mensagens = None
+                        else:
+                            mensagens_por_lead = await mensagens_do_lote(indice_lead // TAMANHO_LOTE_MENSAGENS)
+                            mensagens = mensagens_por_lead.get(lead_info.get("lead_id"), [])
                     except Exception as e:
-                        logger.exception(f"Erro ao processar lead {lead_info.get('lead_id')}: {e}", exc_info=True)
-                        return {"processado": False, "agendadas": 0}
+                        # fallback: busca individual do lead dentro de processa_lead
+                        logger.warning(f"Falha na busca em lote de mensagens, buscando lead individualmente: {e}")
+                        mensagens = None
+                    return await processa_lead(db_core, db_evo, session, lead_info, auth_token_company, mensagens)
+                except Exception as e:
+                    logger.exception(f"Erro ao processar lead {lead_info.get('lead_id')}: {e}", exc_info=True)
+                    return {"processado": False, "agendadas": 0}
+            return executa
+
+        futures = await escalonador.enfileira(
+            company_id,
+            [tarefa_lead(indice_lead, lead_info) for indice_lead, lead_info in enumerate(leads_infos)],
+            peso=PESOS_COMPANY.get(str(company_id), 1.0),
+        )
 
-            tasks = [
-                asyncio.create_task(processa_lead_com_limite(lead_info))
-                for lead_info in leads_infos
-            ]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        log_metadata.set({"company_id": company_id})
 
-            results = await asyncio.gather(*tasks, return_exceptions=False)
+        # -------------------------------------------------------------------
+        # 3. Calcula totais
+        # -------------------------------------------------------------------
+        total_leads = len(leads_infos)
+        processados_total = 0
+        processados_kw = 0
+        processados_ai = 0
+        pulados_sem_alteracao = 0
+        pulados_cota_esgotada = 0
+        agendados_total = 0
 
-            # -------------------------------------------------------------------
-            # 3. Calcula totais
-            # -------------------------------------------------------------------
-            total_leads = len(leads_infos)
-            processados_total = 0
-            processados_kw = 0
-            processados_ai = 0
-            agendados_total = 0
-
-            for result in results:
-                if isinstance(result, dict):
-                    if result.get("processado"):
-                        processados_total += 1
-                        via = result.get("via")
-                        if via == "kw":
-                            processados_kw += 1
-                        elif via == "ai":
-                            processados_ai += 1
-                    agendados_total += result.get("agendadas", 0)
-                else:
-                    logger.warning(f"Resultado inesperado ao processar lead: {result}")
+        for result in results:
+            if isinstance(result, dict):
+                if result.get("via") == "ai_cota_esgotada":
+                    pulados_cota_esgotada += 1
+                if result.get("processado"):
+                    processados_total += 1
+                    via = result.get("via")
+                    if via == "kw":
+                        processados_kw += 1
+                    elif via == "ai":
+                        processados_ai += 1
+                    elif via == "ai_sem_alteracao":
+                        pulados_sem_alteracao += 1
+                agendados_total += result.get("agendadas", 0)
+            else:
+                logger.warning(f"Resultado inesperado ao processar lead: {result}")
 
-            # -------------------------------------------------------------------
-            # 4. Log e retorno final
-            # -------------------------------------------------------------------
-            logger.info(
-                f"Company concluída | Leads: {total_leads} | "
-                f"Processados: {processados_total} (kw: {processados_kw} | ai: {processados_ai}) | "
-                f"Agendados: {agendados_total}"
-            )
+        # -------------------------------------------------------------------
+        # 4. Log e retorno final
+        # -------------------------------------------------------------------
+        # leads elegíveis que ficaram fora desta rodada (limite de MAX_LEADS_POR_RODADA por company); com a cota
+        # esgotada não conta, para não emendar ciclos que a IA recusaria
+        backlog = max(0, int(leads_infos[0].get("total_elegiveis") or 0) - total_leads)
+        if pulados_cota_esgotada:
+            _companies_cota_esgotada.setdefault(str(company_id), asyncio.get_running_loop().time())
+        if str(company_id) in _companies_cota_esgotada:
+            backlog = 0
 
-            return {
-                "company_id": company_id,
-                "leads": total_leads,
-                "processados": processados_total,
-                "processados_kw": processados_kw,
-                "processados_ai": processados_ai,
-                "agendados": agendados_total,
-            }
+        logger.info(
+            f"Company concluída | Leads: {total_leads} | Backlog: {backlog} | "
+            f"Processados: {processados_total} (kw: {processados_kw} | ai: {processados_ai} | ai sem alteração: {pulados_sem_alteracao}) | "
+            f"Sem IA por cota esgotada: {pulados_cota_esgotada} | "
+            f"Agendados: {agendados_total} | "
+            f"Saldo diário de tokens: {limitador_tokens_gemini.saldo_diario(company_id)}"
+        )
 
-        except Exception as e:
-            logger.exception(f"Erro geral no processamento da company: {e}", exc_info=True)
-            return {"company_id": company_id, "leads": 0, "processados": 0, "agendados": 0}
+        return {
+            "company_id": company_id,
+            "leads": total_leads,
+            "processados": processados_total,
+            "processados_kw": processados_kw,
+            "processados_ai": processados_ai,
+            "pulados_sem_alteracao": pulados_sem_alteracao,
+            "agendados": agendados_total,
+            "backlog": backlog,
+        }
+
+    except Exception as e:
+        logger.exception(f"Erro geral no processamento da company: {e}", exc_info=True)
+        return {"company_id": company_id, "leads": 0, "processados": 0, "agendados": 0}
 
    
 
 # ================================================================================================================================================================================
 # PROCESSA INSTANCIA
 # ================================================================================================================================================================================
-async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, session, companies_ids):
+async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, session, companies_ids, escalonador):
     """
-    Executa o processamento de múltiplas companies em paralelo, capturando
-    apenas os erros individuais de cada subtask sem interromper as demais.
+    Executa o processamento de múltiplas companies em paralelo (leads via escalonador do ciclo),
+    capturando apenas os erros individuais de cada subtask sem interromper as demais.
     """
     
 
@@ -1456,12 +2660,28 @@ async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, sess
         logger.info(f"Iniciando processamento da instância")
 
         # -------------------------------------------------------------------
-        # 2. Cria subtarefas para companies (máx. 4 simultâneas)
+        # 1. Leads elegíveis de todas as companies da instância em 1 query
+        #    (se falhar, cada company consulta os seus)
+        # -------------------------------------------------------------------
+        leads_por_company = await consulta_leads_disponiveis_instancia(db_core, companies_ids, MAX_LEADS_POR_RODADA)
+        if leads_por_company is None:
+            leads_por_company = {}
+        else:
+            logger.info(
+                f"Leads elegíveis da instância: {sum(len(l) for l in leads_por_company.values())} "
+                f"em {sum(1 for l in leads_por_company.values() if l)}/{len(companies_ids)} companies"
+            )
+
+        # -------------------------------------------------------------------
+        # 2. Cria subtarefas para companies (preparação limitada a COMPANIES_SIMULTANEAS)
         # -------------------------------------------------------------------
-        sem_company = asyncio.Semaphore(4)
+        sem_company = asyncio.Semaphore(COMPANIES_SIMULTANEAS)
 
         tasks = [
-            asyncio.create_task(processa_company(db_core, db_evo, session, company_id, sem_company))
+            asyncio.create_task(processa_company(
+                db_core, db_evo, session, company_id, sem_company, escalonador,
+                leads_por_company.get(str(company_id))
+            ))
             for company_id in companies_ids
         ]
 
@@ -1475,7 +2695,9 @@ async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, sess
         processados_total = 0
         processados_kw_total = 0
         processados_ai_total = 0
+        pulados_sem_alteracao_total = 0
         agendados_total = 0
+        backlog_total = 0
 
         for company_id, result in zip(companies_ids, results):
             if isinstance(result, Exception):
@@ -1485,17 +2707,24 @@ async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, sess
                 processados_total += result.get("processados", 0)
                 processados_kw_total += result.get("processados_kw", 0)
                 processados_ai_total += result.get("processados_ai", 0)
+                pulados_sem_alteracao_total += result.get("pulados_sem_alteracao", 0)
                 agendados_total += result.get("agendados", 0)
+                backlog_total += result.get("backlog", 0)
             else:
                 logger.warning(f"Company {company_id} retornou None ou formato inesperado")
 
         # -------------------------------------------------------------------
         # 4. Log final da instância
         # -------------------------------------------------------------------
+        # taxa de leads em que a IA foi dispensada por fingerprint igual (economia de chamadas Gemini)
+        elegiveis_ai = processados_ai_total + pulados_sem_alteracao_total
+        taxa_pulados_sem_alteracao = (pulados_sem_alteracao_total / elegiveis_ai * 100) if elegiveis_ai else 0.0
+
         logger.info(
             f"Instância finalizada | Companies: {total_companies} | Leads: {leads_total} | "
-            f"Processados: {processados_total} (kw: {processados_kw_total} | ai: {processados_ai_total}) | "
-            f"Agendados: {agendados_total}"
+            f"Processados: {processados_total} (kw: {processados_kw_total} | ai: {processados_ai_total} | ai sem alteração: {pulados_sem_alteracao_total}) | "
+            f"Taxa IA dispensada: {taxa_pulados_sem_alteracao:.1f}% | "
+            f"Agendados: {agendados_total} | Backlog: {backlog_total}"
         )
 
         return {
@@ -1506,7 +2735,10 @@ async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, sess
             "processados": processados_total,
             "processados_kw": processados_kw_total,
             "processados_ai": processados_ai_total,
+            "pulados_sem_alteracao": pulados_sem_alteracao_total,
+            "taxa_pulados_sem_alteracao": round(taxa_pulados_sem_alteracao, 2),
             "agendados": agendados_total,
+            "backlog": backlog_total,
         }
 
     except Exception as e:
@@ -1522,6 +2754,83 @@ async def processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, sess
     
     
     
+# ================================================================================================================================================================================
+# PROCESSA TODAS AS INSTANCIAS (SEQUENCIAL OU EM PARALELO COM LIMITE GLOBAL E POR HOST)
+# ================================================================================================================================================================================
+async def processa_instancias_wpp(db_core, session, instancias_companies):
+    """
+    Processa as instâncias Evolution do ciclo. Com PROCESSA_INSTANCIAS_EM_PARALELO, roda até
+    MAX_INSTANCIAS_SIMULTANEAS instâncias ao mesmo tempo, no máx. MAX_INSTANCIAS_POR_HOST por evo_db_host.
+    """
+    sem_global = asyncio.Semaphore(MAX_INSTANCIAS_SIMULTANEAS if PROCESSA_INSTANCIAS_EM_PARALELO else 1)
+    sems_host = {}
+
+    # 1 fila justa (DRR por company) + 1 pool de workers para os leads de todas as instâncias do ciclo
+    escalonador = EscalonadorDRR()
+    qtd_workers = WORKERS_LEADS_BATCH if modo_batch_ai.get() else WORKERS_LEADS
+    workers = [asyncio.create_task(worker_escalonador(escalonador)) for _ in range(qtd_workers)]
+
+    async def processa_instancia_com_limite(instancia_companies):
+        evo_db_host = instancia_companies.get("evo_db_host")
+        evo_db_name = instancia_companies.get("evo_db_name")
+        companies_ids = instancia_companies.get("companies_ids", [])
+
+        sem_host = sems_host.setdefault(evo_db_host, asyncio.Semaphore(MAX_INSTANCIAS_POR_HOST))
+
+        async with sem_host, sem_global:
+            log_metadata.set({"evo_db_host": evo_db_host, "evo_db_name": evo_db_name})
+
+            # Pool persistente por (host, db): abre só na primeira vez, reaproveita nos ciclos seguintes
+            try:
+                db_evo = await obtem_pool_evo(evo_db_host, evo_db_name, min_size=1, max_size=EVO_POOL_MAX_SIZE)
+            except Exception as e:
+                logger.error(f"Erro ao conectar à instância {evo_db_host} - {evo_db_name}: {e}")
+                # a rota em cache pode estar desatualizada: recarrega todas no próximo ciclo
+                forca_atualizacao_rotas_instancias()
+                return None
+
+            try:
+                return await processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, session, companies_ids, escalonador)
+            except Exception as e:
+                logger.error(f"Erro ao processar instância {evo_db_host} - {evo_db_name}: {e}")
+                return None
+
+    instancias_validas = [
+        i for i in instancias_companies
+        if i.get("evo_db_name") and i.get("companies_ids")
+    ]
+
+    t0 = datetime.now()
+    try:
+        if PROCESSA_INSTANCIAS_EM_PARALELO:
+            results = await asyncio.gather(*[processa_instancia_com_limite(i) for i in instancias_validas])
+        else:
+            results = [await processa_instancia_com_limite(i) for i in instancias_validas]
+    finally:
+        await escalonador.fecha()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    elapsed = (datetime.now() - t0).total_seconds()
+    logger.info(f"Instâncias finalizadas | Instâncias: {len(instancias_validas)} | Paralelo: {PROCESSA_INSTANCIAS_EM_PARALELO} | Workers: {qtd_workers} | Duração: {elapsed:.2f}s")
+    return results
+
+
+
+# ================================================================================================================================================================================
+# INTERVALO ATÉ O PRÓXIMO CICLO
+# ================================================================================================================================================================================
+def calcula_espera_proximo_ciclo(duracao_ciclo, backlog_restante, processados_ciclo):
+    """
+    Com backlog (e progresso no ciclo, para não girar em falso com leads que falham sempre) emenda o próximo
+    ciclo após CICLO_INTERVALO_MINIMO; ocioso, completa CICLO_INTERVALO_OCIOSO contado do início do ciclo.
+    """
+    jitter = random.uniform(0, CICLO_JITTER)
+    if backlog_restante > 0 and processados_ciclo > 0:
+        return CICLO_INTERVALO_MINIMO + jitter
+    return max(CICLO_INTERVALO_MINIMO, CICLO_INTERVALO_OCIOSO - duracao_ciclo) + jitter
+
+
+
 # ================================================================================================================================================================================
 # MAIN
 # ================================================================================================================================================================================
@@ -1534,19 +2843,63 @@ async def main():
     t0 = datetime.now()
     logger.info("Iniciando processo contínuo...")
 
+    configura_gemini_batch(
+        GEMINI_API_BASE, GEMINI_MODELO, GEMINI_API_KEY,
+        GEMINI_BATCH_MAX_REQUESTS, GEMINI_BATCH_MAX_ESPERA, GEMINI_BATCH_INTERVALO_POLL, GEMINI_BATCH_TIMEOUT,
+    )
+
     # Cria pools e sessão HTTP uma vez só
-    db_core = await conecta_leaper_db_core(min_size=1, max_size=WORKERS_GLOBAIS*2)
+    instancias_simultaneas = MAX_INSTANCIAS_SIMULTANEAS if PROCESSA_INSTANCIAS_EM_PARALELO else 1
+    db_core = await conecta_leaper_db_core(min_size=1, max_size=WORKERS_GLOBAIS*2*instancias_simultaneas)
     
     db_gateway = await conecta_leaper_db_gateway(min_size=1, max_size=WORKERS_GLOBAIS*2)
+
+    # Estado por lead: cria/backfill da lead_analysis_state (se falhar, segue com o DISTINCT ON no histórico)
+    if ESTADO_LEADS_ATIVO:
+        try:
+            await cria_estado_leads(db_core)
+        except Exception as e:
+            logger.error(f"Erro ao criar lead_analysis_state, elegibilidade segue pelo histórico: {e}")
+    await verifica_estado_leads(db_core)
+
+    # Resumo rolante da conversa por lead (se falhar, IA segue recebendo o histórico completo)
+    if RESUMO_CONVERSA_ATIVO:
+        try:
+            await cria_resumos_conversa(db_core)
+            _resumos_conversa["ativo"] = True
+            logger.info("Resumo rolante de conversa (lead_conversation_summary) ativo")
+        except Exception as e:
+            logger.error(f"Erro ao criar lead_conversation_summary, IA segue com o histórico completo: {e}")
+
+    # Leases de company (várias réplicas dividem as companies; sem sharding processa todas)
+    leases = None
+    if SHARDING_ATIVO:
+        leases = LeasesCompanies(db_core, REPLICA_ID, LEASE_TTL)
+        await leases.inicia()
+
+    # Store local de conversas (sobrevive a restarts via volume em /app/data)
+    if CONVERSAS_LOCAIS_ATIVO:
+        try:
+            abre_conversas_locais(CONVERSAS_LOCAIS_DB)
+            logger.info(f"Store local de conversas aberto em {CONVERSAS_LOCAIS_DB}")
+        except Exception as e:
+            logger.error(f"Erro ao abrir store local de conversas, seguindo com busca completa: {e}")
     
     
     async with aiohttp.ClientSession() as session:
         try:
         
             while True:
+
+                inicio_ciclo = asyncio.get_running_loop().time()
+                backlog_restante = 0
+                processados_ciclo = 0
+
+                # tabela de estado criada por outra réplica depois do startup desta
+                await verifica_estado_leads(db_core)
             
                 # ------------------------------------------------------------------------------------------------------------------------------------------
-                # PROVISÓRIO: garante que user microservice está autorizado em todas companies
+                # PROVISÓRIO: garante que user microservice está autorizado em todas companies (incremental por created_at)
                 # ------------------------------------------------------------------------------------------------------------------------------------------
                 await add_user_microservice_companies(db_core)
                 
@@ -1557,66 +2910,95 @@ async def main():
                 dentro_do_horario = await checa_se_esta_dentro_do_horario()
                 
                 # dentro_do_horario = True
+
+                # Modo lote da Gemini: sempre, ou só fora do horário (quando também passa a processar nesse período)
+                em_modo_batch = GEMINI_MODO_BATCH == "sempre" or (GEMINI_MODO_BATCH == "fora_do_horario" and not dentro_do_horario)
+                modo_batch_ai.set(em_modo_batch)
+                prazo_batch_ai.set(inicio_proximo_horario_comercial() if em_modo_batch and GEMINI_MODO_BATCH == "fora_do_horario" else None)
+                if em_modo_batch:
+                    logger.info("Ciclo em modo lote (Batch API da Gemini)")
                 
-                if dentro_do_horario:
+                if dentro_do_horario or em_modo_batch:
                     
                     # ------------------------------------------------------------------------------------------------------------------------------------------
                     # PROCESSA POR INSTANCIA DE EVOLUTION (INSTANCIA -> COMPANY -> LEADS)
                     # ------------------------------------------------------------------------------------------------------------------------------------------
                     instancias_companies = await consulta_instancias_wpp(db_gateway)
 
-                    # Variável de controle para reconectar apenas quando trocar de instância
-                    evo_db_name_atual = None
-                    db_evo = None
+                    # Sharding: mantém só as companies arrendadas por esta réplica
+                    if leases is not None:
+                        try:
+                            minhas = await leases.companies_do_ciclo([
+                                company_id
+                                for instancia_companies in instancias_companies
+                                for company_id in instancia_companies.get("companies_ids", [])
+                            ])
+                        except Exception as e:
+                            logger.error(f"Erro ao distribuir companies por leases, pulando ciclo: {e}")
+                            minhas = set()
+                        instancias_companies = [
+                            {**instancia_companies, "companies_ids": [c for c in instancia_companies.get("companies_ids", []) if str(c) in minhas]}
+                            for instancia_companies in instancias_companies
+                        ]
 
                     logger.info(instancias_companies)
 
-                    for instancia_companies in instancias_companies:
-                    
-                        evo_db_host = instancia_companies.get("evo_db_host")
-                        evo_db_name = instancia_companies.get("evo_db_name")
-                        companies_ids = instancia_companies.get("companies_ids", [])
-
-                        if not evo_db_name or not companies_ids:
-                            #logger.info(f"Ignorando instância vazia ou sem companies: {instancia_companies}")
-                            continue
-
-                        # Reabre conexão apenas se mudar o nome da instância
-                        if evo_db_name != evo_db_name_atual:
-                            # Fecha conexão anterior, se houver
-                            if db_evo:
-                                try:
-                                    await db_evo.disconnect()
-                                    logger.info(f"Conexão com {evo_db_name_atual} encerrada.")
-                                except Exception as e:
-                                    logger.error(f"Erro ao encerrar conexão com {evo_db_name_atual}: {e}")
-
-                            # Abre nova conexão
-                            log_metadata.set({"evo_db_host": evo_db_host, "evo_db_name": evo_db_name})
-                            logger.info(f"Conectando à instância {evo_db_host} - {evo_db_name}...")
-                            db_evo = await conecta_leaper_db_evo(evo_db_host, evo_db_name, min_size=1, max_size=1)
-                            evo_db_name_atual = evo_db_name
-
-                        # Processa normalmente as companies da instância atual
-                        try:
-                            await processa_instancia_wpp(db_core, db_evo, evo_db_host, evo_db_name, session, companies_ids)
-                        except Exception as e:
-                            logger.error(f"Erro ao processar instância {evo_db_host} - {evo_db_name}: {e}")
+                    # Catálogo de status de todas as companies do ciclo (só recarrega as que mudaram)
+                    await atualiza_catalogo_status(db_core, [
+                        company_id
+                        for instancia_companies in instancias_companies
+                        for company_id in instancia_companies.get("companies_ids", [])
+                    ])
+
+                    resultados_instancias = await processa_instancias_wpp(db_core, session, instancias_companies)
+                    for resultado in resultados_instancias:
+                        if resultado:
+                            backlog_restante += resultado.get("backlog", 0)
+                            processados_ciclo += resultado.get("processados", 0)
+
+                    # Garante que os registros do ciclo estejam gravados antes da próxima consulta de elegibilidade
+                    await descarrega_tracking()
+
+                    # Stats de espera por conexão nos pools Evolution durante o ciclo
+                    log_metadata.set({})
+                    for stats_pool in estatisticas_pools_evo():
+                        logger.info(f"Pool Evolution {stats_pool['evo_db_host']} - {stats_pool['evo_db_name']} | {stats_pool}")
+
+                    # Limite atual de concorrência da Gemini (AIMD) e desfechos do ciclo
+                    logger.info(f"Concorrência Gemini (AIMD) | {controle_concorrencia_gemini.estatisticas()}")
+                    logger.info(f"Orçamento de tokens Gemini | {limitador_tokens_gemini.estatisticas()}")
+                    logger.info(f"Circuit breakers Gemini | {[b.estatisticas() for b in breakers_gemini]}")
+                    logger.info(f"Codificador de conversa ({CODIFICADOR_CONVERSA_PERFIL}) | {economia_codificador.estatisticas()}")
+
+                # Remove do store local leads fora do ai_analysis_period ou que saíram da elegibilidade
+                if conversas_locais_ativas():
+                    try:
+                        removidos = await asyncio.to_thread(remove_expirados, CONVERSAS_LOCAIS_DIAS_SEM_ATUALIZACAO)
+                        if removidos:
+                            logger.info(f"Store local de conversas: {removidos} leads removidos")
+                    except Exception as e:
+                        logger.error(f"Erro ao limpar store local de conversas: {e}")
 
-                    # Fecha a última conexão usada
-                    if db_evo:
-                        try:
-                            await db_evo.disconnect()
-                            logger.info(f"Conexão final com {evo_db_name_atual} encerrada.")
-                        except Exception as e:
-                            logger.error(f"Erro ao encerrar última conexão com {evo_db_name_atual}: {e}")
+                # Fecha pools Evolution sem uso há mais de EVO_POOL_IDLE_TIMEOUT
+                try:
+                    for evo_db_host, evo_db_name in await fecha_pools_evo_ociosos():
+                        logger.info(f"Pool ocioso com {evo_db_host} - {evo_db_name} encerrado.")
+                except Exception as e:
+                    logger.error(f"Erro ao encerrar pools Evolution ociosos: {e}")
 
                         
                         
                 # ------------------------------------------------------------------------------------------------------------------------------------------
-                # TIMER ATÉ PROXIMA EXECUÇÃO -> 5 minutos = 300 segundos
+                # PRÓXIMA EXECUÇÃO: IMEDIATA (+ FOLGA/JITTER) COM BACKLOG, SENÃO COMPLETA O INTERVALO OCIOSO
                 # ------------------------------------------------------------------------------------------------------------------------------------------
-                await asyncio.sleep(300) 
+                duracao_ciclo = asyncio.get_running_loop().time() - inicio_ciclo
+                espera = calcula_espera_proximo_ciclo(duracao_ciclo, backlog_restante, processados_ciclo)
+                log_metadata.set({})
+                logger.info(
+                    f"Ciclo concluído em {duracao_ciclo:.1f}s | Processados: {processados_ciclo} | "
+                    f"Backlog restante: {backlog_restante} | Próximo ciclo em {espera:.1f}s"
+                )
+                await asyncio.sleep(espera)
                 
 
         except Exception:
@@ -1625,12 +3007,35 @@ async def main():
         finally:
             logger.info("Encerrando conexões...")
 
+            # Jobs em lote ainda em andamento gravam tracking ao terminar
+            try:
+                await asyncio.wait_for(aguarda_jobs_gemini_batch(), timeout=60)
+            except Exception:
+                logger.exception("Jobs em lote da Gemini não concluídos no encerramento")
+
+            # Não perde registros ainda no buffer de tracking
+            try:
+                await encerra_tracking()
+            except Exception:
+                logger.exception("Erro ao descarregar buffer de tracking no encerramento")
+
+            # Devolve os leases para as outras réplicas
+            if leases is not None:
+                try:
+                    await leases.encerra()
+                except Exception:
+                    logger.exception("Erro ao liberar leases de company")
          
             try:
                 await db_core.disconnect()
             except Exception:
                 logger.exception("Erro ao desconectar db_core")
 
+            for (evo_db_host, evo_db_name), e in await fecha_pools_evo():
+                logger.error(f"Erro ao encerrar conexão com {evo_db_host} - {evo_db_name}: {e}")
+
+            fecha_conversas_locais()
+
             
             # TIME ELAPSED
             elapsed_td = datetime.now() - t0
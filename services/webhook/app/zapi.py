@@ -16,6 +16,7 @@ for _sub in ("logging", "api"):
     sys.path.append(str(_app / _sub))
 from log_config import logger, log_metadata
 from leaper_core_apis import get_auth_token_company_leaper, change_lead_status
+from estado_leads import atualiza_estado_resposta
 
 sys.path.append(str(_app / "scheduling"))
 
@@ -78,6 +79,12 @@ async def update_lead_status_response(conn, id_tb_tracking, status_name, metadat
         }
         await conn.execute(query, values=values)
 
+        # estado por lead (elegibilidade do status_analyzer): resposta recebida -> volta ao intervalo normal
+        try:
+            await atualiza_estado_resposta(conn, id_tb_tracking, values["response_date"])
+        except Exception as e:
+            logger.warning(f"Erro ao atualizar lead_analysis_state para id {id_tb_tracking}: {e}")
+
     except Exception as e:
         logger.error(f"Erro ao atualizar lead_status_transition para id {id_tb_tracking}: {e}")
 